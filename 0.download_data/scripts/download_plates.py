@@ -10,11 +10,13 @@
 
 import os
 import pathlib
-import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import sys
-sys.path.append("../")
-from utils import download_figshare as downfig
+sys.path.append("../utils")
+import download_figshare as downfig
+import image_catalog
+import image_compression
 
 
 # ## Set constant paths/variables
@@ -28,6 +30,27 @@ figshare_url = "https://figshare.com/ndownloader/articles/"
 # metadata folder for metadata files from both plates to be moved into
 metadata_dir = pathlib.Path("metadata")
 
+# all items are downloaded at once, where each item is downloaded over several connections and the total number of
+# connections (and bandwidth in bytes per second, which is not limited when None) is shared across the items
+connections_per_item = 4
+transfer_limits = downfig.TransferLimits(max_connections=16, max_bytes_per_second=None)
+
+# the files extracted from each item are saved with their checksums in a manifest for the item and version, so items
+# that are already extracted are skipped and only missing or corrupted files are downloaded again
+download_cache_dir = pathlib.Path("download_cache")
+
+# set to False to keep the zip files and read the images from them (see utils/zip_images.py) instead of extracting
+# them, which only works for analyses that read the images in Python (CellProfiler needs the extracted images)
+extract_images = True
+
+# set to True to rewrite the extracted images with lossless compression (see utils/image_compression.py), which makes
+# them smaller to store and faster to read from network storage
+compress_downloaded_images = False
+
+# only download the plates given by the stage scheduler (see utils/stage_scheduler.py) when it runs this notebook,
+# otherwise all plates are downloaded
+stage_plates = os.environ["NF1_STAGE_PLATES"].split(",") if os.environ.get("NF1_STAGE_PLATES") else None
+
 
 # ## Set dictionaries with specific path/variables for each plate
 # 
@@ -37,9 +60,10 @@ metadata_dir = pathlib.Path("metadata")
 
 
 # since we are dealing with zip files, we use the optional parameter `output_dir` where we 
-# specify where to extract the files to
+# specify where to extract the files to (with the plates that have images in each download)
 download_plates_info_dictionary = {
     "Plate_1": {
+        "plates": ["Plate_1"],
         "figshare_id": "22233292",
         "version_number": "2",
         "output_folder": "Plate_1_zip",
@@ -47,6 +71,7 @@ download_plates_info_dictionary = {
         "output_dir": pathlib.Path("./Plate_1"),
     },
     "Plate_2": {
+        "plates": ["Plate_2"],
         "figshare_id": "22233700",
         "version_number": "4",
         "output_folder": "Plate_2_zip",
@@ -54,43 +79,53 @@ download_plates_info_dictionary = {
         "output_dir": pathlib.Path("./Plate_2"),
     },
     # these plates are combined due to the figshare project containing zip files with the images for each plate and
-    # is extracted in a second step
+    # is extracted in the same pass as the download (see `nested_zips`)
     "Plates_3_and_3_prime": {
+        "plates": ["Plate_3", "Plate_3_prime"],
         "figshare_id": "22592890",
         "version_number": "2",
         "output_folder": "Plates_3_zip",
         # save extracted zip files from figshare download to a folder in the `0.download_data` directory
         "output_dir": pathlib.Path("./Plates_3_and_3_prime"),
+        # the images for each plate are extracted from the zip file inside the download to the plate folder
+        "nested_zips": {
+            "plate_3.zip": pathlib.Path("./Plate_3"),
+            "plate_3_prime.zip": pathlib.Path("./Plate_3_prime"),
+        },
     },
     # this plate data was added to figshare as a zip file due to the size of the data and
-    # is extracted in a second step
+    # is extracted in the same pass as the download (see `nested_zips`)
     "Plate_4": {
+        "plates": ["Plate_4"],
         "figshare_id": "23671056",
         "version_number": "1",
         "output_folder": "Plates_4_zip",
         # save extracted zip file from figshare download to a folder in the `0.download_data` directory
         "output_dir": pathlib.Path("./Plate_4_zip"),
+        "nested_zips": {"plate_4.zip": pathlib.Path("./Plate_4")},
     },
     # this plate data was added to figshare as a zip file due to the size of the data and
-    # is extracted in a second step
+    # is extracted in the same pass as the download (see `nested_zips`)
     "Plate_5": {
+        "plates": ["Plate_5"],
         "figshare_id": "26759914",
         "version_number": "1",
         "output_folder": "Plates_5_zip",
         # save extracted zip file from figshare download to a folder in the `0.download_data` directory
         "output_dir": pathlib.Path("./Plate_5_zip"),
+        "nested_zips": {"Plate_5.zip": pathlib.Path("./Plate_5")},
     },
 }
 
 
 # ## Download files for all plates
 # 
-# **Note:** In the case of the NF1 Schwann Cell Project, the items on figshare are downloaded as zip files so we will have the `unzip_download` parameter turned on to extract the items from the zip file into the respective plate directory.
+# **Note:** In the case of the NF1 Schwann Cell Project, the items on figshare are downloaded as zip files so we will have the `unzip_download` parameter turned on to extract the items from the zip file into the respective plate directory (including the zip files for each plate inside the items). The metadata CSV files are extracted straight into the metadata folder.
 
 # In[4]:
 
 
-for _, info in download_plates_info_dictionary.items():
+def download_item(info: dict) -> None:
     # set the parameters for the function as variables based on the plate dictionary info
     figshare_id = str(info["figshare_id"] + "/versions/" + info["version_number"])
     output_folder = info["output_folder"]
@@ -105,65 +140,42 @@ for _, info in download_plates_info_dictionary.items():
         figshare_url=figshare_url,
         # zip files are downloaded from figshare so they need to be unzipped
         unzip_download="True",
+        num_connections=connections_per_item,
+        transfer_limits=transfer_limits,
+        # the zip files inside the download are extracted in the same pass instead of in a second step
+        nested_zips=info.get("nested_zips"),
+        cache_dir=download_cache_dir,
+        extract_images=extract_images,
     )
 
 
-# ## Extract images from extracted zip file from figshare download
-
-# In[5]:
-
-
-# this dictionary contains the paths to the extracted zip file from the previous step for each plate
-# and the path to the directory for the images
-zip_images_dictionary = {
-    "Plate_3": {
-        "path_to_zip_file": pathlib.Path("./Plates_3_and_3_prime/plate_3.zip"),
-        "extraction_path": pathlib.Path("./Plate_3"),
-    },
-    "Plate_3_prime": {
-        "path_to_zip_file": pathlib.Path("./Plates_3_and_3_prime/plate_3_prime.zip"),
-        "extraction_path": pathlib.Path("./Plate_3_prime"),
-    },
-    "Plate_4": {
-        "path_to_zip_file": pathlib.Path("./Plate_4_zip/plate_4.zip"),
-        "extraction_path": pathlib.Path("./Plate_4"),
-    },
-    "Plate_5": {
-        "path_to_zip_file": pathlib.Path("./Plate_5_zip/Plate_5.zip"),
-        "extraction_path": pathlib.Path("./Plate_5"),
-    }
-}
-
+download_infos = [
+    info
+    for info in download_plates_info_dictionary.values()
+    if stage_plates is None or set(info["plates"]) & set(stage_plates)
+]
+with ThreadPoolExecutor(max_workers=max(len(download_infos), 1)) as executor:
+    # raise an error if any download failed (downloads that stopped resume when this is run again)
+    for _ in executor.map(download_item, download_infos):
+        pass
 
-# In[6]:
 
+# ## Update the image catalog
+# 
+# The image catalog (`image_catalog.parquet`) lists every image with the plate, well, site, channel, stain, size, modification time, and checksum, which the other modules use to find the plates without walking the image directories.
 
-for plate, info in zip_images_dictionary.items():
-    # set the parameters for the function as variables based on the plate dictionary info
-    path_to_zip_file = info["path_to_zip_file"]
-    extraction_path = info["extraction_path"]
+# In[ ]:
 
-    print(f"Starting extraction on {plate} zip file!")
 
-    # download images and metadata for both plates
-    downfig.extract_zip_from_Figshare(
-        path_to_zip_file=path_to_zip_file,
-        extraction_path=extraction_path,
+# compress the images that are not compressed yet, which keeps the download manifests up to date so the compressed
+# images are not downloaded again
+if compress_downloaded_images:
+    image_compression.compress_images(
+        images_dir=pathlib.Path("."),
+        plates=stage_plates,
+        download_cache_dir=download_cache_dir,
     )
 
-
-# ### Remove folder with zip files since all files have been extracted
-
-# In[7]:
-
-
-# remove the directory with the zip files for Plates 3, 3 prime, 4, and 5 only since the zips are no longer needed
-for plate in ["Plate_3", "Plate_4", "Plate_5"]:
-    if zip_images_dictionary[plate]["path_to_zip_file"].exists():
-        # remove the parent directory with the zip files as we have moved all the images
-        parent_directory = os.path.dirname(zip_images_dictionary[plate]["path_to_zip_file"])
-        shutil.rmtree(parent_directory)
-        print(f"The directory containing zip files from Figshare for {plate} has been deleted as the files have been extracted!")
-    else:
-        print(f"The path to the zip file for {plate} does not exist. Please check to make sure that the data was downloaded properly from Figshare.")
+# add the downloaded images to the image catalog (only new or changed images are checksummed)
+image_catalog.update_catalog(pathlib.Path("."))
 
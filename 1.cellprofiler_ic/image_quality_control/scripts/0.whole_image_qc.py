@@ -15,7 +15,9 @@ import pprint
 import sys
 
 sys.path.append("../../utils")
+import cp_manifest
 import cp_parallel
+import image_catalog
 
 
 # ## Set paths and variables
@@ -26,6 +28,11 @@ import cp_parallel
 # set the run type for the parallelization
 run_name = "quality_control"
 
+# backend that runs the CellProfiler processes, which is "local", "batch" (e.g., SLURM), or "dask",
+# with options for the batch or Dask backend (see utils/cp_executors.py)
+executor = "local"
+executor_options = {}
+
 # set path for pipeline for illumination correction
 path_to_pipeline = pathlib.Path("../pipelines/whole_image_qc.cppipe").resolve(strict=True)
 
@@ -36,12 +43,10 @@ output_dir.mkdir(exist_ok=True)
 # directory where images are located within folders
 images_dir = pathlib.Path("../../0.download_data")
 
-# list for plate names based on folders to use to create dictionary
-plate_names = []
-# iterate through 0.download_data and append plate names from folder names that contain image data from that plate
-for file_path in images_dir.iterdir():
-    if str(file_path.stem).startswith("Plate"):
-        plate_names.append(str(file_path.stem))
+# find the plates from the image catalog for 0.download_data (made when the plates are downloaded), where plates with images that are only
+# in a zip file (kept with `extract_images=False`) are skipped
+plate_directories = image_catalog.plate_directories(images_dir)
+plate_names = sorted(plate_directories)
 
 print(plate_names)
 print("There are a total of", len(plate_names), "plates. The names of the plates are:")
@@ -57,9 +62,7 @@ for plate in plate_names:
 # create plate info dictionary with all parts of the CellProfiler CLI command to run in parallel
 plate_info_dictionary = {
     name: {
-        "path_to_images": pathlib.Path(list(images_dir.rglob(name))[0]).resolve(
-            strict=True
-        ),
+        "path_to_images": plate_directories[name],
         "path_to_output": pathlib.Path(f"{output_dir}/{name}"),
         "path_to_pipeline": path_to_pipeline,
 
@@ -67,6 +70,19 @@ plate_info_dictionary = {
     for name in plate_names if not name=='Plate_1' and not name=='Plate_2' # Do not include pilot datasets
 }
 
+# only keep plates with image sets that have not been processed yet (based on the run manifest), where plates
+# run before the run manifest was added are complete if they have the Image.csv output
+plate_info_dictionary = {
+    name: info
+    for name, info in plate_info_dictionary.items()
+    if not cp_manifest.is_plate_complete(
+        path_to_output=info["path_to_output"],
+        path_to_pipeline=info["path_to_pipeline"],
+        path_to_images=info["path_to_images"],
+        legacy_output_pattern="Image.csv",
+    )
+}
+
 # view the dictionary to assess that all info is added correctly
 pprint.pprint(plate_info_dictionary, indent=4)
 
@@ -77,6 +93,10 @@ pprint.pprint(plate_info_dictionary, indent=4)
 
 
 cp_parallel.run_cellprofiler_parallel(
-    plate_info_dictionary=plate_info_dictionary, run_name=run_name
+    plate_info_dictionary=plate_info_dictionary,
+    run_name=run_name,
+    sharded=True,
+    executor=executor,
+    executor_options=executor_options,
 )
 
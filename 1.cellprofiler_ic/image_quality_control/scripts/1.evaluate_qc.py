@@ -15,6 +15,7 @@
 
 
 import pathlib
+import sys
 import pandas as pd
 import numpy as np
 
@@ -22,6 +23,9 @@ from scipy.stats import zscore
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+sys.path.append("../../utils")
+import cp_skiplist
+
 
 # ## Set paths and load in data frame
 
@@ -177,6 +181,10 @@ threshold_value_below_mean = mean_value - threshold * std_dev
 print("Threshold for outliers above the mean:", threshold_value_above_mean)
 print("Threshold for outliers below the mean:", threshold_value_below_mean)
 
+# Keep the blur thresholds for the skip lists (the threshold variables are used again for saturation below)
+blur_minimum = threshold_value_below_mean
+blur_maximum = threshold_value_above_mean
+
 
 # **We will be using these thresholds in the CellProfiler pipeline. We will set anything `greater` than -1.37 as outliers and anything `below` -2.50 as outliers.**
 
@@ -390,5 +398,34 @@ threshold_value_above_mean = mean_value + threshold * std_dev
 # Print the calculated threshold values
 print("Threshold for outliers above the mean:", threshold_value_above_mean)
 
+# Keep the saturation threshold for the skip lists
+saturation_maximum = threshold_value_above_mean
+
 
 # **We will be using 1.40 as the threshold for anything that `above` this is considered a outlier for all channels.**
+
+# ## Create skip lists for each plate
+# 
+# The thresholds calculated above are saved to `qc_thresholds.json`, and the image sets (well and site) where any channel is outside the blur thresholds or above the saturation threshold are saved in a skip list for each plate. These image sets are left out of the LoadData CSV in `2.cellprofiler_analysis`, so they are not segmented or measured.
+
+# In[ ]:
+
+
+# Directory for the skip list of each plate, which is used in 2.cellprofiler_analysis
+skip_list_dir = pathlib.Path("./skip_lists")
+
+# Save the thresholds found above (rounded to the second decimal like in the pipeline) to use them to flag image sets
+thresholds_path = pathlib.Path("./qc_thresholds.json")
+qc_thresholds = cp_skiplist.save_qc_thresholds(
+    thresholds_path=thresholds_path,
+    blur_minimum=blur_minimum,
+    blur_maximum=blur_maximum,
+    saturation_maximum=saturation_maximum,
+)
+print(qc_thresholds)
+
+skip_list_paths = cp_skiplist.create_skip_lists(
+    qc_path=pathlib.Path("./concat_img_quality_data.parquet"),
+    thresholds_path=thresholds_path,
+    output_dir=skip_list_dir,
+)
@@ -8,13 +8,18 @@
 # In[1]:
 
 
+import os
 import pathlib
 import pprint
 
 import sys
 
 sys.path.append("../utils")
+import cp_illum_cache
+import cp_manifest
 import cp_parallel
+import image_catalog
+import image_compression
 
 
 # ## Set paths and variables
@@ -25,6 +30,11 @@ import cp_parallel
 # set the run type for the parallelization
 run_name = "illum_correction"
 
+# backend that runs the CellProfiler processes, which is "local", "batch" (e.g., SLURM), or "dask",
+# with options for the batch or Dask backend (see utils/cp_executors.py)
+executor = "local"
+executor_options = {}
+
 # Directory with pipelines
 pipeline_dir = pathlib.Path("./pipelines/").resolve(strict=True)
 
@@ -35,12 +45,28 @@ output_dir.mkdir(exist_ok=True)
 # directory where images are located within folders
 images_dir = pathlib.Path("../0.download_data/")
 
-# list for plate names based on folders to use to create dictionary
-plate_names = []
-# iterate through 0.download_data and append plate names from folder names that contain image data from that plate
-for file_path in pathlib.Path("../0.download_data/").iterdir():
-    if str(file_path.stem).startswith("Plate"):
-        plate_names.append(str(file_path.stem))
+# directory for the illumination functions of each plate, which are reused when the images and the settings for
+# calculating them have not changed
+illum_cache_dir = pathlib.Path("./illum_cache").resolve()
+
+# set to True to rewrite the corrected images with lossless compression (see utils/image_compression.py), which makes
+# them smaller to store and faster to read during analysis
+compress_corrected_images = False
+
+# update the image catalog for 0.download_data (made when the plates are downloaded), since the image checksums in the
+# catalog are used to find the illumination functions in the cache
+image_catalog.update_catalog(images_dir)
+
+# find the plates from the image catalog for 0.download_data, where plates with images that are only
+# in a zip file (kept with `extract_images=False`) are skipped
+plate_directories = image_catalog.plate_directories(images_dir)
+plate_names = sorted(plate_directories)
+
+# only process the plates given by the stage scheduler (see utils/stage_scheduler.py) when it runs this notebook, with
+# the number of CellProfiler processes it was given
+if os.environ.get("NF1_STAGE_PLATES"):
+    plate_names = [name for name in plate_names if name in os.environ["NF1_STAGE_PLATES"].split(",")]
+max_workers = int(os.environ["NF1_STAGE_MAX_WORKERS"]) if os.environ.get("NF1_STAGE_MAX_WORKERS") else None
 
 print(plate_names)
 
@@ -53,15 +79,11 @@ print(plate_names)
 # create plate info dictionary with all parts of the CellProfiler CLI command to run in parallel
 plate_info_dictionary = {
     name: {
-        "path_to_images": pathlib.Path(list(images_dir.rglob(name))[0]).resolve(
-            strict=True
-        ),
+        "path_to_images": plate_directories[name],
         "path_to_output": pathlib.Path(f"{output_dir}/Corrected_{name}"),
+        "illum_cache_dir": illum_cache_dir,
     }
     for name in plate_names
-    if not any(
-        pathlib.Path(f"{output_dir}/Corrected_{name}").glob("*")
-    )  # only add plates that have not been processed yet
 }
 
 # iterate over the dictionary and add the path_to_pipeline specific for each plate
@@ -77,6 +99,20 @@ for name, info in plate_info_dictionary.items():
             f"{pipeline_dir}/NF1_illum_4channel.cppipe"
         ).resolve(strict=True)
 
+# only keep plates with image sets that have not been processed yet (based on the run manifest), where plates
+# corrected before the run manifest was added are complete if the run finished, which is when the QC measurements
+# are exported (QC-flagged image sets are skipped, so there is not a corrected image for every image set)
+plate_info_dictionary = {
+    name: info
+    for name, info in plate_info_dictionary.items()
+    if not cp_manifest.is_plate_complete(
+        path_to_output=info["path_to_output"],
+        path_to_pipeline=info["path_to_pipeline"],
+        path_to_images=info["path_to_images"],
+        legacy_output_pattern="IC_QC_RunImage.csv",
+    )
+}
+
 # view the dictionary to assess that all info is added correctly
 pprint.pprint(plate_info_dictionary, indent=4)
 
@@ -89,6 +125,32 @@ pprint.pprint(plate_info_dictionary, indent=4)
 
 
 cp_parallel.run_cellprofiler_parallel(
-    plate_info_dictionary=plate_info_dictionary, run_name=run_name
+    plate_info_dictionary=plate_info_dictionary,
+    run_name=run_name,
+    sharded=True,
+    max_workers=max_workers,
+    executor=executor,
+    executor_options=executor_options,
 )
 
+# mark the illumination functions in the cache as complete for plates where all image sets are completed
+for name, info in plate_info_dictionary.items():
+    if cp_manifest.is_plate_complete(
+        path_to_output=info["path_to_output"],
+        path_to_pipeline=info["path_to_pipeline"],
+        path_to_images=info["path_to_images"],
+    ):
+        cp_illum_cache.record_illum_cache(
+            path_to_pipeline=info["path_to_pipeline"],
+            path_to_images=info["path_to_images"],
+            cache_dir=illum_cache_dir,
+            path_to_output=info["path_to_output"],
+        )
+
+# compress the corrected images of the plates that were just corrected
+if compress_corrected_images:
+    image_compression.compress_images(images_dir=output_dir, plates=list(plate_info_dictionary))
+
+# add the corrected images to the image catalog for Corrected_Images, which is used to find the plates for analysis
+image_catalog.update_catalog(output_dir)
+
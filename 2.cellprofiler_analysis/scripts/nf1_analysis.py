@@ -8,13 +8,18 @@
 # In[1]:
 
 
+import os
 import pathlib
 import pprint
 
 import sys
 
 sys.path.append("../utils")
+import cp_illum_cache
+import cp_manifest
 import cp_parallel
+import cp_sqlite
+import image_catalog
 from cp_sequential import rename_sqlite_file
 
 
@@ -26,19 +31,53 @@ from cp_sequential import rename_sqlite_file
 # set the run type for the parallelization
 run_name = "analysis"
 
+# backend that runs the CellProfiler processes, which is "local", "batch" (e.g., SLURM), or "dask",
+# with options for the batch or Dask backend (see utils/cp_executors.py)
+executor = "local"
+executor_options = {}
+
 # set main output dir for all plates
 output_dir = pathlib.Path("./analysis_output")
 output_dir.mkdir(exist_ok=True)
 
-# directory where images are located within folders
-images_dir = pathlib.Path("../1.cellprofiler_ic/Corrected_Images/")
-
-# list for plate names based on folders to use to create dictionary
-plate_names = []
-# iterate through 0.download_data and append plate names from folder names that contain image data from that plate
-for file_path in pathlib.Path("../0.download_data/").iterdir():
-    if str(file_path.stem).startswith("Plate"):
-        plate_names.append(str(file_path.stem))
+# correct the raw images in the analysis run with the illumination functions from 1.cellprofiler_ic (loaded from the
+# illumination function cache when they are cached) instead of analyzing the corrected images saved by nf1_ic, where
+# the corrected images are only saved to Corrected_Images when they are exported
+fused_illum_correction = False
+export_corrected_images = False
+illum_pipeline_dir = pathlib.Path("../1.cellprofiler_ic/pipelines/").resolve(strict=True)
+illum_cache_dir = pathlib.Path("../1.cellprofiler_ic/illum_cache").resolve()
+corrected_images_dir = pathlib.Path("../1.cellprofiler_ic/Corrected_Images/")
+
+# directory where images are located within folders, which are the raw images when correcting in the analysis run
+if fused_illum_correction:
+    images_dir = pathlib.Path("../0.download_data/")
+    # the image checksums in the catalog are used to find the illumination functions in the cache
+    image_catalog.update_catalog(images_dir)
+else:
+    images_dir = corrected_images_dir
+
+# directory to save the Parquet file of each shard, which is converted with CytoTable as soon as the shard completes
+# while the other shards are still running (these are combined for each plate in 3.processing_features)
+stream_convert_dir = pathlib.Path("../3.processing_features/data/converted_data/streamed_shards").resolve()
+
+# time the single-cell merge of each plate SQLite file before and after it is optimized (saved to the statistics file
+# next to the SQLite file), which merges every single cell twice so it adds time to the run
+benchmark_sqlite_merge = False
+
+# directory with the QC skip list for each plate (made in 1.evaluate_qc), where flagged image sets are not analyzed
+skip_list_dir = pathlib.Path("../1.cellprofiler_ic/image_quality_control/skip_lists/")
+
+# find the plates from the image catalog for the image directory (Corrected_Images is updated after illumination correction),
+# where plates with images that are only in a zip file (kept with `extract_images=False`) are skipped
+plate_directories = image_catalog.plate_directories(images_dir)
+plate_names = sorted(plate_directories)
+
+# only process the plates given by the stage scheduler (see utils/stage_scheduler.py) when it runs this notebook, with
+# the number of CellProfiler processes it was given
+if os.environ.get("NF1_STAGE_PLATES"):
+    plate_names = [name for name in plate_names if name in os.environ["NF1_STAGE_PLATES"].split(",")]
+max_workers = int(os.environ["NF1_STAGE_MAX_WORKERS"]) if os.environ.get("NF1_STAGE_MAX_WORKERS") else None
 
 print(plate_names)
 
@@ -51,13 +90,13 @@ print(plate_names)
 # create plate info dictionary with specified plates for the CellProfiler CLI command
 plate_info_dictionary = {
     name: {
-        "path_to_images": pathlib.Path(
-            list(images_dir.rglob(f"Corrected_{name}"))[0]
-        ).resolve(strict=True),
+        "path_to_images": plate_directories[name],
         "path_to_output": pathlib.Path(f"{output_dir}/{name}"),
     }
     for name in plate_names
-    if not any((output_dir / name).glob("*.sqlite")) # only process plates that have not been processed yet
+    # only process plates that have not been processed yet, where the SQLite file is only renamed once all image
+    # sets are completed (plates with an unnamed SQLite file are resumed from the missing image sets)
+    if not (output_dir / name / f"{name}_nf1_analysis.sqlite").exists()
 }
 
 # iterate over the dictionary and add the path_to_pipeline specific for each plate
@@ -67,11 +106,22 @@ for name, info in plate_info_dictionary.items():
         info["path_to_pipeline"] = pathlib.Path(
             "./NF1_analysis_3channel.cppipe"
         ).resolve(strict=True)
+        illum_pipeline_name = "NF1_illum_3channel.cppipe"
     # all other plates have 4 channels and will use that specific pipeline
     else:
         info["path_to_pipeline"] = pathlib.Path(
             "./NF1_analysis_4channel.cppipe"
         ).resolve(strict=True)
+        illum_pipeline_name = "NF1_illum_4channel.cppipe"
+    # the illumination correction pipeline is only used when correcting the images in the analysis run
+    if fused_illum_correction:
+        info["path_to_illum_pipeline"] = (illum_pipeline_dir / illum_pipeline_name).resolve(strict=True)
+        info["illum_cache_dir"] = illum_cache_dir
+        if export_corrected_images:
+            info["path_to_corrected_images"] = corrected_images_dir / f"Corrected_{name}"
+    # only plates with QC metrics have a skip list
+    if (skip_list_dir / f"{name}_skip_list.csv").exists():
+        info["path_to_skip_list"] = (skip_list_dir / f"{name}_skip_list.csv").resolve()
 
 # view the dictionary to assess that all info is added correctly
 pprint.pprint(plate_info_dictionary, indent=4)
@@ -86,10 +136,37 @@ pprint.pprint(plate_info_dictionary, indent=4)
 
 # Process data with cp_parallel
 cp_parallel.run_cellprofiler_parallel(
-    plate_info_dictionary=plate_info_dictionary, run_name=run_name
+    plate_info_dictionary=plate_info_dictionary,
+    run_name=run_name,
+    sharded=True,
+    max_workers=max_workers,
+    executor=executor,
+    executor_options=executor_options,
+    stream_convert_dir=stream_convert_dir,
 )
 
-# rename the sqlite files to match the plate names
-for name in plate_names:
-    rename_sqlite_file(pathlib.Path(f"{output_dir}/{name}"), name)
+# rename the sqlite files to match the plate names once all image sets for the plate are completed, and add the indexes
+# and statistics used to merge single cells to them
+for name, info in plate_info_dictionary.items():
+    if cp_manifest.is_plate_complete(
+        path_to_output=info["path_to_output"],
+        path_to_pipeline=info["path_to_pipeline"],
+        path_to_images=info["path_to_images"],
+        path_to_skip_list=info.get("path_to_skip_list"),
+    ):
+        sqlite_file_path = rename_sqlite_file(pathlib.Path(f"{output_dir}/{name}"), name)
+        cp_sqlite.optimize_sqlite_file(sqlite_file_path, benchmark=benchmark_sqlite_merge)
+        # mark the illumination functions saved in the analysis run as complete in the cache
+        if fused_illum_correction:
+            cp_illum_cache.record_illum_cache(
+                path_to_pipeline=info["path_to_illum_pipeline"],
+                path_to_images=info["path_to_images"],
+                cache_dir=illum_cache_dir,
+                path_to_output=info["path_to_output"],
+            )
+    else:
+        print(f"{name} has image sets that are not completed, so run this notebook again to resume the plate!")
 
+# add the exported corrected images to the image catalog for Corrected_Images
+if fused_illum_correction and export_corrected_images:
+    image_catalog.update_catalog(corrected_images_dir)
@@ -8,6 +8,7 @@
 # In[1]:
 
 
+import os
 import sys
 import pathlib
 import yaml
@@ -15,11 +16,14 @@ import pprint
 import pandas as pd
 
 # cytotable will merge objects from SQLite file into single cells and save as parquet file
-from cytotable import convert, presets
+from cytotable import convert
 
 # import utility to use function that will add single-cell count per well as a metadata column
 sys.path.append("../utils")
 import extraction_utils as sc_utils
+import image_catalog
+import cp_stream_convert
+import sc_merge
 
 
 # ## Set paths and variables
@@ -33,17 +37,15 @@ dest_datatype = "parquet"
 # preset configurations based on typical CellProfiler outputs
 preset = "cellprofiler_sqlite_pycytominer"
 
-# update preset to include site metadata and cell counts
-joins = presets.config["cellprofiler_sqlite_pycytominer"]["CONFIG_JOINS"].replace(
-    "Image_Metadata_Well,",
-    "Image_Metadata_Well, Image_Metadata_Site,",
-)
+# update preset to include site metadata and the PathName columns (the same joins are used for the shards that are
+# converted during the analysis run)
+joins = cp_stream_convert.cytotable_joins()
 
-# Add the PathName columns separately
-joins = joins.replace(
-    "COLUMNS('Image_FileName_.*'),",
-    "COLUMNS('Image_FileName_.*'),\n COLUMNS('Image_PathName_.*'),"
-)
+# merge single cells with CytoTable ("cytotable") or with one DuckDB query that makes the same columns ("duckdb", see
+# utils/sc_merge.py), with the number of threads and the memory limit in GB for DuckDB (None uses the DuckDB defaults)
+merge_engine = "cytotable"
+merge_threads = None
+merge_memory_limit_gb = None
 
 # set main output dir for all parquet files
 output_dir = pathlib.Path("./data/converted_data/")
@@ -52,15 +54,18 @@ output_dir.mkdir(exist_ok=True)
 # directory where SQLite files are located
 sqlite_dir = pathlib.Path("../2.cellprofiler_analysis/analysis_output/")
 
-# list for plate names based on folders to use to create dictionary
-plate_names = []
+# directory with the shards converted to parquet while the analysis was running (see 2.cellprofiler_analysis)
+streamed_dir = pathlib.Path(f"{output_dir}/streamed_shards")
 
-# iterate through 0.download_data and append plate names from folder names
-# that contain image data from that plate
+# find the plates from the image catalog for 0.download_data
 # (Note, you must first run `0.download_data/download_plates.ipynb`)
-for file_path in pathlib.Path("../0.download_data/").iterdir():
-    if str(file_path.stem).startswith("Plate"):
-        plate_names.append(str(file_path.stem))
+all_plate_names = image_catalog.list_plates(pathlib.Path("../0.download_data/"))
+plate_names = all_plate_names
+
+# only merge the plates given by the stage scheduler (see utils/stage_scheduler.py) when it runs this notebook, which
+# runs it once per plate (the yaml file for the downstream steps still lists every converted plate)
+if os.environ.get("NF1_STAGE_PLATES"):
+    plate_names = [name for name in plate_names if name in os.environ["NF1_STAGE_PLATES"].split(",")]
 
 print(plate_names)
 
@@ -72,9 +77,9 @@ print(plate_names)
 # In[3]:
 
 
-# create plate info dictionary with all parts of the CellProfiler CLI command to run in parallel
-plate_info_dictionary = {
-    name: {
+def plate_info(name: str) -> dict:
+    """Find the path to the SQLite file of a plate and the path to save its parquet file."""
+    return {
         "source_path": str(
             pathlib.Path(
                 list(sqlite_dir.rglob(f"{name}_nf1_analysis.sqlite"))[0]
@@ -82,6 +87,11 @@ plate_info_dictionary = {
         ),
         "dest_path": str(pathlib.Path(f"{output_dir}/{name}.parquet")),
     }
+
+
+# create plate info dictionary with all parts of the CellProfiler CLI command to run in parallel
+plate_info_dictionary = {
+    name: plate_info(name)
     for name in plate_names
     if not pathlib.Path(
         f"{output_dir}/{name}.parquet"
@@ -102,16 +112,31 @@ for plate, info in plate_info_dictionary.items():
     source_path = info["source_path"]
     dest_path = info["dest_path"]
 
-    print(f"Performing merge single cells and conversion on {plate}!")
-
-    # merge single cells and output as parquet file
-    convert(
-        source_path=source_path,
-        dest_path=dest_path,
-        dest_datatype=dest_datatype,
-        preset=preset,
-        joins=joins,
-    )
+    # combine the shards that were converted during the analysis run when they cover every image set of the plate
+    if cp_stream_convert.is_stream_complete(
+        plate_dir=streamed_dir / plate, path_to_output=pathlib.Path(source_path).parent
+    ):
+        print(f"Combining the converted shards for {plate}!")
+        cp_stream_convert.combine_converted_shards(plate_dir=streamed_dir / plate, dest_path=dest_path)
+    else:
+        print(f"Performing merge single cells and conversion on {plate}!")
+
+        # merge single cells and output as parquet file
+        if merge_engine == "duckdb":
+            sc_merge.merge_single_cells(
+                source_path=source_path,
+                dest_path=dest_path,
+                threads=merge_threads,
+                memory_limit_gb=merge_memory_limit_gb,
+            )
+        else:
+            convert(
+                source_path=source_path,
+                dest_path=dest_path,
+                dest_datatype=dest_datatype,
+                preset=preset,
+                joins=joins,
+            )
     print(f"Merged and converted {pathlib.Path(dest_path).name}!")
 
     # add single cell count per well as metadata column to parquet file and save back to same path
@@ -171,16 +196,19 @@ for plate, info in plate_info_dictionary.items():
 # In[6]:
 
 
-# Automatically select one plate from the current dictionary
-selected_plate = next(iter(plate_info_dictionary))
-print(f"Selected plate: {selected_plate}")
+# Automatically select one plate from the current dictionary (which is empty when all plates were already merged)
+if plate_info_dictionary:
+    selected_plate = next(iter(plate_info_dictionary))
+    print(f"Selected plate: {selected_plate}")
 
-# Load the DataFrame from the Parquet file of the selected plate
-converted_df = pd.read_parquet(plate_info_dictionary[selected_plate]["dest_path"])
+    # Load the DataFrame from the Parquet file of the selected plate
+    converted_df = pd.read_parquet(plate_info_dictionary[selected_plate]["dest_path"])
 
-# Print the shape and head of the DataFrame
-print(converted_df.shape)
-converted_df.head()
+    # Print the shape and head of the DataFrame
+    print(converted_df.shape)
+    print(converted_df.head())
+else:
+    print("No plates were merged in this run!")
 
 
 # ## Write dictionary to yaml file for use in downstream steps
@@ -188,7 +216,23 @@ converted_df.head()
 # In[7]:
 
 
+# the yaml file lists every plate that has been converted (not only the plates merged in this run), and keeps the
+# paths added to it by the downstream steps (e.g., the cleaned_path from 1.sc_cosmicqc)
 dictionary_path = pathlib.Path("./plate_info_dictionary.yaml")
-with open(dictionary_path, "w") as file:
-    yaml.dump(plate_info_dictionary, file)
+converted_plates = {}
+if dictionary_path.exists():
+    with open(dictionary_path, "r") as file:
+        converted_plates = yaml.safe_load(file) or {}
+for name in all_plate_names:
+    # plates with a SQLite file that has been removed since they were converted keep the paths already in the yaml file
+    if pathlib.Path(f"{output_dir}/{name}.parquet").exists() and (
+        name not in converted_plates or any(sqlite_dir.rglob(f"{name}_nf1_analysis.sqlite"))
+    ):
+        converted_plates[name] = {**converted_plates.get(name, {}), **plate_info(name)}
+
+# write to a temporary file first so the yaml file is never left half written when plates are merged at the same time
+temporary_path = dictionary_path.with_suffix(f".yaml.{os.getpid()}.tmp")
+with open(temporary_path, "w") as file:
+    yaml.dump(converted_plates, file)
+temporary_path.replace(dictionary_path)
 
@@ -0,0 +1,350 @@
+"""
+This collection of functions runs a list of CellProfiler commands on an executor backend. The same commands (from the
+plate_info_dictionary) can be run on the local machine, submitted as job scripts to a batch scheduler (e.g., SLURM),
+or sent to the workers of a Dask cluster by changing the executor name and options.
+
+Each batch job and Dask task runs its command with `cp_job.run_job`, which only needs `cp_ledger`, so the compute
+nodes do not need the packages used to schedule the commands (e.g., psutil).
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Callable, List, Optional
+import json
+import pathlib
+import shlex
+import subprocess
+import sys
+import time
+
+import cp_job
+import cp_ledger
+import cp_progress
+import cp_retry
+import cp_scheduler
+
+# names of the executor backends that can be used to run CellProfiler
+EXECUTORS = ("local", "batch", "dask")
+
+# template for the job script submitted to a batch scheduler, where the directives are set from the options
+BATCH_SCRIPT_TEMPLATE = """#!/bin/bash
+#SBATCH --job-name={job_name}
+#SBATCH --output={scheduler_log_path}
+#SBATCH --cpus-per-task={cpus_per_task}
+#SBATCH --mem={mem_gb}G
+#SBATCH --time={time_limit}
+{extra_directives}
+{setup_commands}
+{python} {runner_path} --log-path {log_path} --usage-path {usage_path} -- {command}
+"""
+
+
+def completed_processes(commands: List[list], usages: List[dict]) -> List[subprocess.CompletedProcess]:
+    """Create the completed processes for commands that were run on a batch scheduler or Dask cluster, where
+    the output was written to log files.
+
+    Args:
+        commands (List[list]): commands that were run
+        usages (List[dict]): resource usage for each command
+
+    Returns:
+        List[subprocess.CompletedProcess]: completed processes in the same order as the commands
+    """
+    return [
+        subprocess.CompletedProcess(args=command, returncode=usage["returncode"], stdout=None, stderr=None)
+        for command, usage in zip(commands, usages)
+    ]
+
+
+def scheduler_state(accounting_command: Optional[List[str]], job_id: str) -> str:
+    """Find the final state of a batch job from the accounting records of the batch scheduler (e.g., OUT_OF_MEMORY,
+    TIMEOUT, or NODE_FAIL with SLURM).
+
+    Args:
+        accounting_command (List[str], optional): command that is given a job ID and prints the state of the job on
+        the first line, where None does not look up the state
+        job_id (str): ID of the batch job
+
+    Returns:
+        str: state of the job, or "UNKNOWN" if it is not available
+    """
+    if accounting_command is None:
+        return "UNKNOWN"
+    try:
+        accounting = subprocess.run(accounting_command + [job_id], capture_output=True, text=True)
+    except OSError:
+        return "UNKNOWN"
+    lines = accounting.stdout.strip().splitlines()
+    if accounting.returncode != 0 or not lines or not lines[0].strip():
+        return "UNKNOWN"
+    # states can be followed by more details (e.g., "CANCELLED by 1234")
+    return lines[0].split("|")[0].split()[0]
+
+
+def run_commands_batch(
+    commands: List[list],
+    log_paths: List[pathlib.Path],
+    job_dir: pathlib.Path,
+    submit_command: Optional[List[str]] = None,
+    status_command: Optional[List[str]] = None,
+    accounting_command: Optional[List[str]] = None,
+    cpus_per_task: int = 1,
+    mem_gb: float = 16,
+    time_limit: str = "2-00:00:00",
+    extra_directives: Optional[List[str]] = None,
+    setup_commands: Optional[List[str]] = None,
+    python: str = sys.executable,
+    poll_interval: float = 30.0,
+    progress_monitor: Optional[cp_progress.ProgressMonitor] = None,
+    on_finish: Optional[Callable[[int, dict], None]] = None,
+) -> List[subprocess.CompletedProcess]:
+    """Write a job script for each command, submit the scripts to a batch scheduler, and wait for the jobs to finish.
+    Each job writes its resource usage to a JSON file in the job directory when the command finishes. If a job
+    leaves the queue without writing this file (e.g., it was stopped for going over the time or memory limit, or
+    its node failed), it is returned with a return code of -1, and the state of the job from the accounting records
+    of the batch scheduler is written to its log file so the failure can be classified (see `cp_retry`).
+
+    Args:
+        commands (List[list]): commands to run
+        log_paths (List[pathlib.Path]): path to the log file for each command
+        job_dir (pathlib.Path): directory for the job scripts, scheduler logs, and resource usage files
+        submit_command (List[str], optional): command that submits a job script and prints the job ID
+        (defaults to ["sbatch", "--parsable"])
+        status_command (List[str], optional): command that is given a job ID and prints output only while the
+        job is queued or running (defaults to ["squeue", "--noheader", "--job"]), where None only waits for the
+        resource usage files
+        accounting_command (List[str], optional): command that is given a job ID and prints the state of the job
+        (defaults to ["sacct", "--noheader", "--parsable2", "--allocations", "--format=State", "--jobs"]), where the
+        state is "UNKNOWN" if the command is not available
+        cpus_per_task (int, optional): CPUs for each job (default is 1)
+        mem_gb (float, optional): memory in GB for each job (default is 16)
+        time_limit (str, optional): time limit for each job (default is "2-00:00:00")
+        extra_directives (List[str], optional): other `#SBATCH` lines to add to the job scripts (default is None)
+        setup_commands (List[str], optional): lines to run before the command (e.g., activating the conda
+        environment) (default is None)
+        python (str, optional): Python used to run the job on the compute node (defaults to the current Python)
+        poll_interval (float, optional): seconds between checks of the jobs (default is 30.0)
+        progress_monitor (cp_progress.ProgressMonitor, optional): monitor that follows the log files (default is None)
+        on_finish (Callable[[int, dict], None], optional): function called with the index of each command that finishes
+        and its resource usage (default is None)
+
+    Returns:
+        List[subprocess.CompletedProcess]: completed processes in the same order as the commands
+    """
+    if submit_command is None:
+        submit_command = ["sbatch", "--parsable"]
+    if status_command is None:
+        status_command = ["squeue", "--noheader", "--job"]
+    if accounting_command is None:
+        accounting_command = ["sacct", "--noheader", "--parsable2", "--allocations", "--format=State", "--jobs"]
+
+    job_dir = pathlib.Path(job_dir).resolve()
+    job_dir.mkdir(parents=True, exist_ok=True)
+
+    # write and submit a job script for each command
+    job_ids = {}
+    usage_paths = {}
+    submitted_at = {}
+    for index, (command, log_path) in enumerate(zip(commands, log_paths)):
+        job_name = pathlib.Path(log_path).stem
+        usage_paths[index] = job_dir / f"{job_name}.usage.json"
+        script_path = job_dir / f"{job_name}.sh"
+        # remove files from a previous submission so they are not mistaken for this one
+        for old_path in (usage_paths[index], pathlib.Path(log_path)):
+            if old_path.exists():
+                old_path.unlink()
+
+        script_path.write_text(
+            BATCH_SCRIPT_TEMPLATE.format(
+                job_name=job_name,
+                scheduler_log_path=job_dir / f"{job_name}.scheduler.log",
+                cpus_per_task=cpus_per_task,
+                mem_gb=int(mem_gb),
+                time_limit=time_limit,
+                extra_directives="\n".join(f"#SBATCH {directive}" for directive in extra_directives or []),
+                setup_commands="\n".join(setup_commands or []),
+                python=shlex.quote(python),
+                runner_path=shlex.quote(str(pathlib.Path(cp_job.__file__).resolve())),
+                log_path=shlex.quote(str(pathlib.Path(log_path).resolve())),
+                usage_path=shlex.quote(str(usage_paths[index])),
+                command=" ".join(shlex.quote(str(argument)) for argument in command),
+            )
+        )
+        submission = subprocess.run(
+            submit_command + [str(script_path)], capture_output=True, check=True, text=True
+        )
+        # job IDs can be followed by the cluster name (e.g., "1234;cluster")
+        job_ids[index] = submission.stdout.strip().split(";")[0]
+        submitted_at[index] = time.time()
+        if progress_monitor is not None:
+            progress_monitor.start(index)
+        print(f"Submitted job {job_ids[index]} for {job_name}")
+
+    usages: List[Optional[dict]] = [None] * len(commands)
+    while any(usage is None for usage in usages):
+        for index in [index for index, usage in enumerate(usages) if usage is None]:
+            if usage_paths[index].exists():
+                with open(usage_paths[index], "r") as usage_file:
+                    usages[index] = json.load(usage_file)
+            elif status_command is not None:
+                status = subprocess.run(
+                    status_command + [job_ids[index]], capture_output=True, text=True
+                )
+                # a job that is not in the queue anymore may still be writing its usage file, so check it again
+                if not status.stdout.strip() and not usage_paths[index].exists():
+                    state = scheduler_state(accounting_command, job_ids[index])
+                    usages[index] = {
+                        "returncode": -1,
+                        "started_at": submitted_at[index],
+                        "wall_seconds": time.time() - submitted_at[index],
+                        "scheduler_state": state,
+                    }
+                    message = f"Job {job_ids[index]} {cp_retry.LOST_JOB_MESSAGE} (scheduler state: {state})"
+                    with open(log_paths[index], "a") as log_file:
+                        log_file.write(message + "\n")
+                    print(message)
+            if usages[index] is not None:
+                if progress_monitor is not None:
+                    progress_monitor.finish(index, usages[index]["returncode"])
+                if on_finish is not None:
+                    on_finish(index, usages[index])
+
+        if progress_monitor is not None:
+            progress_monitor.update()
+        if any(usage is None for usage in usages):
+            time.sleep(poll_interval)
+
+    return completed_processes(commands=commands, usages=usages)
+
+
+def run_commands_dask(
+    commands: List[list],
+    log_paths: List[pathlib.Path],
+    scheduler_address: Optional[str] = None,
+    n_workers: Optional[int] = None,
+    resources: Optional[dict] = None,
+    progress_monitor: Optional[cp_progress.ProgressMonitor] = None,
+    on_finish: Optional[Callable[[int, dict], None]] = None,
+) -> List[subprocess.CompletedProcess]:
+    """Run each command as a task on a Dask cluster and wait for the tasks to finish. When no scheduler address
+    is given, a LocalCluster with one thread per worker is started on this machine.
+
+    Args:
+        commands (List[list]): commands to run
+        log_paths (List[pathlib.Path]): path to the log file for each command (must be on a shared file system)
+        scheduler_address (str, optional): address of the Dask scheduler (e.g., "tcp://10.0.0.1:8786") (default is None)
+        n_workers (int, optional): number of workers for the LocalCluster (default is None)
+        resources (dict, optional): worker resources each task needs (e.g., {"MEMORY": 16e9}) (default is None)
+        progress_monitor (cp_progress.ProgressMonitor, optional): monitor that follows the log files (default is None)
+        on_finish (Callable[[int, dict], None], optional): function called with the index of each command that finishes
+        and its resource usage (default is None)
+
+    Returns:
+        List[subprocess.CompletedProcess]: completed processes in the same order as the commands
+    """
+    # dask is only needed when using this executor
+    from distributed import Client, LocalCluster, as_completed
+
+    if scheduler_address is None:
+        cluster = LocalCluster(n_workers=n_workers, threads_per_worker=1, processes=True)
+        client = Client(cluster)
+    else:
+        cluster = None
+        client = Client(scheduler_address)
+        # send the modules used by each task to the workers on the remote cluster, where `cp_job` is uploaded last
+        # since it imports `cp_ledger`
+        for module_path in (cp_ledger.__file__, cp_job.__file__):
+            client.upload_file(str(pathlib.Path(module_path).resolve()))
+
+    try:
+        futures = []
+        future_indices = {}
+        for index, (command, log_path) in enumerate(zip(commands, log_paths)):
+            if pathlib.Path(log_path).exists():
+                pathlib.Path(log_path).unlink()
+            future = client.submit(
+                cp_job.run_job,
+                command,
+                str(pathlib.Path(log_path).resolve()),
+                # each command is run once (tasks with the same arguments are not combined)
+                pure=False,
+                resources=resources,
+            )
+            futures.append(future)
+            future_indices[future.key] = index
+            if progress_monitor is not None:
+                progress_monitor.start(index)
+
+        usages: List[Optional[dict]] = [None] * len(commands)
+        for future in as_completed(futures):
+            index = future_indices[future.key]
+            usages[index] = future.result()
+            if progress_monitor is not None:
+                progress_monitor.update()
+                progress_monitor.finish(index, usages[index]["returncode"])
+            if on_finish is not None:
+                on_finish(index, usages[index])
+    finally:
+        client.close()
+        if cluster is not None:
+            cluster.close()
+
+    return completed_processes(commands=commands, usages=usages)
+
+
+def run_commands(
+    commands: List[list],
+    log_paths: List[pathlib.Path],
+    executor: str = "local",
+    executor_options: Optional[dict] = None,
+    progress_monitor: Optional[cp_progress.ProgressMonitor] = None,
+    on_finish: Optional[Callable[[int, dict], None]] = None,
+) -> List[subprocess.CompletedProcess]:
+    """Run CellProfiler commands on an executor backend.
+
+    Args:
+        commands (List[list]): commands to run
+        log_paths (List[pathlib.Path]): path to the log file for each command
+        executor (str, optional): name of the backend, which is "local" (queue on this machine with CPU and memory
+        budgets), "batch" (job scripts submitted to a batch scheduler), or "dask" (tasks on a Dask cluster)
+        (default is "local")
+        executor_options (dict, optional): options for the backend (see `cp_scheduler.run_commands_with_budget`,
+        `run_commands_batch`, and `run_commands_dask`) (default is None)
+        progress_monitor (cp_progress.ProgressMonitor, optional): monitor that follows the log files (default is None)
+        on_finish (Callable[[int, dict], None], optional): function called with the index of each command that finishes
+        and its resource usage (default is None)
+
+    Raises:
+        ValueError: if the executor is not one of the backends
+
+    Returns:
+        List[subprocess.CompletedProcess]: completed processes in the same order as the commands
+    """
+    executor_options = executor_options or {}
+    if executor == "local":
+        return cp_scheduler.run_commands_with_budget(
+            commands=commands,
+            log_paths=log_paths,
+            progress_monitor=progress_monitor,
+            on_finish=on_finish,
+            **executor_options,
+        )
+    if executor == "batch":
+        return run_commands_batch(
+            commands=commands,
+            log_paths=log_paths,
+            progress_monitor=progress_monitor,
+            on_finish=on_finish,
+            **executor_options,
+        )
+    if executor == "dask":
+        return run_commands_dask(
+            commands=commands,
+            log_paths=log_paths,
+            progress_monitor=progress_monitor,
+            on_finish=on_finish,
+            **executor_options,
+        )
+    raise ValueError(f"The executor '{executor}' is not one of the available executors: {EXECUTORS}")
+
@@ -0,0 +1,177 @@
+"""
+This collection of functions creates a fused illumination correction and analysis pipeline for a plate, which loads
+the raw images, applies the illumination functions (from the illumination function cache when they are cached, see
+`cp_illum_cache`), and segments and measures the corrected images in the same CellProfiler run. The corrected images
+are kept in memory, so they are only written to disk when they are exported.
+
+The fused pipeline is made from the input modules of the analysis pipeline (with the channels named like in the
+illumination correction pipeline), the modules of the illumination correction pipeline where CorrectIlluminationApply
+outputs the images with the names used in the analysis pipeline, and the rest of the analysis pipeline.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Dict, List, Optional
+import pathlib
+import re
+
+import cp_illum_cache
+import cp_loaddata
+
+# modules of the illumination correction pipeline that are not used in the fused pipeline, where the QC measurements
+# are already saved by the whole image QC pipeline
+DROPPED_ILLUM_MODULES = ("ExportToSpreadsheet",)
+
+# prefix of the corrected image folders that the analysis pipelines extract the plate from, which is removed from the
+# folder name regular expression so the plate is extracted from the raw image folders
+CORRECTED_FOLDER_PREFIX = "Corrected_"
+
+
+def set_setting(module_lines: List[str], name: str, values: Dict[str, str]) -> List[str]:
+    """Change the values of a setting in a module, where each value in `values` is replaced by its new value.
+
+    Args:
+        module_lines (List[str]): lines for one module from the .cppipe file
+        name (str): name of the setting (e.g., "Name to assign these images")
+        values (Dict[str, str]): new value for each value to replace
+
+    Returns:
+        List[str]: lines for the module with the new values
+    """
+    new_lines = [module_lines[0]]
+    for line in module_lines[1:]:
+        setting_name, _, value = line.strip().partition(":")
+        if setting_name == name and value in values:
+            line = line[: len(line) - len(value)] + values[value]
+        new_lines.append(line)
+    return new_lines
+
+
+def create_fused_pipeline(
+    path_to_pipeline: pathlib.Path,
+    path_to_illum_pipeline: pathlib.Path,
+    path_to_fused_pipeline: pathlib.Path,
+    path_to_corrected_images: Optional[pathlib.Path] = None,
+) -> None:
+    """Create the fused illumination correction and analysis pipeline.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file for analysis
+        path_to_illum_pipeline (pathlib.Path): path to the CellProfiler .cppipe file for illumination correction
+        path_to_fused_pipeline (pathlib.Path): path to save the fused pipeline
+        path_to_corrected_images (pathlib.Path, optional): folder to export the corrected images to, where the
+        corrected images are not saved if not given (default is None)
+
+    Raises:
+        ValueError: if a channel in the analysis pipeline is not in the illumination correction pipeline
+    """
+    header, modules = cp_loaddata.read_pipeline_modules(path_to_pipeline)
+    _, illum_modules = cp_loaddata.read_pipeline_modules(path_to_illum_pipeline)
+
+    # channels are matched between the pipelines by the text in the file name (e.g., DAPI is OrigDAPI in the
+    # illumination correction pipeline and DAPI in the analysis pipeline)
+    channels, _ = cp_loaddata.parse_input_modules(path_to_pipeline)
+    illum_channels = dict(cp_loaddata.parse_input_modules(path_to_illum_pipeline)[0])
+    missing = [file_text for file_text, _ in channels if file_text not in illum_channels]
+    if missing:
+        raise ValueError(
+            f"The channels {missing} in {pathlib.Path(path_to_pipeline).name} are not in {pathlib.Path(path_to_illum_pipeline).name}."
+        )
+    input_names = {image_name: illum_channels[file_text] for file_text, image_name in channels}
+    analysis_names = {input_name: image_name for image_name, input_name in input_names.items()}
+
+    fused_modules = []
+    for module_lines in modules:
+        module_name = module_lines[0].split(":")[0]
+        if module_name == "NamesAndTypes":
+            module_lines = set_setting(module_lines, "Name to assign these images", input_names)
+        if module_name == "Metadata":
+            module_lines = [
+                line.replace(f"{CORRECTED_FOLDER_PREFIX}(", "(")
+                if line.strip().startswith("Regular expression to extract from folder name:")
+                else line
+                for line in module_lines
+            ]
+        if module_name in cp_loaddata.INPUT_MODULES:
+            fused_modules.append(module_lines)
+
+    # the corrected images are given the names of the channels in the analysis pipeline
+    corrected_names = {}
+    for module_lines in illum_modules:
+        module_name = module_lines[0].split(":")[0]
+        if module_name in cp_loaddata.INPUT_MODULES + DROPPED_ILLUM_MODULES:
+            continue
+        settings = cp_loaddata.module_settings(module_lines)
+        if module_name == "CorrectIlluminationApply":
+            for (name, value), (next_name, next_value) in zip(settings, settings[1:]):
+                if name == "Select the input image" and next_name == "Name the output image":
+                    corrected_names[next_value] = analysis_names.get(value, next_value)
+            module_lines = set_setting(module_lines, "Name the output image", corrected_names)
+        if module_name == "SaveImages" and dict(settings)["Select the image to save"] in corrected_names:
+            if path_to_corrected_images is None:
+                continue
+            module_lines = set_setting(module_lines, "Select the image to save", corrected_names)
+            export_location = f"Elsewhere...|{pathlib.Path(path_to_corrected_images).resolve()}"
+            module_lines = [
+                f"    Output file location:{export_location}"
+                if line.strip().startswith("Output file location:")
+                else line
+                for line in module_lines
+            ]
+        fused_modules.append(module_lines)
+
+    fused_modules += [
+        module_lines for module_lines in modules if module_lines[0].split(":")[0] not in cp_loaddata.INPUT_MODULES
+    ]
+
+    # renumber the modules since modules were added from the illumination correction pipeline
+    for module_num, module_lines in enumerate(fused_modules, start=1):
+        module_lines[0] = re.sub(r"module_num:\d+", f"module_num:{module_num}", module_lines[0])
+    header = [f"ModuleCount:{len(fused_modules)}" if line.startswith("ModuleCount:") else line for line in header]
+
+    blocks = ["\n".join(header)] + ["\n".join(module_lines) for module_lines in fused_modules]
+    pathlib.Path(path_to_fused_pipeline).parent.mkdir(parents=True, exist_ok=True)
+    pathlib.Path(path_to_fused_pipeline).write_text("\n\n".join(blocks) + "\n")
+
+
+def prepare_fused_pipeline(
+    path_to_pipeline: pathlib.Path,
+    path_to_illum_pipeline: pathlib.Path,
+    path_to_images: pathlib.Path,
+    cache_dir: pathlib.Path,
+    path_to_corrected_images: Optional[pathlib.Path] = None,
+) -> dict:
+    """Create the fused illumination correction and analysis pipeline for a plate, which uses the illumination
+    functions in the cache and saves the illumination functions that are not cached yet.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file for analysis
+        path_to_illum_pipeline (pathlib.Path): path to the CellProfiler .cppipe file for illumination correction
+        path_to_images (pathlib.Path): path to the directory with raw images for a plate
+        cache_dir (pathlib.Path): directory for the illumination function cache
+        path_to_corrected_images (pathlib.Path, optional): folder to export the corrected images to, where the
+        corrected images are not saved if not given (default is None)
+
+    Returns:
+        dict: path to the fused pipeline ("path_to_pipeline"), which has the same file name as the analysis pipeline,
+        and the input image name and cache folder for each illumination function that is loaded from the cache
+        ("illum_functions")
+    """
+    illum_cache = cp_illum_cache.prepare_illum_cache(
+        path_to_pipeline=path_to_illum_pipeline, path_to_images=path_to_images, cache_dir=cache_dir
+    )
+    path_to_fused_pipeline = (
+        pathlib.Path(cache_dir).resolve()
+        / "fused_pipelines"
+        / pathlib.Path(path_to_images).name
+        / pathlib.Path(path_to_pipeline).name
+    )
+    create_fused_pipeline(
+        path_to_pipeline=path_to_pipeline,
+        path_to_illum_pipeline=illum_cache["path_to_pipeline"],
+        path_to_fused_pipeline=path_to_fused_pipeline,
+        path_to_corrected_images=path_to_corrected_images,
+    )
+
+    return {"path_to_pipeline": path_to_fused_pipeline, "illum_functions": illum_cache["illum_functions"]}
@@ -0,0 +1,323 @@
+"""
+This collection of functions keeps a cache of the illumination functions made by the CorrectIlluminationCalculate
+modules in the illumination correction pipelines, so a rerun (e.g., to save corrected images with different settings)
+only runs the correction and does not calculate the illumination functions again.
+
+Each CorrectIlluminationCalculate module (one per channel) has a cache folder for a plate that is named by a key made
+from the SHA256 checksums of the plate images for that channel (from the image catalog) and the settings of the modules
+that decide which illumination functions are made (MeasureImageQuality, FlagImage, and CorrectIlluminationCalculate).
+While the folder is not complete, a SaveImages module is added after the CorrectIlluminationCalculate module to save
+the illumination function of every image set as a .npy file. Once all image sets for the plate are completed, the
+folder is marked as complete, and from then on the CorrectIlluminationCalculate module is removed from the pipeline and
+the illumination functions are loaded from the LoadData CSV instead. Image sets that are flagged by the FlagImage module
+do not have an illumination function, so a folder is only marked as complete when it has an illumination function for
+every image set that was not flagged, and the flagged image sets are left out of the LoadData CSV.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import List, Optional
+import hashlib
+import json
+import pathlib
+import re
+import sqlite3
+
+import pandas as pd
+
+import cp_loaddata
+import image_catalog
+
+# modules before a CorrectIlluminationCalculate module whose settings change which illumination functions are made
+# (image sets flagged by FlagImage are skipped and do not have an illumination function)
+CACHE_KEY_MODULES = ("MeasureImageQuality", "FlagImage")
+
+# measurement of the FlagImage module in the illumination correction pipelines, which is 1 for image sets that are
+# skipped by the rest of the pipeline (named Image_Image_Quality_Control_QC_Flag in the Per_Image table)
+QC_FLAG_MEASUREMENT = "Image_Quality_Control_QC_Flag"
+
+# file in a cache folder that marks that the illumination functions for every image set have been saved
+COMPLETE_NAME = "cache_complete.json"
+
+# SaveImages module that saves the illumination function of each image set as a .npy file named after the image
+# it was calculated from (e.g., B2_01_1_1_DAPI_001_illum.npy)
+SAVE_ILLUM_MODULE = """SaveImages:[module_num:1|svn_version:'Unknown'|variable_revision_number:16|show_window:False|notes:['Save the illumination function to the illumination function cache made by utils/cp_illum_cache.py.']|batch_state:array([], dtype=uint8)|enabled:True|wants_pause:False]
+    Select the type of image to save:Image
+    Select the image to save:{illum_name}
+    Select method for constructing file names:From image filename
+    Select image name for file prefix:{image_name}
+    Enter single file name:{illum_name}
+    Number of digits:4
+    Append a suffix to the image file name?:Yes
+    Text to append to the image name:{suffix}
+    Saved file format:npy
+    Output file location:Elsewhere...|{cache_folder}
+    Image bit depth:32-bit floating point
+    Overwrite existing files without warning?:Yes
+    When to save:Every cycle
+    Record the file and path information to the saved image?:No
+    Create subfolders in the output folder?:No
+    Base image folder:Elsewhere...|
+    How to save the series:T (Time)
+    Save with lossless compression?:No
+"""
+
+
+def channel_content_hash(path_to_images: pathlib.Path, file_text: str) -> str:
+    """Find a hash of the contents of every image in a channel for a plate from the checksums in the image catalog.
+    The image catalog must be up to date (see `image_catalog.update_catalog`).
+
+    Args:
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        file_text (str): text in the file name that identifies the channel (e.g., "DAPI")
+
+    Raises:
+        ValueError: if the image catalog does not have any images for the channel
+
+    Returns:
+        str: hex digest of the path and checksum of each image in the channel
+    """
+    path_to_images = pathlib.Path(path_to_images).resolve()
+    catalog = image_catalog.load_catalog(path_to_images.parent)
+    catalog = catalog[catalog["plate_directory"] == path_to_images.name]
+    images = sorted(
+        (path, sha256)
+        for path, sha256 in catalog[["path", "sha256"]].itertuples(index=False)
+        if file_text in pathlib.Path(path).name
+    )
+    if not images:
+        raise ValueError(f"The image catalog does not have any {file_text} images for {path_to_images.name}.")
+
+    content_hash = hashlib.sha256()
+    for path, sha256 in images:
+        content_hash.update(f"{path}:{sha256}\n".encode())
+    return content_hash.hexdigest()
+
+
+def plan_illum_cache(
+    path_to_pipeline: pathlib.Path, path_to_images: pathlib.Path, cache_dir: pathlib.Path
+) -> List[dict]:
+    """Find the cache folder for the illumination function of each CorrectIlluminationCalculate module in a pipeline
+    and if all of its illumination functions have been saved.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        cache_dir (pathlib.Path): directory for the illumination function cache
+
+    Returns:
+        List[dict]: module number ("module_num"), input image name ("image_name"), illumination function name
+        ("illum_name"), cache folder ("cache_folder"), and if the folder is complete ("cached") for each module
+    """
+    channels, _ = cp_loaddata.parse_input_modules(path_to_pipeline)
+    file_texts = {image_name: file_text for file_text, image_name in channels}
+    _, modules = cp_loaddata.read_pipeline_modules(path_to_pipeline)
+
+    plans = []
+    key_settings = []
+    for module_num, module_lines in enumerate(modules, start=1):
+        module_name = module_lines[0].split(":")[0]
+        enabled = "enabled:True" in module_lines[0]
+        settings = cp_loaddata.module_settings(module_lines)
+        if module_name in CACHE_KEY_MODULES:
+            key_settings.append([module_name, enabled, settings])
+        if module_name != "CorrectIlluminationCalculate" or not enabled:
+            continue
+
+        image_name = dict(settings)["Select the input image"]
+        illum_name = dict(settings)["Name the output image"]
+        key = hashlib.sha256(
+            json.dumps(
+                {
+                    "content_sha256": channel_content_hash(path_to_images, file_texts[image_name]),
+                    "modules": key_settings + [[module_name, enabled, settings]],
+                }
+            ).encode()
+        ).hexdigest()
+        cache_folder = pathlib.Path(cache_dir).resolve() / pathlib.Path(path_to_images).name / illum_name / key
+        plans.append(
+            {
+                "module_num": module_num,
+                "image_name": image_name,
+                "illum_name": illum_name,
+                "cache_folder": cache_folder,
+                "cached": (cache_folder / COMPLETE_NAME).exists(),
+            }
+        )
+
+    return plans
+
+
+def create_cached_pipeline(
+    path_to_pipeline: pathlib.Path, path_to_cached_pipeline: pathlib.Path, plans: List[dict]
+) -> None:
+    """Create a copy of a pipeline that uses the illumination function cache, where CorrectIlluminationCalculate
+    modules with a complete cache folder are removed and all others are followed by a SaveImages module that saves
+    the illumination functions to their cache folder.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_cached_pipeline (pathlib.Path): path to save the pipeline that uses the cache
+        plans (List[dict]): cache folder for each CorrectIlluminationCalculate module (see `plan_illum_cache`)
+    """
+    header, modules = cp_loaddata.read_pipeline_modules(path_to_pipeline)
+    plans_by_module = {plan["module_num"]: plan for plan in plans}
+
+    cached_modules = []
+    for module_num, module_lines in enumerate(modules, start=1):
+        plan = plans_by_module.get(module_num)
+        if plan is not None and plan["cached"]:
+            continue
+        cached_modules.append(module_lines)
+        if plan is not None:
+            save_module = SAVE_ILLUM_MODULE.format(
+                illum_name=plan["illum_name"],
+                image_name=plan["image_name"],
+                suffix=cp_loaddata.ILLUM_FUNCTION_SUFFIX,
+                cache_folder=plan["cache_folder"],
+            )
+            cached_modules.append(save_module.strip("\n").split("\n"))
+
+    # renumber the modules since modules were added or removed
+    for module_num, module_lines in enumerate(cached_modules, start=1):
+        module_lines[0] = re.sub(r"module_num:\d+", f"module_num:{module_num}", module_lines[0])
+    header = [f"ModuleCount:{len(cached_modules)}" if line.startswith("ModuleCount:") else line for line in header]
+
+    blocks = ["\n".join(header)] + ["\n".join(module_lines) for module_lines in cached_modules]
+    pathlib.Path(path_to_cached_pipeline).parent.mkdir(parents=True, exist_ok=True)
+    pathlib.Path(path_to_cached_pipeline).write_text("\n\n".join(blocks) + "\n")
+
+
+def prepare_illum_cache(
+    path_to_pipeline: pathlib.Path, path_to_images: pathlib.Path, cache_dir: pathlib.Path
+) -> dict:
+    """Create the pipeline for a plate that uses the illumination function cache.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        cache_dir (pathlib.Path): directory for the illumination function cache
+
+    Returns:
+        dict: path to the pipeline that uses the cache ("path_to_pipeline"), which has the same file name as the
+        pipeline, and the input image name and cache folder for each illumination function that is loaded from the
+        cache ("illum_functions")
+    """
+    plans = plan_illum_cache(path_to_pipeline=path_to_pipeline, path_to_images=path_to_images, cache_dir=cache_dir)
+    path_to_cached_pipeline = (
+        pathlib.Path(cache_dir).resolve()
+        / "pipelines"
+        / pathlib.Path(path_to_images).name
+        / pathlib.Path(path_to_pipeline).name
+    )
+    create_cached_pipeline(
+        path_to_pipeline=path_to_pipeline, path_to_cached_pipeline=path_to_cached_pipeline, plans=plans
+    )
+
+    cached = [plan["illum_name"] for plan in plans if plan["cached"]]
+    print(
+        f"{pathlib.Path(path_to_images).name}: loading {len(cached)} of {len(plans)} illumination functions from "
+        f"the cache {cached}"
+    )
+
+    return {
+        "path_to_pipeline": path_to_cached_pipeline,
+        "illum_functions": {
+            plan["illum_name"]: (plan["image_name"], plan["cache_folder"]) for plan in plans if plan["cached"]
+        },
+    }
+
+
+def count_unflagged_image_sets(path_to_output: pathlib.Path) -> Optional[int]:
+    """Count the image sets of a plate that were not flagged by the FlagImage module from the image measurements in
+    the outputs of the plate, which are in the Image CSV from ExportToSpreadsheet (illumination correction pipelines)
+    or the Per_Image table of the SQLite file from ExportToDatabase (fused analysis pipelines).
+
+    Args:
+        path_to_output (pathlib.Path): path to the output directory for the plate
+
+    Returns:
+        Optional[int]: number of image sets with a QC flag of 0, or None if the outputs do not have the QC flag
+    """
+    path_to_output = pathlib.Path(path_to_output)
+    for csv_path in sorted(path_to_output.glob("*Image.csv")):
+        if QC_FLAG_MEASUREMENT in pd.read_csv(csv_path, nrows=0).columns:
+            flags = pd.read_csv(csv_path, usecols=[QC_FLAG_MEASUREMENT])[QC_FLAG_MEASUREMENT]
+            return int((flags == 0).sum())
+
+    for sqlite_path in sorted(path_to_output.glob("*.sqlite")):
+        connection = sqlite3.connect(sqlite_path)
+        try:
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(Per_Image)")]
+            if f"Image_{QC_FLAG_MEASUREMENT}" in columns:
+                return connection.execute(
+                    f'SELECT COUNT(*) FROM Per_Image WHERE "Image_{QC_FLAG_MEASUREMENT}" = 0'
+                ).fetchone()[0]
+        finally:
+            connection.close()
+
+    return None
+
+
+def record_illum_cache(
+    path_to_pipeline: pathlib.Path,
+    path_to_images: pathlib.Path,
+    cache_dir: pathlib.Path,
+    path_to_output: pathlib.Path,
+) -> List[pathlib.Path]:
+    """Mark the cache folders of a plate as complete, which must only be done once all image sets for the plate
+    have been completed with the pipeline that uses the cache. A folder is not marked as complete when it has fewer
+    illumination functions than the image sets that were not flagged (see `count_unflagged_image_sets`).
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        cache_dir (pathlib.Path): directory for the illumination function cache
+        path_to_output (pathlib.Path): path to the output directory for the plate with the image measurements
+
+    Returns:
+        List[pathlib.Path]: cache folders that were marked as complete
+    """
+    plans = [
+        plan
+        for plan in plan_illum_cache(
+            path_to_pipeline=path_to_pipeline, path_to_images=path_to_images, cache_dir=cache_dir
+        )
+        if not plan["cached"]
+    ]
+    if not plans:
+        return []
+    num_unflagged = count_unflagged_image_sets(path_to_output)
+    if num_unflagged is None:
+        print(
+            f"{pathlib.Path(path_to_images).name}: the illumination function cache is not marked as complete, since "
+            f"the outputs in {pathlib.Path(path_to_output).name} do not have the {QC_FLAG_MEASUREMENT} measurement"
+        )
+        return []
+
+    recorded = []
+    for plan in plans:
+        plan["cache_folder"].mkdir(parents=True, exist_ok=True)
+        num_illum_functions = len(list(plan["cache_folder"].glob("*.npy")))
+        if num_illum_functions < num_unflagged:
+            print(
+                f"{pathlib.Path(path_to_images).name}: the cache for {plan['illum_name']} is not marked as complete, "
+                f"since it has {num_illum_functions} illumination functions for {num_unflagged} image sets that "
+                "were not flagged"
+            )
+            continue
+        with open(plan["cache_folder"] / COMPLETE_NAME, "w") as complete_file:
+            json.dump(
+                {
+                    "pipeline": pathlib.Path(path_to_pipeline).name,
+                    "image_name": plan["image_name"],
+                    "num_illum_functions": num_illum_functions,
+                    "num_unflagged_image_sets": num_unflagged,
+                },
+                complete_file,
+                indent=4,
+            )
+        recorded.append(plan["cache_folder"])
+
+    return recorded
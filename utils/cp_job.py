@@ -0,0 +1,60 @@
+"""
+This function runs one CellProfiler command on a compute node and writes its output and resource usage, which is what
+each batch job and Dask task of `cp_executors` runs. It only imports the standard library and `cp_ledger`, so these
+two files are all that a node needs (they are sent to the workers of a remote Dask cluster with `upload_file`).
+
+Jobs on a batch scheduler run this file as a script, so it must be on a file system that is shared with the compute
+nodes.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Optional
+import argparse
+import json
+import pathlib
+import subprocess
+import sys
+
+import cp_ledger
+
+
+def run_job(command: list, log_path: pathlib.Path, usage_path: Optional[pathlib.Path] = None) -> dict:
+    """Run a CellProfiler command with the output written to a log file and find the resources it used. This is
+    what each batch job and Dask task runs on the compute node.
+
+    Args:
+        command (list): CellProfiler command to run
+        log_path (pathlib.Path): path to the log file for the CellProfiler output
+        usage_path (pathlib.Path, optional): path to a JSON file to write the resource usage to (default is None)
+
+    Returns:
+        dict: resource usage of the process (see `cp_ledger.usage_from_rusage`)
+    """
+    with open(log_path, "wb") as log_file:
+        usage = cp_ledger.run_with_usage(
+            command, stdout=log_file, stderr=subprocess.STDOUT
+        )
+
+    if usage_path is not None:
+        # write to a temporary file first so the usage file only exists once it is complete
+        temporary_path = pathlib.Path(f"{usage_path}.tmp")
+        with open(temporary_path, "w") as usage_file:
+            json.dump(usage, usage_file)
+        temporary_path.replace(usage_path)
+
+    return usage
+
+
+if __name__ == "__main__":
+    # run one CellProfiler command within a batch job
+    parser = argparse.ArgumentParser(
+        description="Run a CellProfiler command and write its output and resource usage."
+    )
+    parser.add_argument("--log-path", type=pathlib.Path, required=True)
+    parser.add_argument("--usage-path", type=pathlib.Path, required=True)
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    sys.exit(run_job(command, args.log_path, args.usage_path)["returncode"])
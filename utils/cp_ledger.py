@@ -0,0 +1,294 @@
+"""
+This collection of functions records the resources used by each CellProfiler process (wall time, CPU time, peak memory,
+I/O, and number of image sets) to a SQLite run ledger, and reports on the runs to compare them over time.
+
+To compare runs recorded in a ledger, run this file as a script:
+
+    python utils/cp_ledger.py 2.cellprofiler_analysis/logs/cellprofiler_run_ledger.sqlite
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Optional
+import argparse
+import datetime
+import os
+import pathlib
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+# name of the ledger file that is saved in the logs directory for each module
+LEDGER_NAME = "cellprofiler_run_ledger.sqlite"
+
+# size of the blocks counted as input and output by getrusage
+RUSAGE_BLOCK_BYTES = 512
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cellprofiler_runs (
+    run_id TEXT,
+    run_name TEXT,
+    unit_name TEXT,
+    pipeline_name TEXT,
+    pipeline_sha256 TEXT,
+    command TEXT,
+    hostname TEXT,
+    started_at TEXT,
+    wall_seconds REAL,
+    cpu_seconds REAL,
+    peak_rss_bytes INTEGER,
+    read_bytes INTEGER,
+    write_bytes INTEGER,
+    num_image_sets INTEGER,
+    returncode INTEGER
+)
+"""
+
+
+def create_run_id() -> str:
+    """Create an ID for one call of a CellProfiler run to group the processes that were run together.
+
+    Returns:
+        str: ID with the start time and process ID (e.g., 20240101T120000_1234)
+    """
+    return f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}_{os.getpid()}"
+
+
+def exit_code_from_status(status: int) -> int:
+    """Convert a wait status into a return code the same way as subprocess (negative signal number if killed).
+
+    Args:
+        status (int): wait status from os.wait4
+
+    Returns:
+        int: return code of the process
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def poll_with_rusage(popen: subprocess.Popen, block: bool = False) -> Optional[object]:
+    """Check if a process has finished and collect its resource usage, which includes the child processes that
+    it waited on. The return code is set on the Popen object like `Popen.poll` does.
+
+    Args:
+        popen (subprocess.Popen): process to check
+        block (bool, optional): wait for the process to finish (default is False)
+
+    Returns:
+        Optional[resource.struct_rusage]: resource usage of the finished process, or None if it is still running
+    """
+    if popen.returncode is not None:
+        return None
+    pid, status, rusage = os.wait4(popen.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    popen.returncode = exit_code_from_status(status)
+    return rusage
+
+
+def usage_from_rusage(
+    rusage: object,
+    returncode: int,
+    started_at: float,
+    wall_seconds: float,
+    peak_rss_bytes: Optional[int] = None,
+) -> dict:
+    """Create the resource usage of a finished process that is recorded in the run ledger.
+
+    Args:
+        rusage (resource.struct_rusage): resource usage from os.wait4
+        returncode (int): return code of the process
+        started_at (float): time the process started (seconds since the epoch)
+        wall_seconds (float): seconds the process ran for
+        peak_rss_bytes (int, optional): peak RSS of the process and its children if measured while it ran, otherwise
+        the peak RSS of the largest process from the resource usage is used (default is None)
+
+    Returns:
+        dict: resource usage with the return code, hostname, start time, wall seconds, CPU seconds, peak RSS, and I/O bytes
+    """
+    # peak RSS is reported in kilobytes on Linux and bytes on macOS
+    maxrss_scale = 1 if sys.platform == "darwin" else 1024
+    return {
+        "returncode": returncode,
+        "hostname": socket.gethostname(),
+        "started_at": started_at,
+        "wall_seconds": wall_seconds,
+        "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+        "peak_rss_bytes": max(peak_rss_bytes or 0, rusage.ru_maxrss * maxrss_scale),
+        "read_bytes": rusage.ru_inblock * RUSAGE_BLOCK_BYTES,
+        "write_bytes": rusage.ru_oublock * RUSAGE_BLOCK_BYTES,
+    }
+
+
+def run_with_usage(command: list, **popen_kwargs) -> dict:
+    """Run a command until it finishes (like subprocess.run) and find the resources that it used.
+
+    Args:
+        command (list): command to run
+        **popen_kwargs: arguments passed to subprocess.Popen (e.g., stdout and stderr)
+
+    Returns:
+        dict: resource usage of the process (see `usage_from_rusage`)
+    """
+    started_at = time.time()
+    popen = subprocess.Popen([str(argument) for argument in command], **popen_kwargs)
+    rusage = poll_with_rusage(popen, block=True)
+    return usage_from_rusage(
+        rusage=rusage,
+        returncode=popen.returncode,
+        started_at=started_at,
+        wall_seconds=time.time() - started_at,
+    )
+
+
+def record_run(
+    ledger_path: pathlib.Path,
+    run_id: str,
+    run_name: str,
+    unit_name: str,
+    command: list,
+    usage: dict,
+    num_image_sets: int,
+    pipeline_sha256: str,
+) -> None:
+    """Append a CellProfiler process to the run ledger.
+
+    Args:
+        ledger_path (pathlib.Path): path to the SQLite run ledger (created if it does not exist)
+        run_id (str): ID for the call of the CellProfiler run that the process was part of
+        run_name (str): a given name for the type of CellProfiler run (example: analysis)
+        unit_name (str): name of the plate or shard
+        command (list): CellProfiler command that was run
+        usage (dict): resource usage of the finished process (see `usage_from_rusage`)
+        num_image_sets (int): number of image sets the process was given
+        pipeline_sha256 (str): hash of the pipeline file that was run
+    """
+    path_to_pipeline = pathlib.Path(command[command.index("-p") + 1])
+
+    pathlib.Path(ledger_path).parent.mkdir(parents=True, exist_ok=True)
+    with sqlite3.connect(ledger_path) as connection:
+        connection.execute(LEDGER_SCHEMA)
+        connection.execute(
+            "INSERT INTO cellprofiler_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                run_id,
+                run_name,
+                unit_name,
+                path_to_pipeline.name,
+                pipeline_sha256,
+                " ".join(str(argument) for argument in command),
+                usage.get("hostname", socket.gethostname()),
+                datetime.datetime.fromtimestamp(usage["started_at"]).isoformat(timespec="seconds"),
+                round(usage["wall_seconds"], 2),
+                # resource usage is not available if a process was stopped by a batch scheduler
+                None if usage.get("cpu_seconds") is None else round(usage["cpu_seconds"], 2),
+                usage.get("peak_rss_bytes"),
+                usage.get("read_bytes"),
+                usage.get("write_bytes"),
+                num_image_sets,
+                usage["returncode"],
+            ),
+        )
+
+
+def run_and_record(
+    command: list,
+    ledger_path: pathlib.Path,
+    run_name: str,
+    unit_name: str,
+    num_image_sets: int,
+    pipeline_sha256: str,
+    **popen_kwargs,
+) -> subprocess.CompletedProcess:
+    """Run a command until it finishes (like subprocess.run) and append its resource usage to the run ledger.
+
+    Args:
+        command (list): CellProfiler command to run
+        ledger_path (pathlib.Path): path to the SQLite run ledger
+        run_name (str): a given name for the type of CellProfiler run (example: analysis)
+        unit_name (str): name of the plate or shard
+        num_image_sets (int): number of image sets the process is given
+        pipeline_sha256 (str): hash of the pipeline file that is run
+        **popen_kwargs: arguments passed to subprocess.Popen (e.g., stdout and stderr)
+
+    Returns:
+        subprocess.CompletedProcess: completed process with the return code
+    """
+    usage = run_with_usage(command, **popen_kwargs)
+    record_run(
+        ledger_path=ledger_path,
+        run_id=create_run_id(),
+        run_name=run_name,
+        unit_name=unit_name,
+        command=command,
+        usage=usage,
+        num_image_sets=num_image_sets,
+        pipeline_sha256=pipeline_sha256,
+    )
+    return subprocess.CompletedProcess(args=command, returncode=usage["returncode"])
+
+
+def report_runs(ledger_path: pathlib.Path) -> str:
+    """Create a report that compares the runs in a ledger by run name and pipeline version, with the time and
+    memory per image set so runs with different numbers of image sets (e.g., shards) can be compared.
+
+    Args:
+        ledger_path (pathlib.Path): path to the SQLite run ledger
+
+    Returns:
+        str: report table with one row per run ID and pipeline version
+    """
+    with sqlite3.connect(ledger_path) as connection:
+        rows = connection.execute(
+            """
+            SELECT
+                run_id,
+                run_name,
+                pipeline_name,
+                SUBSTR(pipeline_sha256, 1, 8),
+                COUNT(*),
+                SUM(returncode != 0),
+                SUM(num_image_sets),
+                MIN(started_at),
+                SUM(wall_seconds),
+                TOTAL(cpu_seconds),
+                IFNULL(MAX(peak_rss_bytes), 0),
+                TOTAL(read_bytes + write_bytes)
+            FROM cellprofiler_runs
+            GROUP BY run_id, run_name, pipeline_name, pipeline_sha256
+            ORDER BY run_name, pipeline_name, MIN(started_at)
+            """
+        ).fetchall()
+
+    header = (
+        f"{'run_id':<22} {'run_name':<16} {'pipeline':<30} {'hash':<8} {'procs':>5} {'failed':>6} "
+        f"{'sets':>7} {'wall_s/set':>10} {'cpu_s/set':>9} {'peak_rss_gb':>11} {'io_gb':>8}"
+    )
+    lines = [header, "-" * len(header)]
+    for (
+        run_id, run_name, pipeline_name, short_hash, processes, failed, image_sets,
+        _, wall_seconds, cpu_seconds, peak_rss, io_bytes,
+    ) in rows:
+        per_set = max(image_sets or 0, 1)
+        lines.append(
+            f"{run_id:<22} {run_name:<16} {pipeline_name:<30} {short_hash:<8} {processes:>5} {failed:>6} "
+            f"{image_sets or 0:>7} {wall_seconds / per_set:>10.2f} {cpu_seconds / per_set:>9.2f} "
+            f"{peak_rss / 1024**3:>11.2f} {io_bytes / 1024**3:>8.2f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the CellProfiler runs recorded in a run ledger."
+    )
+    parser.add_argument(
+        "ledger_path", type=pathlib.Path, help="path to the SQLite run ledger"
+    )
+    args = parser.parse_args()
+    print(report_runs(ledger_path=args.ledger_path))
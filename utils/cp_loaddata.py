@@ -0,0 +1,391 @@
+"""
+This collection of functions creates a CellProfiler LoadData CSV for each plate (one row per image set with the file
+name, path, and metadata for each channel) and a copy of the pipeline that loads images from the CSV, so CellProfiler
+does not have to walk the image directory and apply the metadata regular expressions to every image at startup.
+
+The CSV is cached with a fingerprint of the image directory and pipeline, so it is only created again when images are
+added or removed (or the pipeline changes). Row N of the CSV is image set N, so a shard of a plate is run with the
+first (`-f`) and last (`-l`) image set options on the same CSV. Image sets in the QC skip list for a plate (see
+`cp_skiplist`) are left out of the CSV, so they are never run. Illumination functions from the illumination function
+cache (see `cp_illum_cache`) are loaded from the CSV like the images.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Dict, List, Optional, Set, Tuple
+import codecs
+import csv
+import hashlib
+import json
+import os
+import pathlib
+import re
+
+import cp_manifest
+import cp_shards
+import cp_skiplist
+
+# input modules that are replaced by the LoadData module in the pipelines that load images from a CSV
+INPUT_MODULES = ("Images", "Metadata", "NamesAndTypes", "Groups")
+
+# LoadData module that reads the image file names, paths, and metadata from the CSV given with `--data-file`,
+# where the file name is also set so the module finds the CSV in the default input folder (`-i`)
+LOAD_DATA_MODULE = """LoadData:[module_num:1|svn_version:'Unknown'|variable_revision_number:6|show_window:False|notes:['Images and metadata are loaded from the LoadData CSV made by utils/cp_loaddata.py, which replaces the Images, Metadata, NamesAndTypes, and Groups modules.']|batch_state:array([], dtype=uint8)|enabled:True|wants_pause:False]
+    Input data file location:Default Input Folder|
+    Name of the file:{csv_name}
+    Load images based on this data?:Yes
+    Base image location:None|
+    Process just a range of rows?:No
+    Rows to process:1,100000
+    Group images by metadata?:No
+    Select metadata tags for grouping:
+    Rescale intensities?:Yes
+"""
+
+# suffix added to the file name of an image for the .npy file with its illumination function
+ILLUM_FUNCTION_SUFFIX = "_illum"
+
+# metadata that CellProfiler adds for every image when using the input modules
+DEFAULT_METADATA = {"Metadata_Frame": 0, "Metadata_Series": 0}
+
+
+def read_pipeline_modules(path_to_pipeline: pathlib.Path) -> Tuple[List[str], List[List[str]]]:
+    """Split a CellProfiler .cppipe file into the header lines and the lines for each module.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+
+    Returns:
+        Tuple[List[str], List[List[str]]]: header lines and a list of lines for each module
+    """
+    blocks = pathlib.Path(path_to_pipeline).read_text().strip("\n").split("\n\n")
+    return blocks[0].split("\n"), [block.strip("\n").split("\n") for block in blocks[1:]]
+
+
+def module_settings(module_lines: List[str]) -> List[Tuple[str, str]]:
+    """Find the settings of a module as (setting name, value) pairs in the order they are in the pipeline.
+
+    Args:
+        module_lines (List[str]): lines for one module from the .cppipe file
+
+    Returns:
+        List[Tuple[str, str]]: setting name and value for each setting
+    """
+    settings = []
+    for line in module_lines[1:]:
+        name, _, value = line.strip().partition(":")
+        # values are saved with backslashes escaped in the .cppipe file
+        settings.append((name, codecs.decode(value, "unicode_escape")))
+    return settings
+
+
+def parse_input_modules(path_to_pipeline: pathlib.Path) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    """Find how images are assigned to channels and how metadata is extracted from the input modules of a pipeline.
+    All of our pipelines use the "Order" matching method with a rule per channel (e.g., file name contains "DAPI")
+    and regular expressions on the file or folder name for metadata.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+
+    Raises:
+        ValueError: if the pipeline uses input module settings that a LoadData CSV can not be made for
+
+    Returns:
+        Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]: (text in the file name, image name) for each channel in
+        the order of the rules, and (source, regular expression) for each metadata extraction method
+    """
+    _, modules = read_pipeline_modules(path_to_pipeline)
+    modules = {module_lines[0].split(":")[0]: module_settings(module_lines) for module_lines in modules}
+
+    channels = []
+    file_text = None
+    for name, value in modules["NamesAndTypes"]:
+        if name == "Image set matching method" and value != "Order":
+            raise ValueError(
+                f"{pathlib.Path(path_to_pipeline).name} matches images by {value}, but only Order is supported."
+            )
+        if name == "Select the rule criteria":
+            match = re.fullmatch(r'and \(file does contain "([^"]+)"\)', value)
+            if match is None:
+                raise ValueError(
+                    f"The rule '{value}' in {pathlib.Path(path_to_pipeline).name} is not supported, as rules must only check the file name."
+                )
+            file_text = match.group(1)
+        # the image name that follows each rule is the name for that channel
+        if name == "Name to assign these images" and file_text is not None:
+            channels.append((file_text, value))
+            file_text = None
+
+    extraction_methods = []
+    metadata_settings = modules["Metadata"]
+    if dict(metadata_settings).get("Extract metadata?") == "Yes":
+        source = None
+        for name, value in metadata_settings:
+            if name == "Metadata extraction method" and value != "Extract from file/folder names":
+                raise ValueError(
+                    f"The metadata extraction method '{value}' in {pathlib.Path(path_to_pipeline).name} is not supported."
+                )
+            if name == "Metadata source":
+                source = value
+            if name == "Regular expression to extract from file name" and source == "File name":
+                extraction_methods.append(("File name", value))
+            if name == "Regular expression to extract from folder name" and source == "Folder name":
+                extraction_methods.append(("Folder name", value))
+
+    return channels, extraction_methods
+
+
+def create_load_data_pipeline(path_to_pipeline: pathlib.Path, path_to_load_data_pipeline: pathlib.Path) -> None:
+    """Create a copy of a pipeline where the input modules are replaced by a LoadData module as the first module.
+    The copy has the same file name as the pipeline so runs are recorded under the same pipeline name.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_load_data_pipeline (pathlib.Path): path to save the pipeline that uses the LoadData module
+    """
+    header, modules = read_pipeline_modules(path_to_pipeline)
+    modules = [
+        module_lines for module_lines in modules if module_lines[0].split(":")[0] not in INPUT_MODULES
+    ]
+
+    # renumber the modules after the LoadData module
+    for module_num, module_lines in enumerate(modules, start=2):
+        module_lines[0] = re.sub(r"module_num:\d+", f"module_num:{module_num}", module_lines[0])
+    header = [
+        f"ModuleCount:{len(modules) + 1}" if line.startswith("ModuleCount:") else line for line in header
+    ]
+
+    load_data_module = LOAD_DATA_MODULE.format(csv_name=load_data_csv_name(path_to_pipeline)).strip("\n")
+    blocks = ["\n".join(header), load_data_module] + ["\n".join(module_lines) for module_lines in modules]
+    pathlib.Path(path_to_load_data_pipeline).parent.mkdir(parents=True, exist_ok=True)
+    pathlib.Path(path_to_load_data_pipeline).write_text("\n\n".join(blocks) + "\n")
+
+
+def load_data_csv_name(path_to_pipeline: pathlib.Path) -> str:
+    """Create the file name of the LoadData CSV for a pipeline, since the image names differ between pipelines.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+
+    Returns:
+        str: file name of the LoadData CSV (e.g., load_data_NF1_analysis_4channel.csv)
+    """
+    return f"load_data_{pathlib.Path(path_to_pipeline).stem}.csv"
+
+
+def list_image_files(path_to_images: pathlib.Path) -> Tuple[List[pathlib.Path], str]:
+    """Find the image files that CellProfiler would load from a directory, with a fingerprint of the directory
+    that changes when images are added or removed (from the modification time of each folder).
+
+    Args:
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+
+    Returns:
+        Tuple[List[pathlib.Path], str]: sorted image file paths and the fingerprint of the directory
+    """
+    image_paths = []
+    folder_mtimes = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path_to_images):
+        # skip hidden directories like the `Images` module rule in the pipelines
+        dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.startswith("."))
+        folder_mtimes.update(f"{dirpath}:{os.stat(dirpath).st_mtime_ns}\n".encode())
+        image_paths.extend(
+            pathlib.Path(dirpath) / filename
+            for filename in filenames
+            if pathlib.Path(filename).suffix.lower() in cp_shards.IMAGE_EXTENSIONS
+        )
+    # CellProfiler orders images by their URL when matching by order
+    return sorted(image_paths, key=lambda image_path: image_path.as_posix()), folder_mtimes.hexdigest()
+
+
+def extract_metadata(image_path: pathlib.Path, extraction_methods: List[Tuple[str, str]]) -> Dict[str, str]:
+    """Extract metadata from the file or folder name of an image the same way as the CellProfiler Metadata module.
+
+    Args:
+        image_path (pathlib.Path): path to the image
+        extraction_methods (List[Tuple[str, str]]): source ("File name" or "Folder name") and regular expression
+        for each metadata extraction method
+
+    Returns:
+        Dict[str, str]: metadata columns (e.g., Metadata_Well) and values
+    """
+    metadata = {}
+    for source, expression in extraction_methods:
+        text = image_path.name if source == "File name" else str(image_path.parent)
+        match = re.search(expression, text)
+        if match is not None:
+            metadata.update(
+                {f"Metadata_{key}": value for key, value in match.groupdict().items() if value is not None}
+            )
+    return metadata
+
+
+def create_load_data_csv(
+    path_to_images: pathlib.Path,
+    path_to_pipeline: pathlib.Path,
+    path_to_csv: pathlib.Path,
+    skip_image_sets: Optional[Set[Tuple[str, int]]] = None,
+    illum_functions: Optional[Dict[str, Tuple[str, pathlib.Path]]] = None,
+) -> int:
+    """Create the LoadData CSV for a plate with one row per image set, where images of each channel are matched
+    by order like the NamesAndTypes module. Metadata for the image set is extracted from the image in the first
+    channel.
+
+    Args:
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_csv (pathlib.Path): path to save the LoadData CSV
+        skip_image_sets (Set[Tuple[str, int]], optional): well and site of image sets to leave out of the CSV
+        (default is None)
+        illum_functions (Dict[str, Tuple[str, pathlib.Path]], optional): input image name and folder of the .npy
+        files for each illumination function to load from the CSV, where image sets without a .npy file (flagged by
+        the FlagImage module when the cache was made) are left out of the CSV (default is None)
+
+    Raises:
+        ValueError: if the channels do not have the same number of images
+
+    Returns:
+        int: number of image sets (rows) in the CSV
+    """
+    channels, extraction_methods = parse_input_modules(path_to_pipeline)
+    image_paths, _ = list_image_files(path_to_images)
+    channel_paths = {
+        image_name: [image_path for image_path in image_paths if file_text in image_path.name]
+        for file_text, image_name in channels
+    }
+    num_images = {image_name: len(paths) for image_name, paths in channel_paths.items()}
+    if len(set(num_images.values())) > 1:
+        raise ValueError(
+            f"The channels in {pathlib.Path(path_to_images).name} do not have the same number of images: {num_images}"
+        )
+
+    # image sets that are flagged by the FlagImage module are skipped before the illumination functions are
+    # calculated, so they do not have a .npy file in the cache and can not be loaded by the LoadData module
+    illum_files = {
+        illum_name: set(os.listdir(illum_folder)) for illum_name, (_, illum_folder) in (illum_functions or {}).items()
+    }
+    num_flagged = 0
+
+    rows = []
+    for image_set in zip(*channel_paths.values()):
+        # the well and site are found from the file name since not all pipelines extract metadata
+        if cp_shards.is_skipped(image_set[0], skip_image_sets):
+            continue
+        if any(
+            f"{image_set[list(channel_paths).index(image_name)].stem}{ILLUM_FUNCTION_SUFFIX}.npy"
+            not in illum_files[illum_name]
+            for illum_name, (image_name, _) in (illum_functions or {}).items()
+        ):
+            num_flagged += 1
+            continue
+        row = {}
+        for image_name, image_path in zip(channel_paths, image_set):
+            row[f"FileName_{image_name}"] = image_path.name
+            row[f"PathName_{image_name}"] = str(image_path.parent.resolve())
+        # illumination functions are named after the image they were calculated from
+        for illum_name, (image_name, illum_folder) in (illum_functions or {}).items():
+            image_path = image_set[list(channel_paths).index(image_name)]
+            row[f"FileName_{illum_name}"] = f"{image_path.stem}{ILLUM_FUNCTION_SUFFIX}.npy"
+            row[f"PathName_{illum_name}"] = str(pathlib.Path(illum_folder).resolve())
+        row["Metadata_FileLocation"] = image_set[0].resolve().as_uri()
+        row.update(DEFAULT_METADATA)
+        row.update(extract_metadata(image_set[0], extraction_methods))
+        rows.append(row)
+
+    # images without a match for a metadata expression do not have that metadata, so all columns are collected
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    pathlib.Path(path_to_csv).parent.mkdir(parents=True, exist_ok=True)
+    with open(path_to_csv, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    if num_flagged:
+        print(
+            f"Left {num_flagged} image sets without cached illumination functions (flagged by FlagImage) out of the "
+            f"LoadData CSV for {pathlib.Path(path_to_images).name}"
+        )
+
+    return len(rows)
+
+
+def prepare_load_data(
+    path_to_images: pathlib.Path,
+    path_to_pipeline: pathlib.Path,
+    load_data_dir: pathlib.Path,
+    path_to_skip_list: Optional[pathlib.Path] = None,
+    illum_functions: Optional[Dict[str, Tuple[str, pathlib.Path]]] = None,
+) -> dict:
+    """Create (or reuse from the cache) the LoadData CSV for a plate and the pipeline that loads images from it.
+    The CSV is only created again when the fingerprint of the image directory, the pipeline hash, the skip list, or
+    the cached illumination functions change.
+
+    Args:
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        load_data_dir (pathlib.Path): directory for the LoadData CSVs (in a folder per plate) and pipelines
+        path_to_skip_list (pathlib.Path, optional): path to the QC skip list for the plate, where the image sets
+        in the list are left out of the CSV (default is None)
+        illum_functions (Dict[str, Tuple[str, pathlib.Path]], optional): input image name and folder of the .npy
+        files for each illumination function to load from the CSV (see `cp_illum_cache`) (default is None)
+
+    Returns:
+        dict: paths to the LoadData pipeline ("path_to_pipeline"), the folder given as the input folder with `-i`
+        ("path_to_input"), and the CSV given with `--data-file` ("path_to_csv"), and the number of image sets
+        ("num_image_sets")
+    """
+    load_data_dir = pathlib.Path(load_data_dir).resolve()
+    path_to_input = load_data_dir / pathlib.Path(path_to_images).name
+    path_to_csv = path_to_input / load_data_csv_name(path_to_pipeline)
+    path_to_fingerprint = path_to_csv.with_suffix(".json")
+    # the pipeline is made for each plate since a pipeline that uses the illumination function cache can differ
+    # between plates
+    path_to_load_data_pipeline = (
+        load_data_dir / "pipelines" / pathlib.Path(path_to_images).name / pathlib.Path(path_to_pipeline).name
+    )
+
+    _, directory_fingerprint = list_image_files(path_to_images)
+    fingerprint = {
+        "path_to_images": str(pathlib.Path(path_to_images).resolve()),
+        "directory_fingerprint": directory_fingerprint,
+        "pipeline_sha256": cp_manifest.pipeline_hash(path_to_pipeline),
+        "skip_list_sha256": (
+            None
+            if path_to_skip_list is None
+            else hashlib.sha256(pathlib.Path(path_to_skip_list).read_bytes()).hexdigest()
+        ),
+        "illum_functions": {
+            illum_name: [image_name, str(pathlib.Path(illum_folder).resolve())]
+            for illum_name, (image_name, illum_folder) in sorted((illum_functions or {}).items())
+        },
+    }
+
+    # reuse the cached CSV if the images and pipeline have not changed since it was made
+    cached = {}
+    if path_to_fingerprint.exists() and path_to_csv.exists():
+        with open(path_to_fingerprint, "r") as fingerprint_file:
+            cached = json.load(fingerprint_file)
+    if {key: cached.get(key) for key in fingerprint} == fingerprint:
+        num_image_sets = cached["num_image_sets"]
+    else:
+        num_image_sets = create_load_data_csv(
+            path_to_images=path_to_images,
+            path_to_pipeline=path_to_pipeline,
+            path_to_csv=path_to_csv,
+            skip_image_sets=None if path_to_skip_list is None else cp_skiplist.load_skip_list(path_to_skip_list),
+            illum_functions=illum_functions,
+        )
+        with open(path_to_fingerprint, "w") as fingerprint_file:
+            json.dump({**fingerprint, "num_image_sets": num_image_sets}, fingerprint_file, indent=4)
+        print(f"Created the LoadData CSV for {pathlib.Path(path_to_images).name} with {num_image_sets} image sets")
+
+    create_load_data_pipeline(
+        path_to_pipeline=path_to_pipeline, path_to_load_data_pipeline=path_to_load_data_pipeline
+    )
+
+    return {
+        "path_to_pipeline": path_to_load_data_pipeline,
+        "path_to_input": path_to_input,
+        "path_to_csv": path_to_csv,
+        "num_image_sets": num_image_sets,
+    }
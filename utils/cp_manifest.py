@@ -0,0 +1,236 @@
+"""
+This collection of functions keeps a run manifest in the output directory of each plate that records which image sets
+have been completed for each pipeline, so that a CellProfiler run can resume with only the missing image sets.
+
+The image sets are the rows of the LoadData CSV that the plate was run with (see `cp_loaddata`), so the hash of the CSV
+is recorded with them. The CSV is made again when the images, skip list, or illumination function cache change, and
+the recorded image sets can only be used when the rows of the CSV are the same.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import List, Optional, Tuple
+import hashlib
+import json
+import pathlib
+
+import cp_shards
+import cp_skiplist
+
+# name of the manifest file that is saved in the output directory for each plate
+MANIFEST_NAME = "run_manifest.json"
+
+
+def pipeline_hash(path_to_pipeline: pathlib.Path) -> str:
+    """Find the SHA256 hash of a CellProfiler pipeline file to know if the pipeline changed between runs.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+
+    Returns:
+        str: hex digest of the pipeline file contents
+    """
+    return hashlib.sha256(pathlib.Path(path_to_pipeline).read_bytes()).hexdigest()
+
+
+def load_data_hash(path_to_csv: Optional[pathlib.Path]) -> Optional[str]:
+    """Find the SHA256 hash of a LoadData CSV to know if the rows (image sets) changed between runs.
+
+    Args:
+        path_to_csv (pathlib.Path, optional): path to the LoadData CSV, or None if the plate is not run with one
+
+    Returns:
+        Optional[str]: hex digest of the CSV file contents, or None if no CSV is given
+    """
+    if path_to_csv is None:
+        return None
+    return hashlib.sha256(pathlib.Path(path_to_csv).read_bytes()).hexdigest()
+
+
+def load_manifest(path_to_output: pathlib.Path) -> dict:
+    """Load the run manifest for a plate, which is empty if the plate has not been run yet.
+
+    Args:
+        path_to_output (pathlib.Path): path to the output directory for the plate
+
+    Returns:
+        dict: manifest with the completed image sets for each pipeline (by pipeline file name)
+    """
+    manifest_path = pathlib.Path(path_to_output) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Combine overlapping or adjacent inclusive ranges of image sets.
+
+    Args:
+        ranges (List[Tuple[int, int]]): first and last image set for each range
+
+    Returns:
+        List[Tuple[int, int]]: sorted ranges that do not overlap
+    """
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def get_pipeline_record(
+    path_to_output: pathlib.Path,
+    path_to_pipeline: pathlib.Path,
+    path_to_csv: Optional[pathlib.Path] = None,
+) -> dict:
+    """Get the record for a pipeline from the run manifest of a plate.
+
+    Args:
+        path_to_output (pathlib.Path): path to the output directory for the plate
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_csv (pathlib.Path, optional): path to the LoadData CSV the plate is run with, which must have the same
+        rows as the CSV the image sets in the manifest were completed with (default is None)
+
+    Raises:
+        ValueError: if the image sets in the manifest were completed with a different version of the pipeline or
+        with a LoadData CSV that has different rows
+
+    Returns:
+        dict: record with the pipeline hash, LoadData CSV hash, and completed image sets (empty if the pipeline has
+        not been run)
+    """
+    record = load_manifest(path_to_output).get(pathlib.Path(path_to_pipeline).name, {})
+    if record and record["pipeline_sha256"] != pipeline_hash(path_to_pipeline):
+        raise ValueError(
+            f"The outputs in {pathlib.Path(path_to_output).name} were made with a different version of {pathlib.Path(path_to_pipeline).name}. "
+            "Please remove the output directory to rerun the plate with the updated pipeline."
+        )
+    # records from before the LoadData CSV hash was added can not be checked
+    if record.get("load_data_sha256") is not None and record["load_data_sha256"] != load_data_hash(path_to_csv):
+        raise ValueError(
+            f"The outputs in {pathlib.Path(path_to_output).name} were made with a different LoadData CSV for {pathlib.Path(path_to_pipeline).name} "
+            "(e.g., the images, skip list, or cached illumination functions changed), so the completed image sets do not match the rows of the CSV. "
+            "Please remove the output directory to rerun the plate."
+        )
+    return record
+
+
+def record_completed_image_sets(
+    path_to_output: pathlib.Path,
+    path_to_pipeline: pathlib.Path,
+    first: int,
+    last: int,
+    path_to_csv: Optional[pathlib.Path] = None,
+    num_image_sets: Optional[int] = None,
+) -> None:
+    """Add a range of image sets that completed to the run manifest for a plate.
+
+    Args:
+        path_to_output (pathlib.Path): path to the output directory for the plate
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        first (int): first image set that completed
+        last (int): last image set that completed
+        path_to_csv (pathlib.Path, optional): path to the LoadData CSV the image sets were run with (default is None)
+        num_image_sets (int, optional): total number of image sets (rows of the LoadData CSV) for the plate
+        (default is None)
+    """
+    manifest = load_manifest(path_to_output)
+    record = get_pipeline_record(path_to_output, path_to_pipeline, path_to_csv)
+    completed = [tuple(image_sets) for image_sets in record.get("completed_image_sets", [])]
+
+    manifest[pathlib.Path(path_to_pipeline).name] = {
+        "pipeline_sha256": pipeline_hash(path_to_pipeline),
+        "load_data_csv": None if path_to_csv is None else str(pathlib.Path(path_to_csv).resolve()),
+        "load_data_sha256": load_data_hash(path_to_csv),
+        "num_image_sets": num_image_sets,
+        "completed_image_sets": [list(image_sets) for image_sets in merge_ranges(completed + [(first, last)])],
+    }
+
+    # write to a temporary file first so the manifest is never left half written if the run is stopped
+    manifest_path = pathlib.Path(path_to_output) / MANIFEST_NAME
+    temporary_path = manifest_path.with_suffix(".json.tmp")
+    with open(temporary_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    temporary_path.replace(manifest_path)
+
+
+def missing_image_sets(
+    path_to_output: pathlib.Path,
+    path_to_pipeline: pathlib.Path,
+    num_image_sets: int,
+    path_to_csv: Optional[pathlib.Path] = None,
+) -> List[Tuple[int, int]]:
+    """Find the ranges of image sets that have not been completed for a plate and pipeline.
+
+    Args:
+        path_to_output (pathlib.Path): path to the output directory for the plate
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        num_image_sets (int): total number of image sets for the plate
+        path_to_csv (pathlib.Path, optional): path to the LoadData CSV the plate is run with (default is None)
+
+    Returns:
+        List[Tuple[int, int]]: first and last image set of each range that still needs to be run
+    """
+    record = get_pipeline_record(path_to_output, path_to_pipeline, path_to_csv)
+    completed = merge_ranges(
+        [tuple(image_sets) for image_sets in record.get("completed_image_sets", [])]
+    )
+
+    missing = []
+    next_image_set = 1
+    for first, last in completed:
+        if first > next_image_set:
+            missing.append((next_image_set, min(first - 1, num_image_sets)))
+        next_image_set = max(next_image_set, last + 1)
+    if next_image_set <= num_image_sets:
+        missing.append((next_image_set, num_image_sets))
+
+    return [(first, last) for first, last in missing if first <= last]
+
+
+def is_plate_complete(
+    path_to_output: pathlib.Path,
+    path_to_pipeline: pathlib.Path,
+    path_to_images: pathlib.Path,
+    legacy_output_pattern: Optional[str] = None,
+    path_to_skip_list: Optional[pathlib.Path] = None,
+) -> bool:
+    """Check if all image sets for a plate have been completed with a pipeline.
+
+    Args:
+        path_to_output (pathlib.Path): path to the output directory for the plate
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_images (pathlib.Path): path to the directory with images for the plate
+        legacy_output_pattern (str, optional): glob pattern for an output file that is only made once a plate is
+        finished, which is used for plates that were run before the run manifest was added (default is None)
+        path_to_skip_list (pathlib.Path, optional): path to the QC skip list for the plate, where the image sets in
+        the list are not run and are not counted (default is None)
+
+    Returns:
+        bool: True if there are no missing image sets in the run manifest, where plates run with a LoadData CSV are
+        not complete if the CSV has been made again with different rows since
+    """
+    record = load_manifest(path_to_output).get(pathlib.Path(path_to_pipeline).name, {})
+    if (
+        legacy_output_pattern is not None
+        and not record
+        and any(pathlib.Path(path_to_output).glob(legacy_output_pattern))
+    ):
+        return True
+
+    # the rows of the LoadData CSV are the image sets of the plate
+    if record.get("load_data_sha256") is not None:
+        path_to_csv = pathlib.Path(record["load_data_csv"])
+        if not path_to_csv.exists() or load_data_hash(path_to_csv) != record["load_data_sha256"]:
+            return False
+        return not missing_image_sets(path_to_output, path_to_pipeline, record["num_image_sets"], path_to_csv)
+
+    num_image_sets = cp_shards.count_image_sets(
+        path_to_images,
+        skip_image_sets=None if path_to_skip_list is None else cp_skiplist.load_skip_list(path_to_skip_list),
+    )
+    return not missing_image_sets(path_to_output, path_to_pipeline, num_image_sets)
@@ -1,16 +1,51 @@
 """
-This collection of functions runs CellProfiler in parallel and can convert the results into log files
-for each process.
+This collection of functions runs CellProfiler in parallel, writing the output of each process to its own
+log file while it runs along with a JSONL file of progress events for the run. The resources used by each
+process are recorded in the run ledger in the logs directory. Plates (or shards) that fail are retried and listed
+in a failure summary. Images are loaded from a LoadData CSV for each plate, which is cached in the load_data_csv
+directory and leaves out the image sets in the QC skip list for the plate. Illumination functions can be reused from
+the illumination function cache for each plate, and analysis can be fused with illumination correction so it runs on
+the raw images. The SQLite output of each plate (or shard) can be converted to Parquet as soon as it completes while
+the other plates are still running.
 """
 
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
 import multiprocessing
 import logging
-from typing import List
+from typing import List, Optional
 import os
 import subprocess
 import pathlib
-from concurrent.futures import ProcessPoolExecutor, Future
+import shutil
+import time
 from errors.exceptions import MaxWorkerError
+import cp_ledger
+import cp_loaddata
+import cp_manifest
+import cp_progress
+import cp_retry
+import cp_executors
+import cp_fused
+import cp_illum_cache
+import cp_shards
+import cp_stream_convert
+
+
+def plate_name_from_output(path_to_output: pathlib.Path) -> str:
+    """Find the name for a CellProfiler run from the output path, which includes the image set range for shards.
+
+    Args:
+        path_to_output (pathlib.Path): path to the output directory for a plate or shard
+
+    Returns:
+        str: name of the plate (e.g., Plate_1) or plate and shard (e.g., Plate_1_image_sets_00001_00050)
+    """
+    path_to_output = pathlib.Path(path_to_output)
+    if path_to_output.parent.name == "shards":
+        return f"{path_to_output.parent.parent.name}_{path_to_output.name}"
+    return path_to_output.name
 
 
 def results_to_log(
@@ -18,47 +53,113 @@ def results_to_log(
 ) -> None:
     """
     This function will take the list of subprocess.results from a CellProfiler parallelization run and
-    convert into a log file for each process.
+    add a summary to the log file for each process. If the CellProfiler output was not already written to
+    the log file while the process ran, the output is added as well.
 
     Args:
         results (List[subprocess.CompletedProcess]): the outputs from a subprocess.run
         log_dir (pathlib.Path): directory for log files
         run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
     """
+    log_format = logging.Formatter("[%(asctime)s] [Process ID: %(process)d] %(message)s")
+
     # Access the command (args) and stderr (output) for each CompletedProcess object
     for result in results:
-        # assign plate name and decode the CellProfiler output to use in log file
-        plate_name = result.args[6].name
-        output_string = result.stderr.decode("utf-8")
+        # assign plate name from the output path in the command
+        plate_name = plate_name_from_output(result.args[6])
 
         # set log file name as plate name from command
         log_file_path = pathlib.Path(f"{log_dir}/{plate_name}_{run_name}_run.log")
-        # print output to a log file for each plate to view after the run
-        # set up logging configuration
-        log_format = "[%(asctime)s] [Process ID: %(process)d] %(message)s"
-        logging.basicConfig(
-            filename=log_file_path, level=logging.INFO, format=log_format
-        )
 
-        # log plate name and output string
-        logging.info(f"Plate Name: {plate_name}")
-        logging.info(f"Output String: {output_string}")
+        # use a logger for each plate so each plate is written to its own log file
+        logger = logging.getLogger(f"cp_parallel.{run_name}.{plate_name}")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        file_handler = logging.FileHandler(log_file_path)
+        file_handler.setFormatter(log_format)
+        logger.addHandler(file_handler)
+
+        # log plate name, return code, and output string (if not already in the log file)
+        logger.info(f"Plate Name: {plate_name}")
+        logger.info(f"Return Code: {result.returncode}")
+        if result.stderr is not None:
+            logger.info(f"Output String: {result.stderr.decode('utf-8')}")
+
+        logger.removeHandler(file_handler)
+        file_handler.close()
 
 
 def run_cellprofiler_parallel(
     plate_info_dictionary: dict,
     run_name: str,
+    sharded: bool = False,
+    shard_size: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    memory_budget_gb: Optional[float] = None,
+    memory_per_process_gb: float = 4.0,
+    executor: str = "local",
+    executor_options: Optional[dict] = None,
+    use_load_data: bool = True,
+    max_retries: int = 2,
+    retry_backoff_seconds: float = 60.0,
+    stream_convert_dir: Optional[pathlib.Path] = None,
+    stream_convert_workers: int = 1,
 ) -> None:
     """
-    This function utilizes multi-processing to run CellProfiler pipelines in parallel.
+    This function utilizes multi-processing to run CellProfiler pipelines in parallel. By default, one CellProfiler
+    process is run per plate. When sharded, each plate is split into ranges of image sets that are spread across
+    a pool of workers and the outputs of each shard are merged back into the plate output directory. The completed
+    image sets are recorded in a run manifest for each plate, so a sharded run only submits the image sets that
+    are missing from a previous run.
+    Plates (or shards) are queued and only started when they fit within the CPU and memory budgets.
+    When a plate has a QC skip list ("path_to_skip_list"), only the image sets that pass QC are submitted.
+    When a plate has an illumination function cache directory ("illum_cache_dir"), illumination functions that are
+    in the cache are loaded instead of being calculated again. When a plate also has an illumination correction
+    pipeline ("path_to_illum_pipeline"), the images are corrected in the same run as the pipeline (see `cp_fused`),
+    where the corrected images are only saved when a folder to export them to is given ("path_to_corrected_images").
+    When a stream conversion directory is given, the SQLite output of each plate (or shard) that completes is
+    converted to Parquet with CytoTable in the background while the other plates are still running (see
+    `cp_stream_convert`).
 
     Args:
-        plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline
+        plate_info_dictionary (dict): dictionary with all paths for CellProfiler to run a pipeline, with an optional
+        path to the QC skip list (see `cp_skiplist`), illumination function cache directory (see `cp_illum_cache`), and
+        illumination correction pipeline to fuse with the pipeline (see `cp_fused`) for each plate
         run_name (str): a given name for the type of CellProfiler run being done on the plates (example: whole image features)
+        sharded (bool, optional): split each plate into ranges of image sets to run in parallel (default is False)
+        shard_size (int, optional): number of image sets per shard, which if not set will evenly split all image sets
+        across the workers (default is None)
+        max_workers (int, optional): maximum number of CellProfiler processes to run at once, which defaults
+        to the number of CPUs on the machine (default is None)
+        memory_budget_gb (float, optional): maximum total memory in GB for all running CellProfiler processes, which
+        defaults to 80% of the memory on the machine (default is None)
+        memory_per_process_gb (float, optional): starting estimate of memory in GB for one CellProfiler process, which
+        is updated with the peak memory of finished processes (default is 4.0)
+        executor (str, optional): backend that runs the CellProfiler processes, which is "local" (this machine),
+        "batch" (job scripts submitted to a batch scheduler like SLURM), or "dask" (tasks on a Dask cluster),
+        where the CPU and memory budgets only apply to the local backend (default is "local")
+        executor_options (dict, optional): options for the batch or Dask backend (see `cp_executors`) (default is None)
+        use_load_data (bool, optional): load the images from a LoadData CSV for each plate instead of having
+        CellProfiler scan the image directory (default is True)
+        max_retries (int, optional): number of times to retry a plate (or shard) that failed, where only failures
+        that can pass on another attempt (see `cp_retry.RETRYABLE_FAILURES`) are retried (default is 2)
+        retry_backoff_seconds (float, optional): seconds to wait before the first retry, which doubles for each
+        retry after (default is 60.0)
+        stream_convert_dir (pathlib.Path, optional): directory to save the converted Parquet file of each plate (or
+        shard) in a folder for the plate, where outputs are not converted if not given (default is None)
+        stream_convert_workers (int, optional): maximum number of conversions to run at once (default is 1)
 
     Raises:
         FileNotFoundError: if paths to pipeline and images do not exist
+        ValueError: if a skip list or illumination function cache is given for a plate when not using LoadData CSVs
+        MaxWorkerError: if max_workers exceeds the number of CPUs on the machine when running locally
     """
+    # make sure that the number of workers does not exceed the maximum number of workers for the machine
+    if executor == "local" and max_workers is not None and max_workers > multiprocessing.cpu_count():
+        raise MaxWorkerError(
+            f"Exception occurred: max_workers ({max_workers}) exceeds the number of CPUs/workers ({multiprocessing.cpu_count()})."
+        )
+
     # create a list of commands for each plate with their respective log file
     commands = []
 
@@ -66,12 +167,21 @@ def run_cellprofiler_parallel(
     log_dir = pathlib.Path("./logs")
     os.makedirs(log_dir, exist_ok=True)
 
+    # directory for the LoadData CSV of each plate and the pipelines that load images from them
+    load_data_dir = pathlib.Path("./load_data_csv")
+
+    # number of image sets for each plate, and the LoadData CSV the image sets are the rows of (None when the image
+    # directory is scanned)
+    image_set_counts = {}
+    load_data_csvs = {}
+
     # iterate through each plate in the dictionary
-    for _, info in plate_info_dictionary.items():
+    for plate, info in plate_info_dictionary.items():
         # set paths for CellProfiler
         path_to_pipeline = info["path_to_pipeline"]
         path_to_images = info["path_to_images"]
-        path_to_output = info["path_to_output"]
+        # the output path is absolute so commands can be run from any directory (e.g., on a cluster)
+        path_to_output = pathlib.Path(info["path_to_output"]).resolve()
 
         # check to make sure paths to pipeline and directory of images are correct before running the pipeline
         if not pathlib.Path(path_to_pipeline).resolve(strict=True):
@@ -86,56 +196,316 @@ def run_cellprofiler_parallel(
         pathlib.Path(path_to_output).mkdir(exist_ok=True)
 
         # creates a command for each plate in the list
-        command = [
-            "cellprofiler",
-            "-c",
-            "-r",
-            "-p",
-            path_to_pipeline,
-            "-o",
-            path_to_output,
-            "-i",
-            path_to_images,
-        ]
+        if use_load_data:
+            # the pipeline that is run has the CorrectIlluminationCalculate modules with cached illumination functions
+            # removed, which are loaded from the LoadData CSV instead, and is fused with the illumination correction
+            # pipeline when given (the run manifest still uses the original pipeline)
+            illum_cache = {"path_to_pipeline": path_to_pipeline, "illum_functions": None}
+            if info.get("path_to_illum_pipeline") is not None:
+                illum_cache = cp_fused.prepare_fused_pipeline(
+                    path_to_pipeline=path_to_pipeline,
+                    path_to_illum_pipeline=info["path_to_illum_pipeline"],
+                    path_to_images=path_to_images,
+                    cache_dir=info["illum_cache_dir"],
+                    path_to_corrected_images=info.get("path_to_corrected_images"),
+                )
+            elif info.get("illum_cache_dir") is not None:
+                illum_cache = cp_illum_cache.prepare_illum_cache(
+                    path_to_pipeline=path_to_pipeline,
+                    path_to_images=path_to_images,
+                    cache_dir=info["illum_cache_dir"],
+                )
+            # images are loaded from the LoadData CSV given with `--data-file` (found in the input folder)
+            load_data = cp_loaddata.prepare_load_data(
+                path_to_images=path_to_images,
+                path_to_pipeline=illum_cache["path_to_pipeline"],
+                load_data_dir=load_data_dir,
+                path_to_skip_list=info.get("path_to_skip_list"),
+                illum_functions=illum_cache["illum_functions"],
+            )
+            image_set_counts[plate] = load_data["num_image_sets"]
+            load_data_csvs[plate] = load_data["path_to_csv"]
+            command = [
+                "cellprofiler",
+                "-c",
+                "-r",
+                "-p",
+                load_data["path_to_pipeline"],
+                "-o",
+                path_to_output,
+                "-i",
+                load_data["path_to_input"],
+                "--data-file",
+                load_data["path_to_csv"],
+            ]
+        else:
+            # image sets can only be left out of a run (and illumination functions loaded) through the LoadData CSV
+            if info.get("path_to_skip_list") is not None:
+                raise ValueError(f"A skip list was given for {plate}, which can only be used with use_load_data=True")
+            if info.get("illum_cache_dir") is not None or info.get("path_to_illum_pipeline") is not None:
+                raise ValueError(
+                    f"An illumination function cache was given for {plate}, which can only be used with use_load_data=True"
+                )
+            image_set_counts[plate] = cp_shards.count_image_sets(path_to_images)
+            load_data_csvs[plate] = None
+            command = [
+                "cellprofiler",
+                "-c",
+                "-r",
+                "-p",
+                path_to_pipeline,
+                "-o",
+                path_to_output,
+                "-i",
+                path_to_images,
+            ]
         # creates a list of commands
         commands.append(command)
 
-    # set the number of CPUs/workers as the number of commands
-    num_processes = len(commands)
+    # keep the command for each plate before any are split into shards
+    plate_commands = list(commands)
 
-    # make sure that the number of workers does not exceed the maximum number of workers for the machine
-    if num_processes > multiprocessing.cpu_count():
-        raise MaxWorkerError(
-            "Exception occurred: The number of commands exceeds the number of CPUs/workers. Please reduce the number of commands."
-        )
+    # set the number of workers to the number of CPUs on the machine unless specified
+    num_processes = max_workers or multiprocessing.cpu_count()
 
-    # set parallelization executer to the number of commands
-    executor = ProcessPoolExecutor(max_workers=num_processes)
+    if sharded:
+        # find the ranges of image sets per plate that have not been completed in a previous run
+        missing_ranges = {
+            plate: cp_manifest.missing_image_sets(
+                path_to_output=info["path_to_output"],
+                path_to_pipeline=info["path_to_pipeline"],
+                num_image_sets=image_set_counts[plate],
+                path_to_csv=load_data_csvs[plate],
+            )
+            for plate, info in plate_info_dictionary.items()
+        }
+        if shard_size is None:
+            shard_size = cp_shards.auto_shard_size(
+                image_set_counts=[
+                    last - first + 1
+                    for ranges in missing_ranges.values()
+                    for first, last in ranges
+                ],
+                num_workers=num_processes,
+            )
+        print(f"Running shards with {shard_size} image sets on {num_processes} workers")
 
-    # creates a list of futures that are each CellProfiler process for each plate
-    futures: List[Future] = [
-        executor.submit(
-            subprocess.run,
-            args=command,
-            capture_output=True,
+        # replace the command for each plate with a command for each shard of missing image sets using the first and last
+        # image set (which are the rows of the LoadData CSV)
+        shard_commands = []
+        for command, (plate, ranges) in zip(commands, missing_ranges.items()):
+            for range_first, range_last in ranges:
+                for first, last in cp_shards.create_image_set_shards(
+                    num_image_sets=range_last - range_first + 1, shard_size=shard_size
+                ):
+                    first, last = first + range_first - 1, last + range_first - 1
+                    shard_output = cp_shards.shard_output_path(command[6], first, last)
+                    # remove any partial outputs left from a shard that did not finish in a previous run
+                    if shard_output.exists():
+                        shutil.rmtree(shard_output)
+                    shard_output.mkdir(parents=True)
+                    shard_commands.append(
+                        command[:6] + [shard_output] + command[7:] + ["-f", str(first), "-l", str(last)]
+                    )
+            if not ranges:
+                print(f"All image sets have already been completed for {plate}!")
+        commands = shard_commands
+
+    # set the first and last image set for each command (all image sets for a plate unless sharded)
+    if sharded:
+        image_set_ranges = [(int(command[-3]), int(command[-1])) for command in commands]
+    else:
+        image_set_ranges = [(1, image_set_counts[plate]) for plate in plate_info_dictionary]
+
+    # the output from each plate (or shard) is written to its own log file while it runs, and the progress
+    # is written as events to one JSONL file for the run
+    unit_names = [plate_name_from_output(command[6]) for command in commands]
+    log_paths = [pathlib.Path(f"{log_dir}/{name}_{run_name}_run.log") for name in unit_names]
+    events_path = pathlib.Path(f"{log_dir}/{run_name}_progress_events.jsonl")
+    progress_monitor = cp_progress.ProgressMonitor(
+        unit_names=unit_names,
+        log_paths=log_paths,
+        image_set_ranges=image_set_ranges,
+        events_path=events_path,
+    )
+    print(f"Follow the progress of each plate in {events_path}")
+
+    # the resources used by each process are appended to the run ledger in the logs directory when it finishes
+    run_id = cp_ledger.create_run_id()
+    ledger_path = pathlib.Path(f"{log_dir}/{cp_ledger.LEDGER_NAME}")
+    # the hash of the original pipeline is recorded for the pipeline that loads images from the LoadData CSV
+    pipeline_hashes = {
+        str(command[4]): cp_manifest.pipeline_hash(info["path_to_pipeline"])
+        for command, info in zip(plate_commands, plate_info_dictionary.values())
+    }
+
+    def record_to_ledger(index: int, usage: dict) -> None:
+        first, last = image_set_ranges[index]
+        cp_ledger.record_run(
+            ledger_path=ledger_path,
+            run_id=run_id,
+            run_name=run_name,
+            unit_name=unit_names[index],
+            command=commands[index],
+            usage=usage,
+            num_image_sets=last - first + 1,
+            pipeline_sha256=pipeline_hashes[str(commands[index][4])],
         )
-        for command in commands
-    ]
 
-    # the list of CompletedProcesses holds all the information from the CellProfiler run
-    results: List[subprocess.CompletedProcess] = [future.result() for future in futures]
+    # the SQLite output of each plate (or shard) that completes is queued for conversion to Parquet right away,
+    # so converting the finished outputs overlaps with the CellProfiler processes that are still running
+    converter = (
+        cp_stream_convert.StreamingConverter(converted_dir=stream_convert_dir, max_workers=stream_convert_workers)
+        if stream_convert_dir is not None
+        else None
+    )
+
+    def on_finish(index: int, usage: dict) -> None:
+        record_to_ledger(index, usage)
+        first, last = image_set_ranges[index]
+        if converter is None or usage["returncode"] != 0 or last < first:
+            return
+        path_to_output = pathlib.Path(commands[index][6])
+        plate_output = path_to_output.parent.parent if path_to_output.parent.name == "shards" else path_to_output
+        converter.submit(plate=plate_output.name, path_to_output=path_to_output, first=first, last=last)
+
+    # the list of CompletedProcesses holds all the information from the CellProfiler run, where commands
+    # are queued and started when they fit within the CPU and memory budgets
+    if executor == "local":
+        executor_options = {
+            "max_workers": min(num_processes, len(commands)),
+            "memory_budget_gb": memory_budget_gb,
+            "memory_per_process_gb": memory_per_process_gb,
+            **(executor_options or {}),
+        }
+    elif executor == "batch":
+        executor_options = {"job_dir": pathlib.Path(f"{log_dir}/batch_jobs"), **(executor_options or {})}
+    results: List[subprocess.CompletedProcess] = cp_executors.run_commands(
+        commands=commands,
+        log_paths=log_paths,
+        executor=executor,
+        executor_options=executor_options,
+        progress_monitor=progress_monitor,
+        on_finish=on_finish,
+    )
+
+    # retry the plates (or shards) that failed for a reason that can pass on another attempt (e.g., running out of
+    # memory), waiting longer before each retry so that short-lived problems on the machine or cluster can clear
+    attempts = [1] * len(commands)
+    failures = {}
+    for retry in range(max_retries + 1):
+        retry_indices = []
+        for index, result in enumerate(results):
+            if result.returncode != 0:
+                failures[index] = cp_retry.classify_failure(
+                    returncode=result.returncode, log_path=log_paths[index]
+                )
+                if cp_retry.is_retryable(failures[index]):
+                    retry_indices.append(index)
+        if retry == max_retries or not retry_indices:
+            break
+
+        wait_seconds = cp_retry.backoff_seconds(attempt=retry + 1, base_seconds=retry_backoff_seconds)
+        print(f"Retrying {len(retry_indices)} failed runs in {wait_seconds:.0f} seconds (retry {retry + 1} of {max_retries})")
+        time.sleep(wait_seconds)
+        for index in retry_indices:
+            # keep the log from the failed attempt and remove the partial outputs of a failed shard
+            log_paths[index].replace(
+                log_paths[index].with_name(f"{log_paths[index].stem}_attempt_{attempts[index]}.log")
+            )
+            if sharded:
+                shutil.rmtree(commands[index][6])
+                pathlib.Path(commands[index][6]).mkdir(parents=True)
+            attempts[index] += 1
+
+        retry_results = cp_executors.run_commands(
+            commands=[commands[index] for index in retry_indices],
+            log_paths=[log_paths[index] for index in retry_indices],
+            executor=executor,
+            executor_options=executor_options,
+            progress_monitor=cp_progress.ProgressMonitor(
+                unit_names=[unit_names[index] for index in retry_indices],
+                log_paths=[log_paths[index] for index in retry_indices],
+                image_set_ranges=[image_set_ranges[index] for index in retry_indices],
+                events_path=events_path,
+            ),
+            on_finish=lambda retry_index, usage: on_finish(retry_indices[retry_index], usage),
+        )
+        for index, result in zip(retry_indices, retry_results):
+            results[index] = result
 
     print("All processes have been completed!")
 
-    # for each process, confirm that the process completed succesfully and return a log file
+    # list the plates (or shards) that failed at least once and if they completed on a retry
+    failure_summary_path = pathlib.Path(f"{log_dir}/{run_name}_failure_summary.txt")
+    failure_summary_path.unlink(missing_ok=True)
+    if failures:
+        failure_summary = cp_retry.summarize_failures(
+            [
+                {
+                    "unit": unit_names[index],
+                    "attempts": attempts[index],
+                    "failure": failure,
+                    "returncode": results[index].returncode,
+                    "completed": results[index].returncode == 0,
+                }
+                for index, failure in failures.items()
+            ]
+        )
+        failure_summary_path.write_text(failure_summary + "\n")
+        print(failure_summary)
+
+    # add a summary of each process to the log files
+    results_to_log(results=results, log_dir=log_dir, run_name=run_name)
+
+    # for each process, confirm that the process completed succesfully
     for result in results:
-        plate_name = result.args[6].name
-        # convert the results into log files
-        results_to_log(results=results, log_dir=log_dir, run_name=run_name)
-        if result.returncode == 1:
+        plate_name = plate_name_from_output(result.args[6])
+        if result.returncode != 0:
             print(
                 f"A return code of {result.returncode} was returned for {plate_name}, which means there was an error in the CellProfiler run."
             )
 
     # to avoid having multiple print statements due to for loop, confirmation that logs are converted is printed here
     print("All results have been converted to log files!")
+
+    # the conversions must finish before the shard outputs they read from are merged and removed
+    if converter is not None:
+        for error in converter.wait():
+            print(error)
+        print(f"All completed outputs have been converted to Parquet in {stream_convert_dir}!")
+
+    # record the completed image sets in the run manifest for each plate, merging the outputs of the shards that
+    # completed successfully into the plate output directory (shards that failed are run again in the next run)
+    for plate, info in plate_info_dictionary.items():
+        plate_results = [
+            (result, image_set_range)
+            for result, image_set_range in zip(results, image_set_ranges)
+            if pathlib.Path(result.args[6]) == pathlib.Path(info["path_to_output"]).resolve()
+            or pathlib.Path(result.args[6]).parent.parent == pathlib.Path(info["path_to_output"]).resolve()
+        ]
+        completed = [
+            (result, image_set_range)
+            for result, image_set_range in plate_results
+            if result.returncode == 0
+        ]
+        if sharded and completed:
+            cp_shards.merge_shard_outputs(
+                path_to_output=info["path_to_output"],
+                shard_dirs=[result.args[6] for result, _ in completed],
+            )
+        for _, (first, last) in completed:
+            if last < first:
+                continue
+            cp_manifest.record_completed_image_sets(
+                path_to_output=info["path_to_output"],
+                path_to_pipeline=info["path_to_pipeline"],
+                first=first,
+                last=last,
+                path_to_csv=load_data_csvs[plate],
+                num_image_sets=image_set_counts[plate],
+            )
+        if len(completed) < len(plate_results):
+            print(
+                f"{len(plate_results) - len(completed)} of {len(plate_results)} runs did not complete for {pathlib.Path(info['path_to_output']).name}, so those image sets will be run again in the next run."
+            )
@@ -0,0 +1,168 @@
+"""
+This collection of functions follows the log files from running CellProfiler processes, parsing the image set
+progress lines to report the throughput, ETA, and completion of each plate (or shard) as a JSONL event stream.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+import json
+import pathlib
+import re
+import time
+
+# CellProfiler reports progress either as "image set N of M" or as a line per module for each image set
+# (e.g., "Image # 5, module IdentifyPrimaryObjects # 5: CPU_time = 1.25 secs, Wall_time = 1.30 secs")
+IMAGE_SET_OF_TOTAL_PATTERN = re.compile(r"[Ii]mage set #?\s*(\d+) of (\d+)")
+IMAGE_NUMBER_PATTERN = re.compile(r"Image #\s*(\d+), module")
+
+
+def parse_progress_line(line: str) -> Optional[Tuple[int, Optional[int]]]:
+    """Find the image set number (and total image sets if reported) from a line of CellProfiler output.
+
+    Args:
+        line (str): line of CellProfiler output
+
+    Returns:
+        Optional[Tuple[int, Optional[int]]]: image set number and total image sets (None when not reported), or
+        None if the line does not report progress
+    """
+    match = IMAGE_SET_OF_TOTAL_PATTERN.search(line)
+    if match:
+        return int(match.group(1)), int(match.group(2))
+    match = IMAGE_NUMBER_PATTERN.search(line)
+    if match:
+        return int(match.group(1)), None
+    return None
+
+
+class ProgressMonitor:
+    """
+    Follow the log file for each CellProfiler process while it runs and write progress events to a JSONL file.
+    Each event is one JSON object with the event type ("start", "progress", "stalled", or "finish"), the name of
+    the plate or shard, and the time of the event.
+    """
+
+    def __init__(
+        self,
+        unit_names: List[str],
+        log_paths: List[pathlib.Path],
+        image_set_ranges: List[Tuple[int, int]],
+        events_path: pathlib.Path,
+        stall_seconds: float = 900.0,
+    ):
+        """
+        Args:
+            unit_names (List[str]): name of each plate or shard in the same order as the commands
+            log_paths (List[pathlib.Path]): path to the log file for each plate or shard
+            image_set_ranges (List[Tuple[int, int]]): first and last image set for each plate or shard
+            events_path (pathlib.Path): path to the JSONL file for the progress events (appended to)
+            stall_seconds (float, optional): seconds without progress before a "stalled" event is written (default is 900)
+        """
+        self.unit_names = unit_names
+        self.log_paths = log_paths
+        self.image_set_ranges = image_set_ranges
+        self.events_path = pathlib.Path(events_path)
+        self.stall_seconds = stall_seconds
+        # progress state for each running plate or shard by index
+        self.states: Dict[int, dict] = {}
+
+    def write_event(self, event: str, index: int, **fields) -> None:
+        """Append an event for a plate or shard to the JSONL file."""
+        record = {"event": event, "unit": self.unit_names[index], "time": time.time()}
+        record.update(fields)
+        with open(self.events_path, "a") as events_file:
+            events_file.write(json.dumps(record) + "\n")
+
+    def start(self, index: int, pid: Optional[int] = None) -> None:
+        """Start following the log file for a process that was just started (or submitted to a cluster, where the
+        log file is opened once the process starts writing to it)."""
+        first, last = self.image_set_ranges[index]
+        self.states[index] = {
+            "log_file": None,
+            "partial_line": "",
+            "start_time": time.time(),
+            "first_progress_time": None,
+            "last_progress_time": time.time(),
+            "image_set": None,
+            "total": last - first + 1,
+            "stalled": False,
+        }
+        self.write_event(
+            "start",
+            index,
+            pid=pid,
+            log_path=str(self.log_paths[index]),
+            first_image_set=first,
+            last_image_set=last,
+            total_image_sets=last - first + 1,
+        )
+
+    def read_progress(self, index: int) -> None:
+        """Read the new lines in the log file for a process and write an event when a new image set is started."""
+        state = self.states[index]
+        first, _ = self.image_set_ranges[index]
+        if state["log_file"] is None:
+            if not self.log_paths[index].exists():
+                return
+            state["log_file"] = open(self.log_paths[index], "r", errors="replace")
+        lines = (state["partial_line"] + state["log_file"].read()).split("\n")
+        # the last item is an incomplete line (or empty) that is read again with the next output
+        state["partial_line"] = lines.pop()
+
+        for line in lines:
+            progress = parse_progress_line(line)
+            if progress is None or progress[0] == state["image_set"]:
+                continue
+            image_set, total = progress
+            now = time.time()
+            if total is not None:
+                state["total"] = total
+            if state["first_progress_time"] is None:
+                state["first_progress_time"] = now
+            state["image_set"] = image_set
+            state["last_progress_time"] = now
+            state["stalled"] = False
+
+            # all image sets before the current one are completed
+            completed = max(0, image_set - first)
+            elapsed = now - state["first_progress_time"]
+            images_per_sec = completed / elapsed if elapsed > 0 and completed else None
+            remaining = max(0, state["total"] - completed)
+            self.write_event(
+                "progress",
+                index,
+                image_set=image_set,
+                completed_image_sets=completed,
+                total_image_sets=state["total"],
+                percent_complete=round(100 * completed / state["total"], 2) if state["total"] else None,
+                images_per_sec=round(images_per_sec, 4) if images_per_sec else None,
+                eta_seconds=round(remaining / images_per_sec, 1) if images_per_sec else None,
+            )
+
+    def update(self) -> None:
+        """Read new progress from all running processes and write a "stalled" event for any without progress."""
+        for index, state in self.states.items():
+            self.read_progress(index)
+            stalled_for = time.time() - state["last_progress_time"]
+            if not state["stalled"] and stalled_for > self.stall_seconds:
+                state["stalled"] = True
+                self.write_event(
+                    "stalled", index, image_set=state["image_set"], seconds_without_progress=round(stalled_for, 1)
+                )
+
+    def finish(self, index: int, returncode: int) -> None:
+        """Read the rest of the log file for a process that finished and write the "finish" event."""
+        self.read_progress(index)
+        state = self.states.pop(index)
+        if state["log_file"] is not None:
+            state["log_file"].close()
+        self.write_event(
+            "finish",
+            index,
+            returncode=returncode,
+            completed=returncode == 0,
+            elapsed_seconds=round(time.time() - state["start_time"], 1),
+            total_image_sets=state["total"],
+        )
@@ -0,0 +1,109 @@
+"""
+This collection of functions finds why a CellProfiler process failed from its return code and the error messages
+in its log file, which is used to retry plates (or shards) that failed for reasons that can pass on another attempt
+(e.g., running out of memory) and to report a summary of the failures.
+
+Batch jobs that leave the queue without finishing (see `cp_executors.run_commands_batch`) have the state of the job
+from the batch scheduler written to their log file, so these are classified from the log file like the other failures.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import List
+import pathlib
+import re
+
+# message written to the log file of a batch job that left the queue without finishing the CellProfiler run
+LOST_JOB_MESSAGE = "left the queue without finishing the CellProfiler run"
+
+# error messages in the CellProfiler output for each type of failure, which are checked in this order, where the
+# states of batch jobs that left the queue are from the batch scheduler (e.g., SLURM)
+FAILURE_SIGNATURES = {
+    "java_heap": re.compile(r"java\.lang\.OutOfMemoryError|Java heap space|GC overhead limit exceeded"),
+    "out_of_memory": re.compile(
+        r"\bMemoryError\b|Unable to allocate|Cannot allocate memory|scheduler state: OUT_OF_MEMORY"
+    ),
+    "missing_file": re.compile(r"FileNotFoundError|\[Errno 2\] No such file or directory"),
+    "database_locked": re.compile(r"database is locked|disk I/O error"),
+    "timeout": re.compile(r"scheduler state: (TIMEOUT|DEADLINE)"),
+    "lost": re.compile(re.escape(LOST_JOB_MESSAGE)),
+}
+
+# return codes of processes that were stopped by a signal (negative) or by the shell (128 + signal)
+SIGNAL_FAILURES = {-9: "killed", 137: "killed", -11: "segfault", 139: "segfault", -15: "terminated", 143: "terminated"}
+
+# failures that can pass on another attempt (e.g., when other processes have finished and freed memory), where every
+# other failure (e.g., a missing image, a segfault, or an error in a pipeline module) will happen again on every
+# attempt, so it is not retried. Batch jobs that went over the time limit ("timeout") will go over it again, while jobs
+# that left the queue for other reasons ("lost", e.g., the node failed or the job was preempted) are retried
+RETRYABLE_FAILURES = ("java_heap", "out_of_memory", "database_locked", "killed", "terminated", "lost")
+
+
+def classify_failure(returncode: int, log_path: pathlib.Path) -> str:
+    """Find the type of failure for a CellProfiler process from the error messages in its log file, or from the
+    return code if it was stopped by a signal (e.g., killed by the kernel when the machine ran out of memory).
+
+    Args:
+        returncode (int): return code of the process
+        log_path (pathlib.Path): path to the log file with the CellProfiler output
+
+    Returns:
+        str: type of failure (a key of FAILURE_SIGNATURES or SIGNAL_FAILURES), or "error" if it is not known
+    """
+    if pathlib.Path(log_path).exists():
+        with open(log_path, "r", errors="replace") as log_file:
+            log_text = log_file.read()
+        for failure, signature in FAILURE_SIGNATURES.items():
+            if signature.search(log_text):
+                return failure
+    return SIGNAL_FAILURES.get(returncode, "error")
+
+
+def is_retryable(failure: str) -> bool:
+    """Check if a type of failure could pass when the process is run again, where failures that are not known
+    ("error") are not retried.
+
+    Args:
+        failure (str): type of failure from `classify_failure`
+
+    Returns:
+        bool: True if the process should be retried
+    """
+    return failure in RETRYABLE_FAILURES
+
+
+def backoff_seconds(attempt: int, base_seconds: float, max_seconds: float = 3600.0) -> float:
+    """Find how long to wait before a retry, which doubles with each attempt.
+
+    Args:
+        attempt (int): number of the retry (starting at 1)
+        base_seconds (float): seconds to wait before the first retry
+        max_seconds (float, optional): longest time to wait before a retry (default is 3600)
+
+    Returns:
+        float: seconds to wait before the retry
+    """
+    return min(base_seconds * 2 ** (attempt - 1), max_seconds)
+
+
+def summarize_failures(failures: List[dict]) -> str:
+    """Create a summary table of the plates (or shards) that failed at least once during a run.
+
+    Args:
+        failures (List[dict]): one record per plate or shard with the name ("unit"), number of attempts
+        ("attempts"), type of the last failure ("failure"), last return code ("returncode"), and if it
+        completed on a retry ("completed")
+
+    Returns:
+        str: summary table with one row per plate or shard
+    """
+    header = f"{'unit':<45} {'attempts':>8} {'failure':<16} {'returncode':>10} {'status':<10}"
+    lines = [header, "-" * len(header)]
+    for failure in failures:
+        status = "recovered" if failure["completed"] else "failed"
+        lines.append(
+            f"{failure['unit']:<45} {failure['attempts']:>8} {failure['failure']:<16} "
+            f"{failure['returncode']:>10} {status:<10}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,181 @@
+"""
+This collection of functions queues CellProfiler commands and starts them when there are enough CPUs and memory
+available, watching the memory (RSS) of the running processes so the machine does not start swapping.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Callable, List, Optional
+import collections
+import multiprocessing
+import pathlib
+import subprocess
+import tempfile
+import time
+
+# psutil is installed with CellProfiler
+import psutil
+
+import cp_ledger
+import cp_progress
+
+# number of bytes in a gigabyte to convert the memory budget
+BYTES_PER_GB = 1024**3
+
+
+def process_tree_rss(process: psutil.Process) -> int:
+    """Find the total resident memory (RSS) of a process and all of its child processes.
+
+    Args:
+        process (psutil.Process): process to measure
+
+    Returns:
+        int: resident memory in bytes (0 if the process has already exited)
+    """
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    rss = 0
+    for tree_process in processes:
+        try:
+            rss += tree_process.memory_info().rss
+        except psutil.NoSuchProcess:
+            continue
+    return rss
+
+
+def run_commands_with_budget(
+    commands: List[list],
+    max_workers: Optional[int] = None,
+    memory_budget_gb: Optional[float] = None,
+    memory_per_process_gb: float = 4.0,
+    memory_reserve_gb: float = 2.0,
+    poll_interval: float = 5.0,
+    log_paths: Optional[List[pathlib.Path]] = None,
+    progress_monitor: Optional[cp_progress.ProgressMonitor] = None,
+    on_finish: Optional[Callable[[int, dict], None]] = None,
+) -> List[subprocess.CompletedProcess]:
+    """Run commands from a queue, only starting a new process when it fits within the CPU and memory budgets.
+    The memory needed for a new process is estimated as the largest peak RSS of any finished process (using
+    `memory_per_process_gb` until one finishes), so the estimate adjusts to the pipeline that is being run.
+    At least one process is always running so that the queue cannot stall.
+
+    Args:
+        commands (List[list]): commands to run in the order they are queued
+        max_workers (int, optional): maximum number of processes to run at once (defaults to the number of CPUs)
+        memory_budget_gb (float, optional): maximum total RSS in GB for all running processes (defaults to 80%
+        of the total memory on the machine)
+        memory_per_process_gb (float, optional): starting estimate of RSS in GB for one process (default is 4.0)
+        memory_reserve_gb (float, optional): memory in GB that must stay available on the machine after starting a
+        process (default is 2.0)
+        poll_interval (float, optional): seconds between checks of the running processes (default is 5.0)
+        log_paths (List[pathlib.Path], optional): path to a log file for each command that the output is written
+        to while the process runs, otherwise the output is returned as the stderr of each result (default is None)
+        progress_monitor (cp_progress.ProgressMonitor, optional): monitor that follows the log files of running
+        processes to report progress, which needs `log_paths` (default is None)
+        on_finish (Callable[[int, dict], None], optional): function called with the index of each command that finishes
+        and its resource usage (see `cp_ledger.usage_from_rusage`), such as to record the process in the run ledger
+        (default is None)
+
+    Returns:
+        List[subprocess.CompletedProcess]: completed processes in the same order as the commands
+    """
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    if memory_budget_gb is None:
+        memory_budget_gb = 0.8 * psutil.virtual_memory().total / BYTES_PER_GB
+
+    memory_budget = memory_budget_gb * BYTES_PER_GB
+    memory_reserve = memory_reserve_gb * BYTES_PER_GB
+    finished_peak_rss = 0
+
+    queue = collections.deque(enumerate(commands))
+    # running processes are tracked by index as (Popen, psutil.Process, output file, peak RSS)
+    running = {}
+    # time each process started by index
+    started_at = {}
+    results: List[Optional[subprocess.CompletedProcess]] = [None] * len(commands)
+
+    while queue or running:
+        # update the peak RSS of each running process and collect finished processes
+        for index in list(running):
+            popen, process, output_file, peak_rss = running[index]
+            peak_rss = max(peak_rss, process_tree_rss(process))
+            running[index] = (popen, process, output_file, peak_rss)
+
+            # the resource usage (e.g., CPU time) of the process and its children is collected when it finishes
+            rusage = cp_ledger.poll_with_rusage(popen)
+            if rusage is not None:
+                finished_peak_rss = max(finished_peak_rss, peak_rss)
+                # the output is only kept in memory when it is not written to a log file
+                output = None
+                if log_paths is None:
+                    output_file.seek(0)
+                    output = output_file.read()
+                output_file.close()
+                results[index] = subprocess.CompletedProcess(
+                    args=popen.args,
+                    returncode=popen.returncode,
+                    stdout=None,
+                    stderr=output,
+                )
+                del running[index]
+                if progress_monitor is not None:
+                    progress_monitor.finish(index, popen.returncode)
+                if on_finish is not None:
+                    on_finish(
+                        index,
+                        cp_ledger.usage_from_rusage(
+                            rusage=rusage,
+                            returncode=popen.returncode,
+                            started_at=started_at[index],
+                            wall_seconds=time.time() - started_at[index],
+                            peak_rss_bytes=peak_rss,
+                        ),
+                    )
+
+        if progress_monitor is not None:
+            progress_monitor.update()
+
+        # processes that are still running can already use more memory than the estimate
+        memory_estimate = max(
+            finished_peak_rss or memory_per_process_gb * BYTES_PER_GB,
+            max((peak_rss for *_, peak_rss in running.values()), default=0),
+        )
+
+        # start processes from the queue while they fit in the CPU and memory budgets
+        while queue and len(running) < max_workers:
+            # running processes are expected to grow to the estimate, so that memory is held back for them
+            running_peaks = [peak_rss for *_, peak_rss in running.values()]
+            reserved_rss = sum(max(peak_rss, memory_estimate) for peak_rss in running_peaks)
+            expected_growth = sum(max(0, memory_estimate - peak_rss) for peak_rss in running_peaks)
+            available_memory = psutil.virtual_memory().available - expected_growth
+            fits_budget = reserved_rss + memory_estimate <= memory_budget
+            fits_machine = available_memory - memory_estimate >= memory_reserve
+            if running and not (fits_budget and fits_machine):
+                break
+
+            index, command = queue.popleft()
+            # CellProfiler output is written to a file instead of a pipe so a full pipe buffer can not block the process
+            if log_paths is not None:
+                output_file = open(log_paths[index], "wb")
+            else:
+                output_file = tempfile.TemporaryFile()
+            started_at[index] = time.time()
+            popen = subprocess.Popen(
+                [str(argument) for argument in command],
+                stdout=output_file,
+                stderr=subprocess.STDOUT,
+            )
+            # keep the original command as the args so the paths can be used for logging
+            popen.args = command
+            running[index] = (popen, psutil.Process(popen.pid), output_file, 0)
+            if progress_monitor is not None:
+                progress_monitor.start(index, popen.pid)
+
+        if running:
+            time.sleep(poll_interval)
+
+    return results
@@ -1,18 +1,26 @@
 """
 These collection of functions runs CellProfiler and renames the .sqlite outputs to any specified name if 
-running an analysis pipeline.
+running an analysis pipeline, which are then optimized for merging single cells (see `cp_sqlite`).
+The resources used by each run are recorded in the run ledger in the logs directory.
+Images are loaded from a LoadData CSV for each plate, which is cached in the load_data_csv directory.
 """
 
 # must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
 # by itself only works in Python 3.10
 from __future__ import annotations
-from typing import Optional
+from typing import Optional, Tuple
 import os
 import subprocess
 import pathlib
 
+import cp_ledger
+import cp_loaddata
+import cp_manifest
+import cp_shards
+import cp_sqlite
 
-def rename_sqlite_file(sqlite_dir_path: pathlib.Path, name: str):
+
+def rename_sqlite_file(sqlite_dir_path: pathlib.Path, name: str) -> pathlib.Path:
     """Rename the .sqlite file into {name}.sqlite as to differentiate between different files.
 
     Args:
@@ -22,6 +30,9 @@ def rename_sqlite_file(sqlite_dir_path: pathlib.Path, name: str):
     Raises:
         FileNotFoundError: This error will occur if no .sqlite file is found in the specified directory.
         This means that this function cannot find a file to rename, so it raises an error.
+
+    Returns:
+        pathlib.Path: path to the renamed SQLite file
     """
     try:
         # Find the first .sqlite file in the directory
@@ -33,6 +44,7 @@ def rename_sqlite_file(sqlite_dir_path: pathlib.Path, name: str):
         # Change the file name in the directory
         sqlite_file_path.rename(new_file_name)
         print(f"The file is renamed to {new_file_name.name}!")
+        return new_file_name
 
     except StopIteration:
         # Handle case where no .sqlite file is found
@@ -41,12 +53,57 @@ def rename_sqlite_file(sqlite_dir_path: pathlib.Path, name: str):
         )
 
 
+def create_command(
+    path_to_pipeline: pathlib.Path,
+    path_to_output: pathlib.Path,
+    path_to_images: pathlib.Path,
+    use_load_data: bool = True,
+) -> Tuple[list, int]:
+    """Create the CellProfiler command to run a pipeline on a directory of images.
+
+    Args:
+        path_to_pipeline (pathlib.Path): path to the CellProfiler .cppipe file
+        path_to_output (pathlib.Path): path to the output folder
+        path_to_images (pathlib.Path): path to the images
+        use_load_data (bool, optional): load the images from a LoadData CSV instead of having CellProfiler scan the
+        image directory (default is True)
+
+    Returns:
+        Tuple[list, int]: CellProfiler command and the number of image sets
+    """
+    if not use_load_data:
+        command = ["cellprofiler", "-c", "-r", "-p", path_to_pipeline, "-o", path_to_output, "-i", path_to_images]
+        return command, cp_shards.count_image_sets(path_to_images)
+
+    # images are loaded from the LoadData CSV given with `--data-file` (found in the input folder)
+    load_data = cp_loaddata.prepare_load_data(
+        path_to_images=path_to_images,
+        path_to_pipeline=path_to_pipeline,
+        load_data_dir=pathlib.Path("./load_data_csv"),
+    )
+    command = [
+        "cellprofiler",
+        "-c",
+        "-r",
+        "-p",
+        load_data["path_to_pipeline"],
+        "-o",
+        path_to_output,
+        "-i",
+        load_data["path_to_input"],
+        "--data-file",
+        load_data["path_to_csv"],
+    ]
+    return command, load_data["num_image_sets"]
+
+
 def run_cellprofiler(
     path_to_pipeline: str,
     path_to_output: str,
     path_to_images: str,
     sqlite_name: Optional[None | str] = None,
     analysis_run: Optional[False | bool] = False,
+    use_load_data: bool = True,
 ):
     """Run CellProfiler on data. It can be used for either a illumination correction pipeline (default) and analysis pipeline (when
     parameter is set to True).
@@ -58,6 +115,8 @@ def run_cellprofiler(
         sqlite_name (str, optional): string with name for SQLite file for an analysis pipeline if you plan on running
         multiple sets of images (e.g., per plate) so that the outputs will have different names (default is None)
         analysis_run (bool, optional): will use functions to complete an analysis pipeline (default is False)
+        use_load_data (bool, optional): load the images from a LoadData CSV instead of having CellProfiler scan the
+        image directory (default is True)
     """
     # check to make sure paths to pipeline and directory of images are correct before running the pipeline
     if not pathlib.Path(path_to_pipeline):
@@ -87,23 +146,25 @@ def run_cellprofiler(
             "w",
         ) as cellprofiler_output_file:
             # run CellProfiler for a illumination correction pipeline
-            command = [
-                "cellprofiler",
-                "-c",
-                "-r",
-                "-p",
-                path_to_pipeline,
-                "-o",
-                path_to_output,
-                "-i",
-                path_to_images,
-            ]
-            subprocess.run(
-                command,
+            command, num_image_sets = create_command(
+                path_to_pipeline=path_to_pipeline,
+                path_to_output=path_to_output,
+                path_to_images=path_to_images,
+                use_load_data=use_load_data,
+            )
+            # run CellProfiler and record the resources used in the run ledger
+            result = cp_ledger.run_and_record(
+                command=command,
+                ledger_path=pathlib.Path(f"logs/{cp_ledger.LEDGER_NAME}"),
+                run_name="illum_correction",
+                unit_name=pathlib.Path(path_to_images).name,
+                num_image_sets=num_image_sets,
+                pipeline_sha256=cp_manifest.pipeline_hash(path_to_pipeline),
                 stdout=cellprofiler_output_file,
                 stderr=cellprofiler_output_file,
-                check=True,
             )
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, command)
             print(
                 f"The CellProfiler run has been completed with {pathlib.Path(path_to_images).name}. Please check log file for any errors."
             )
@@ -128,29 +189,33 @@ def run_cellprofiler(
         with open(
             f"logs/cellprofiler_output_analysis_{sqlite_name}.log", "w"
         ) as cellprofiler_output_file:
-            command = [
-                "cellprofiler",
-                "-c",
-                "-r",
-                "-p",
-                path_to_pipeline,
-                "-o",
-                path_to_output,
-                "-i",
-                path_to_images,
-            ]
-            subprocess.run(
-                command,
+            command, num_image_sets = create_command(
+                path_to_pipeline=path_to_pipeline,
+                path_to_output=path_to_output,
+                path_to_images=path_to_images,
+                use_load_data=use_load_data,
+            )
+            # run CellProfiler and record the resources used in the run ledger
+            result = cp_ledger.run_and_record(
+                command=command,
+                ledger_path=pathlib.Path(f"logs/{cp_ledger.LEDGER_NAME}"),
+                run_name="analysis",
+                unit_name=sqlite_name,
+                num_image_sets=num_image_sets,
+                pipeline_sha256=cp_manifest.pipeline_hash(path_to_pipeline),
                 stdout=cellprofiler_output_file,
                 stderr=cellprofiler_output_file,
-                check=True,
             )
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, command)
             print(
                 f"The CellProfiler run has been completed with {pathlib.Path(path_to_images).name}. Please check log file for any errors."
             )
 
         if sqlite_name:
             # rename the outputted .sqlite file as a specified name (used when running multiple plates with same CP pipeline)
-            rename_sqlite_file(
+            sqlite_file_path = rename_sqlite_file(
                 sqlite_dir_path=pathlib.Path(path_to_output), name=sqlite_name
             )
+            # add the indexes and statistics used to merge single cells
+            cp_sqlite.optimize_sqlite_file(sqlite_file_path)
@@ -0,0 +1,233 @@
+"""
+This collection of functions splits a plate into ranges of image sets (shards) so that one plate can be run
+across multiple CellProfiler processes, and merges the outputs of each shard back into the per-plate layout.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time
+from __future__ import annotations
+from typing import List, Optional, Set, Tuple
+import math
+import pathlib
+import shutil
+import sqlite3
+
+import image_catalog
+
+# image file extensions that CellProfiler will load with the `Images` module rules used in our pipelines
+IMAGE_EXTENSIONS = (".tif", ".tiff", ".png", ".jpg", ".jpeg")
+
+# all of our pipelines create image sets with the "Order" matching method, where the first channel is DAPI
+IMAGE_SET_CHANNEL = "DAPI"
+
+# tables that hold experiment-level information which is the same across every shard of a plate
+EXPERIMENT_TABLES = ("Experiment", "Experiment_Properties")
+
+
+def is_skipped(image_path: pathlib.Path, skip_image_sets: Optional[Set[Tuple[str, int]]]) -> bool:
+    """Check if the image set of an image is in the QC skip list, using the well and site from the file name.
+
+    Args:
+        image_path (pathlib.Path): path to an image
+        skip_image_sets (Set[Tuple[str, int]], optional): well and site of image sets to skip
+
+    Returns:
+        bool: True if the image belongs to an image set in the skip list
+    """
+    if not skip_image_sets:
+        return False
+    match = image_catalog.IMAGE_NAME_PATTERN.search(pathlib.Path(image_path).name)
+    return match is not None and (match.group("well"), int(match.group("site"))) in skip_image_sets
+
+
+def count_image_sets(
+    path_to_images: pathlib.Path,
+    channel: str = IMAGE_SET_CHANNEL,
+    skip_image_sets: Optional[Set[Tuple[str, int]]] = None,
+) -> int:
+    """Count the number of image sets that CellProfiler will create for a directory of images. Since all of our
+    pipelines match images by order, there is one image set per image from the first channel (DAPI).
+
+    Args:
+        path_to_images (pathlib.Path): path to the directory with images for a plate
+        channel (str, optional): string in the file name that identifies the first channel (defaults to "DAPI")
+        skip_image_sets (Set[Tuple[str, int]], optional): well and site of image sets that are left out of the
+        LoadData CSV and are not counted (default is None)
+
+    Returns:
+        int: number of image sets for the plate
+    """
+    return sum(
+        1
+        for image_path in pathlib.Path(path_to_images).rglob("*")
+        # ignore hidden directories like the `Images` module rule in the pipelines
+        if not any(part.startswith(".") for part in image_path.parts[-2:])
+        and image_path.suffix.lower() in IMAGE_EXTENSIONS
+        and channel in image_path.name
+        and not is_skipped(image_path, skip_image_sets)
+    )
+
+
+def create_image_set_shards(num_image_sets: int, shard_size: int) -> List[Tuple[int, int]]:
+    """Split the image sets of a plate into inclusive ranges (first, last) using 1-based image set numbers,
+    which is what CellProfiler expects for the `-f` (first image set) and `-l` (last image set) options.
+
+    Args:
+        num_image_sets (int): total number of image sets for the plate
+        shard_size (int): maximum number of image sets in each shard
+
+    Returns:
+        List[Tuple[int, int]]: list of the first and last image set for each shard
+    """
+    if shard_size < 1:
+        raise ValueError(f"The shard size must be at least 1, but {shard_size} was given.")
+
+    return [
+        (first, min(first + shard_size - 1, num_image_sets))
+        for first in range(1, num_image_sets + 1, shard_size)
+    ]
+
+
+def auto_shard_size(image_set_counts: List[int], num_workers: int) -> int:
+    """Find a shard size that spreads all image sets across plates evenly over the workers.
+
+    Args:
+        image_set_counts (List[int]): number of image sets for each plate
+        num_workers (int): number of CellProfiler processes that can run at once
+
+    Returns:
+        int: number of image sets per shard
+    """
+    total_image_sets = sum(image_set_counts)
+    return max(1, math.ceil(total_image_sets / max(1, num_workers)))
+
+
+def shard_output_path(path_to_output: pathlib.Path, first: int, last: int) -> pathlib.Path:
+    """Create the path for the output of a shard, which is within a `shards` folder in the plate output directory.
+
+    Args:
+        path_to_output (pathlib.Path): path to the output directory for the plate
+        first (int): first image set in the shard
+        last (int): last image set in the shard
+
+    Returns:
+        pathlib.Path: path to the output directory for the shard
+    """
+    return pathlib.Path(path_to_output) / "shards" / f"image_sets_{first:05d}_{last:05d}"
+
+
+def merge_sqlite_files(shard_sqlite_paths: List[pathlib.Path], merged_path: pathlib.Path) -> None:
+    """Merge the SQLite files from `ExportToDatabase` of each shard into one SQLite file. CellProfiler keeps the
+    image set number as the `ImageNumber` when using the first/last image set options, so rows from each shard
+    are appended as is. Experiment tables are the same across shards, so only the first shard is kept.
+    If the merged file already exists (e.g., when resuming a plate), all shards are appended to it.
+
+    Args:
+        shard_sqlite_paths (List[pathlib.Path]): paths to the SQLite file of each shard in image set order
+        merged_path (pathlib.Path): path to the merged SQLite file
+
+    Raises:
+        ValueError: if the same ImageNumber is found in more than one shard
+    """
+    # the first shard holds the schema and experiment tables that all other shards append to
+    if not merged_path.exists():
+        shutil.copyfile(shard_sqlite_paths[0], merged_path)
+        shard_sqlite_paths = shard_sqlite_paths[1:]
+
+    with sqlite3.connect(merged_path) as connection:
+        table_names = [
+            row[0]
+            for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+            if row[0] not in EXPERIMENT_TABLES
+        ]
+        for shard_sqlite_path in shard_sqlite_paths:
+            connection.execute("ATTACH DATABASE ? AS shard", (str(shard_sqlite_path),))
+            # confirm that image numbers do not overlap before appending the rows
+            if "Per_Image" in table_names:
+                overlap = connection.execute(
+                    "SELECT COUNT(*) FROM shard.Per_Image WHERE ImageNumber IN (SELECT ImageNumber FROM main.Per_Image)"
+                ).fetchone()[0]
+                if overlap:
+                    raise ValueError(
+                        f"{overlap} image number(s) in {shard_sqlite_path} are already in {merged_path.name}."
+                    )
+            for table_name in table_names:
+                connection.execute(
+                    f'INSERT INTO main."{table_name}" SELECT * FROM shard."{table_name}"'
+                )
+            connection.commit()
+            connection.execute("DETACH DATABASE shard")
+
+
+def merge_csv_files(shard_csv_paths: List[pathlib.Path], merged_path: pathlib.Path) -> None:
+    """Merge the CSV files from `ExportToSpreadsheet` of each shard into one CSV file, keeping only one header.
+    Experiment CSV files are the same across shards, so only the first shard is kept. If the merged file already
+    exists (e.g., when resuming a plate), the rows from all shards are appended to it.
+
+    Args:
+        shard_csv_paths (List[pathlib.Path]): paths to the CSV file of each shard in image set order
+        merged_path (pathlib.Path): path to the merged CSV file
+    """
+    merged_exists = merged_path.exists()
+    if merged_path.name.endswith("Experiment.csv"):
+        if not merged_exists:
+            shutil.copyfile(shard_csv_paths[0], merged_path)
+        return
+
+    with open(merged_path, "a", newline="") as merged_file:
+        for index, shard_csv_path in enumerate(shard_csv_paths):
+            with open(shard_csv_path, newline="") as shard_file:
+                header = shard_file.readline()
+                # only write the header from the first shard when creating the merged file
+                if index == 0 and not merged_exists:
+                    merged_file.write(header)
+                shutil.copyfileobj(shard_file, merged_file)
+
+
+def merge_shard_outputs(
+    path_to_output: pathlib.Path, shard_dirs: Optional[List[pathlib.Path]] = None
+) -> None:
+    """Merge the outputs of shards for a plate into the plate output directory, so it has the same layout as a
+    plate that was run by one CellProfiler process. SQLite and CSV files are combined (appending to any outputs
+    already in the plate output directory), and all other files (e.g., corrected images, illumination functions)
+    are moved into the plate output directory.
+
+    Args:
+        path_to_output (pathlib.Path): path to the output directory for the plate
+        shard_dirs (List[pathlib.Path], optional): output directories of the shards to merge (defaults to all shards)
+    """
+    shards_dir = pathlib.Path(path_to_output) / "shards"
+    if shard_dirs is None:
+        shard_dirs = [path for path in shards_dir.iterdir() if path.is_dir()]
+    # the zero-padded shard folder names keep the shards in image set order
+    shard_dirs = sorted(pathlib.Path(shard_dir) for shard_dir in shard_dirs)
+
+    # group files with the same relative path across shards
+    shard_files = {}
+    for shard_dir in shard_dirs:
+        for file_path in sorted(shard_dir.rglob("*")):
+            if file_path.is_file():
+                shard_files.setdefault(file_path.relative_to(shard_dir), []).append(
+                    file_path
+                )
+
+    for relative_path, file_paths in shard_files.items():
+        merged_path = pathlib.Path(path_to_output) / relative_path
+        merged_path.parent.mkdir(parents=True, exist_ok=True)
+        if relative_path.suffix == ".sqlite":
+            merge_sqlite_files(shard_sqlite_paths=file_paths, merged_path=merged_path)
+        elif relative_path.suffix == ".csv":
+            merge_csv_files(shard_csv_paths=file_paths, merged_path=merged_path)
+        else:
+            # per image outputs only exist in one shard, so any files written by every shard are kept from the first
+            shutil.move(str(file_paths[0]), str(merged_path))
+
+    # remove the shard outputs now that they have been merged into the plate output directory
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+    if not any(shards_dir.iterdir()):
+        shards_dir.rmdir()
+    print(
+        f"Merged the outputs from {len(shard_dirs)} shards into {pathlib.Path(path_to_output).name}!"
+    )
@@ -0,0 +1,141 @@
+"""
+This collection of functions turns the whole image QC metrics (from `1.evaluate_qc`) into a skip list for each plate
+with the image sets (well and site) that fail the blur or saturation thresholds, so these image sets are removed from
+the LoadData CSV and never run through segmentation and feature extraction.
+
+The thresholds are calculated in `1.evaluate_qc` from the QC metrics (2 standard deviations from the mean across
+plates 3 to 5, rounded to the second decimal like the FlagImage module in the illumination correction pipeline) and
+saved to a JSON file, which is read to create the skip lists.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Dict, Set, Tuple
+import json
+import pathlib
+
+import pandas as pd
+
+
+def save_qc_thresholds(
+    thresholds_path: pathlib.Path,
+    blur_minimum: float,
+    blur_maximum: float,
+    saturation_maximum: float,
+) -> Dict[str, float]:
+    """Save the QC thresholds calculated in 1.evaluate_qc, rounded to the second decimal, to a JSON file.
+
+    Args:
+        thresholds_path (pathlib.Path): path to save the thresholds JSON file
+        blur_minimum (float): PowerLogLogSlope values below this are out of focus
+        blur_maximum (float): PowerLogLogSlope values above this are empty
+        saturation_maximum (float): PercentMaximal values above this are over saturated or have large artifacts
+
+    Returns:
+        Dict[str, float]: thresholds that were saved
+    """
+    thresholds = {
+        "blur_minimum": round(float(blur_minimum), 2),
+        "blur_maximum": round(float(blur_maximum), 2),
+        "saturation_maximum": round(float(saturation_maximum), 2),
+    }
+    with open(thresholds_path, "w") as thresholds_file:
+        json.dump(thresholds, thresholds_file, indent=4)
+    return thresholds
+
+
+def load_qc_thresholds(thresholds_path: pathlib.Path) -> Dict[str, float]:
+    """Load the QC thresholds saved by 1.evaluate_qc.
+
+    Args:
+        thresholds_path (pathlib.Path): path to the thresholds JSON file
+
+    Returns:
+        Dict[str, float]: blur minimum ("blur_minimum"), blur maximum ("blur_maximum"), and saturation maximum
+        ("saturation_maximum")
+    """
+    with open(thresholds_path, "r") as thresholds_file:
+        return json.load(thresholds_file)
+
+
+def flag_image_sets(
+    qc_df: pd.DataFrame,
+    blur_minimum: float,
+    blur_maximum: float,
+    saturation_maximum: float,
+) -> pd.DataFrame:
+    """Find the image sets where any channel fails the blur or saturation thresholds.
+
+    Args:
+        qc_df (pd.DataFrame): QC metrics with one row per image (channel) and the Metadata_Plate, Metadata_Well,
+        Metadata_Site, ImageQuality_PowerLogLogSlope, and ImageQuality_PercentMaximal columns
+        blur_minimum (float): PowerLogLogSlope values below this are out of focus
+        blur_maximum (float): PowerLogLogSlope values above this are empty
+        saturation_maximum (float): PercentMaximal values above this are over saturated or have large artifacts
+
+    Returns:
+        pd.DataFrame: one row per flagged image set with the plate, well, site, and the reasons it was flagged
+    """
+    qc_df = qc_df.assign(
+        blurry=(qc_df["ImageQuality_PowerLogLogSlope"] < blur_minimum)
+        | (qc_df["ImageQuality_PowerLogLogSlope"] > blur_maximum),
+        saturated=qc_df["ImageQuality_PercentMaximal"] > saturation_maximum,
+    )
+    # an image set is flagged if any of its channels fail, like "Flag if any fail" in the FlagImage module
+    flagged = (
+        qc_df.groupby(["Metadata_Plate", "Metadata_Well", "Metadata_Site"])[["blurry", "saturated"]]
+        .any()
+        .reset_index()
+    )
+    flagged = flagged[flagged["blurry"] | flagged["saturated"]].copy()
+    flagged["Metadata_Site"] = flagged["Metadata_Site"].astype(int)
+
+    return flagged.sort_values(["Metadata_Plate", "Metadata_Well", "Metadata_Site"]).reset_index(drop=True)
+
+
+def create_skip_lists(
+    qc_path: pathlib.Path,
+    thresholds_path: pathlib.Path,
+    output_dir: pathlib.Path,
+) -> Dict[str, pathlib.Path]:
+    """Create a skip list CSV for each plate in the QC metrics, with the image sets that fail the QC thresholds.
+
+    Args:
+        qc_path (pathlib.Path): path to the QC metrics from 1.evaluate_qc (concat_img_quality_data.parquet)
+        thresholds_path (pathlib.Path): path to the QC thresholds saved by 1.evaluate_qc (see `save_qc_thresholds`)
+        output_dir (pathlib.Path): directory to save the skip list for each plate ({plate}_skip_list.csv)
+
+    Returns:
+        Dict[str, pathlib.Path]: path to the skip list for each plate
+    """
+    qc_df = pd.read_parquet(qc_path)
+    flagged = flag_image_sets(qc_df=qc_df, **load_qc_thresholds(thresholds_path))
+
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    skip_list_paths = {}
+    # every plate with QC metrics gets a skip list, even if no image sets are flagged
+    for plate in sorted(qc_df["Metadata_Plate"].unique()):
+        plate_flagged = flagged[flagged["Metadata_Plate"] == plate]
+        skip_list_paths[plate] = pathlib.Path(output_dir) / f"{plate}_skip_list.csv"
+        plate_flagged.to_csv(skip_list_paths[plate], index=False)
+        num_image_sets = qc_df[qc_df["Metadata_Plate"] == plate][["Metadata_Well", "Metadata_Site"]].drop_duplicates()
+        print(
+            f"{plate}: {len(plate_flagged)} of {len(num_image_sets)} image sets are skipped "
+            f"({int(plate_flagged['blurry'].sum())} blurry, {int(plate_flagged['saturated'].sum())} saturated)"
+        )
+
+    return skip_list_paths
+
+
+def load_skip_list(path_to_skip_list: pathlib.Path) -> Set[Tuple[str, int]]:
+    """Load the image sets to skip for a plate.
+
+    Args:
+        path_to_skip_list (pathlib.Path): path to the skip list CSV for the plate
+
+    Returns:
+        Set[Tuple[str, int]]: well and site of each image set to skip
+    """
+    skip_list = pd.read_csv(path_to_skip_list, dtype={"Metadata_Well": str, "Metadata_Site": int})
+    return set(zip(skip_list["Metadata_Well"], skip_list["Metadata_Site"]))
@@ -0,0 +1,343 @@
+"""
+This collection of functions optimizes the SQLite file from the CellProfiler `ExportToDatabase` module for each plate
+once the analysis is complete. CellProfiler only indexes the primary key (ImageNumber and the object number) of the
+compartment tables (`Per_Cells`, `Per_Cytoplasm`, and `Per_Nuclei`), so every merge or query on the parent of each
+object (the `{compartment}_Parent_{compartment}` columns) reads the whole tables. The optimization adds the indexes
+used to merge single cells, saves query planner statistics with ANALYZE, and rewrites the file with VACUUM (with a page
+size that fits the wide rows of the compartment tables). The row, column, and index counts of each table, and the time
+to merge single cells before and after the optimization if benchmarked, are saved next to the SQLite file
+(`{sqlite file}.stats.json`), which is also used to skip files that are already optimized.
+
+To optimize SQLite files (e.g., from a run before this step was added) and benchmark the single-cell merge, run this
+file as a script:
+
+    python utils/cp_sqlite.py 2.cellprofiler_analysis/analysis_output/*/*_nf1_analysis.sqlite --benchmark
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Dict, List, Optional, Tuple
+import argparse
+import json
+import pathlib
+import re
+import sqlite3
+import time
+
+# suffix of the statistics file that is saved next to each optimized SQLite file
+STATS_SUFFIX = ".stats.json"
+
+# page size for the optimized file, where larger pages hold more of each row of the wide compartment tables (thousands
+# of feature columns) on one page instead of spilling onto overflow pages (SQLite's default is 4096 bytes)
+PAGE_SIZE_BYTES = 32768
+
+# number of image sets to merge single cells for when benchmarking a query of a few image sets
+BENCHMARK_SAMPLE_IMAGES = 10
+
+# tables from `ExportToDatabase` start with the table prefix, which is "Per_" in the analysis pipelines
+TABLE_PATTERN = re.compile(r"^Per_")
+
+# columns with the number of each object in its image set (e.g., Cells_Number_Object_Number), which is ObjectNumber
+# when all objects are exported to one table
+OBJECT_NUMBER_PATTERN = re.compile(r"^(?:[A-Za-z]+_Number_Object_Number|ObjectNumber)$")
+
+# columns with the object number of the parent of each object (e.g., Cytoplasm_Parent_Cells)
+PARENT_COLUMN_PATTERN = re.compile(r"^[A-Za-z]+_Parent_[A-Za-z]+$")
+
+# tables that single cells are merged from, which are joined from the cytoplasm to the parent cell and nucleus like
+# the CytoTable preset (`cellprofiler_sqlite_pycytominer`)
+IMAGE_TABLE = "Per_Image"
+MERGE_BASE_TABLE = "Per_Cytoplasm"
+MERGE_BASE_OBJECT_NUMBER = "Cytoplasm_Number_Object_Number"
+# object number and the parent column of the cytoplasm that it is joined on for each table joined to the cytoplasm
+MERGE_TABLES = {
+    "Per_Cells": ("Cells_Number_Object_Number", "Cytoplasm_Parent_Cells"),
+    "Per_Nuclei": ("Nuclei_Number_Object_Number", "Cytoplasm_Parent_Nuclei"),
+}
+
+
+def stats_path(sqlite_file_path: pathlib.Path) -> pathlib.Path:
+    """Find the path to the statistics file of a SQLite file.
+
+    Args:
+        sqlite_file_path (pathlib.Path): path to the SQLite file
+
+    Returns:
+        pathlib.Path: path to the statistics file, which is next to the SQLite file
+    """
+    return pathlib.Path(f"{sqlite_file_path}{STATS_SUFFIX}")
+
+
+def table_columns(connection: sqlite3.Connection) -> Dict[str, List[str]]:
+    """Find the columns of each table from `ExportToDatabase` in a SQLite file.
+
+    Args:
+        connection (sqlite3.Connection): connection to the SQLite file
+
+    Returns:
+        Dict[str, List[str]]: names of the columns of each table by table name
+    """
+    tables = [
+        name
+        for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")
+        if TABLE_PATTERN.match(name)
+    ]
+    return {table: [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')] for table in tables}
+
+
+def indexed_columns(connection: sqlite3.Connection, table: str) -> List[Tuple[str, ...]]:
+    """Find the columns of each index of a table, including the indexes made for primary keys.
+
+    Args:
+        connection (sqlite3.Connection): connection to the SQLite file
+        table (str): name of the table
+
+    Returns:
+        List[Tuple[str, ...]]: columns of each index in index order
+    """
+    indexes = [
+        tuple(row[2] for row in connection.execute(f'PRAGMA index_info("{index[1]}")'))
+        for index in connection.execute(f'PRAGMA index_list("{table}")')
+    ]
+    # a primary key of one INTEGER column is the row ID of the table, which is not in the index list
+    primary_key = [row for row in connection.execute(f'PRAGMA table_info("{table}")') if row[5]]
+    if len(primary_key) == 1 and primary_key[0][2].upper() == "INTEGER":
+        indexes.append((primary_key[0][1],))
+    return indexes
+
+
+def join_indexes(tables: Dict[str, List[str]]) -> List[Tuple[str, Tuple[str, ...]]]:
+    """Find the indexes needed to merge single cells and look up objects by image set, which are the image number of
+    the image table, and the image number with the object number and with each parent column of the object tables.
+
+    Args:
+        tables (Dict[str, List[str]]): names of the columns of each table (see `table_columns`)
+
+    Returns:
+        List[Tuple[str, Tuple[str, ...]]]: table and columns of each index
+    """
+    indexes = []
+    for table, columns in tables.items():
+        if "ImageNumber" not in columns:
+            continue
+        object_numbers = [column for column in columns if OBJECT_NUMBER_PATTERN.match(column)]
+        if not object_numbers:
+            indexes.append((table, ("ImageNumber",)))
+            continue
+        indexes.append((table, ("ImageNumber", object_numbers[0])))
+        indexes.extend(
+            (table, ("ImageNumber", column)) for column in columns if PARENT_COLUMN_PATTERN.match(column)
+        )
+    return indexes
+
+
+def create_join_indexes(connection: sqlite3.Connection) -> List[str]:
+    """Create the indexes needed to merge single cells (see `join_indexes`), skipping indexes that an existing index
+    already covers (an index that starts with the same columns).
+
+    Args:
+        connection (sqlite3.Connection): connection to the SQLite file
+
+    Returns:
+        List[str]: names of the indexes that were created
+    """
+    created = []
+    for table, columns in join_indexes(table_columns(connection)):
+        if any(existing[: len(columns)] == columns for existing in indexed_columns(connection, table)):
+            continue
+        # the indexes are not unique so SQLite can not skip a join when the result would be the same without it
+        name = f"idx_{table}_{'_'.join(columns)}"
+        quoted_columns = ", ".join(f'"{column}"' for column in columns)
+        connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({quoted_columns})')
+        created.append(name)
+    return created
+
+
+def table_statistics(connection: sqlite3.Connection) -> Dict[str, dict]:
+    """Find the number of rows, columns, and indexes of each table from `ExportToDatabase` in a SQLite file.
+
+    Args:
+        connection (sqlite3.Connection): connection to the SQLite file
+
+    Returns:
+        Dict[str, dict]: number of rows ("rows") and columns ("columns"), and the columns of each index ("indexes") of
+        each table by table name
+    """
+    return {
+        table: {
+            "rows": connection.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0],
+            "columns": len(columns),
+            "indexes": [list(index) for index in indexed_columns(connection, table)],
+        }
+        for table, columns in table_columns(connection).items()
+    }
+
+
+def merge_query(image_numbers: Optional[List[int]] = None) -> str:
+    """Create the SQL that merges the compartment tables into single cells like the CytoTable preset, joining each
+    cytoplasm to its parent cell and nucleus and to its image set.
+
+    Args:
+        image_numbers (List[int], optional): image numbers to merge single cells for, where every column of the merged
+        single cells is selected, or only the join keys of every single cell are selected if None (default is None)
+
+    Returns:
+        str: SQL query for the merged single cells
+    """
+    if image_numbers is None:
+        columns = ", ".join(
+            [
+                f"{MERGE_BASE_TABLE}.ImageNumber",
+                f"{MERGE_BASE_TABLE}.{MERGE_BASE_OBJECT_NUMBER}",
+                f"{IMAGE_TABLE}.ImageNumber",
+            ]
+            + [f"{table}.{object_number}" for table, (object_number, _) in MERGE_TABLES.items()]
+        )
+    else:
+        columns = "*"
+    joins = " ".join(
+        f"LEFT JOIN {table} ON {table}.ImageNumber = {MERGE_BASE_TABLE}.ImageNumber "
+        f"AND {table}.{object_number} = {MERGE_BASE_TABLE}.{parent_column}"
+        for table, (object_number, parent_column) in MERGE_TABLES.items()
+    )
+    query = (
+        f"SELECT {columns} FROM {MERGE_BASE_TABLE} {joins} "
+        f"LEFT JOIN {IMAGE_TABLE} ON {IMAGE_TABLE}.ImageNumber = {MERGE_BASE_TABLE}.ImageNumber"
+    )
+    if image_numbers is not None:
+        query += f" WHERE {MERGE_BASE_TABLE}.ImageNumber IN ({', '.join(str(int(number)) for number in image_numbers)})"
+    return query
+
+
+def benchmark_merge(sqlite_file_path: pathlib.Path, repeats: int = 2) -> Optional[Dict[str, float]]:
+    """Measure how long it takes to merge the single cells of a SQLite file, both for every single cell (join keys
+    only) and for every column of a sample of image sets (like a query of a few wells). Each query is run more than
+    once and the fastest time is kept, so the file is read into the page cache by the first run before and after the
+    optimization.
+
+    Args:
+        sqlite_file_path (pathlib.Path): path to the SQLite file
+        repeats (int, optional): number of times to run each query (default is 2)
+
+    Returns:
+        Optional[Dict[str, float]]: seconds to merge every single cell ("merge_seconds") and the sample of image sets
+        ("sample_merge_seconds"), and the number of single cells merged ("single_cells"), or None if the file does not
+        have the compartment tables
+    """
+    connection = sqlite3.connect(f"file:{sqlite_file_path}?mode=ro", uri=True)
+    try:
+        tables = table_columns(connection)
+        if any(table not in tables for table in [IMAGE_TABLE, MERGE_BASE_TABLE, *MERGE_TABLES]):
+            return None
+        image_numbers = [number for (number,) in connection.execute(f"SELECT ImageNumber FROM {IMAGE_TABLE}")]
+        step = max(len(image_numbers) // BENCHMARK_SAMPLE_IMAGES, 1)
+        sample = sorted(image_numbers)[::step][:BENCHMARK_SAMPLE_IMAGES]
+
+        timings = {}
+        for name, query in [("merge_seconds", merge_query()), ("sample_merge_seconds", merge_query(sample))]:
+            elapsed = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                single_cells = sum(1 for _ in connection.execute(query))
+                elapsed.append(time.perf_counter() - start)
+            timings[name] = min(elapsed)
+            if name == "merge_seconds":
+                timings["single_cells"] = single_cells
+        return timings
+    finally:
+        connection.close()
+
+
+def optimize_sqlite_file(
+    sqlite_file_path: pathlib.Path, page_size: int = PAGE_SIZE_BYTES, benchmark: bool = False
+) -> dict:
+    """Add the indexes used to merge single cells to a SQLite file from `ExportToDatabase`, save the query planner
+    statistics (ANALYZE), rewrite the file with the page size (VACUUM), and save the statistics of each table next to
+    the file. Files with statistics from an optimization that match their size and modification time are skipped.
+
+    Args:
+        sqlite_file_path (pathlib.Path): path to the SQLite file
+        page_size (int, optional): page size of the optimized file in bytes, a power of two from 512 to 65536 (default
+        is 32768)
+        benchmark (bool, optional): time the single-cell merge before and after the optimization (see
+        `benchmark_merge`) (default is False)
+
+    Raises:
+        FileNotFoundError: if the SQLite file does not exist
+
+    Returns:
+        dict: size before ("original_bytes") and after ("optimized_bytes") the optimization, page size ("page_size"),
+        indexes that were created ("created_indexes"), statistics of each table ("tables"), merge timings before
+        ("benchmark_before") and after ("benchmark_after") the optimization if benchmarked, and the modification time
+        of the optimized file ("mtime_ns")
+    """
+    sqlite_file_path = pathlib.Path(sqlite_file_path)
+    if not sqlite_file_path.is_file():
+        raise FileNotFoundError(f"The SQLite file {sqlite_file_path} does not exist")
+
+    statistics_path = stats_path(sqlite_file_path)
+    if statistics_path.exists():
+        with open(statistics_path, "r") as stats_file:
+            stats = json.load(stats_file)
+        stat = sqlite_file_path.stat()
+        if stats.get("optimized_bytes") == stat.st_size and stats.get("mtime_ns") == stat.st_mtime_ns:
+            print(f"{sqlite_file_path.name} is already optimized!")
+            return stats
+
+    original_bytes = sqlite_file_path.stat().st_size
+    benchmark_before = benchmark_merge(sqlite_file_path) if benchmark else None
+
+    # autocommit mode is used since VACUUM can not be run in a transaction
+    connection = sqlite3.connect(sqlite_file_path, isolation_level=None)
+    try:
+        created_indexes = create_join_indexes(connection)
+        connection.execute("ANALYZE")
+        # the page size only changes when the file is rewritten by VACUUM, which also puts the pages of each table and
+        # index next to each other in the file
+        connection.execute(f"PRAGMA page_size = {int(page_size)}")
+        connection.execute("VACUUM")
+        tables = table_statistics(connection)
+        optimized_page_size = connection.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        connection.close()
+
+    stats = {
+        "original_bytes": original_bytes,
+        "optimized_bytes": sqlite_file_path.stat().st_size,
+        "page_size": optimized_page_size,
+        "created_indexes": created_indexes,
+        "tables": tables,
+        "benchmark_before": benchmark_before,
+        "benchmark_after": benchmark_merge(sqlite_file_path) if benchmark else None,
+        "mtime_ns": sqlite_file_path.stat().st_mtime_ns,
+    }
+
+    # write to a temporary file first so the statistics are never left half written
+    temporary_path = statistics_path.with_suffix(".tmp")
+    with open(temporary_path, "w") as stats_file:
+        json.dump(stats, stats_file, indent=4)
+    temporary_path.replace(statistics_path)
+
+    print(
+        f"Optimized {sqlite_file_path.name} with {len(created_indexes)} new indexes "
+        f"({original_bytes / 1024**3:.2f} GB to {stats['optimized_bytes'] / 1024**3:.2f} GB)"
+    )
+    if benchmark_before is not None:
+        for name in ["merge_seconds", "sample_merge_seconds"]:
+            print(
+                f"{name}: {benchmark_before[name]:.2f} before and {stats['benchmark_after'][name]:.2f} after "
+                "optimization"
+            )
+
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimize the SQLite files from CellProfiler for merging single cells.")
+    parser.add_argument("sqlite_files", type=pathlib.Path, nargs="+", help="paths to the SQLite files")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE_BYTES, help="page size of the optimized files")
+    parser.add_argument("--benchmark", action="store_true", help="time the single-cell merge before and after")
+    args = parser.parse_args()
+    for sqlite_file in args.sqlite_files:
+        optimize_sqlite_file(sqlite_file_path=sqlite_file, page_size=args.page_size, benchmark=args.benchmark)
@@ -0,0 +1,283 @@
+"""
+This collection of functions converts the SQLite output of each CellProfiler shard (or plate) into a single-cell
+Parquet file with CytoTable as soon as the shard completes, while CellProfiler is still running the other shards and
+plates. The converted shards of a plate are then combined into the plate Parquet file in `0.merge_sc_cytotable`
+instead of converting the plate SQLite file after analysis is finished.
+
+CytoTable is installed in the preprocessing environment and not the CellProfiler environment, so each conversion is
+run as its own process in the preprocessing environment by running this file with the source and destination paths:
+
+    conda run -n nf1_preprocessing_env python utils/cp_stream_convert.py shard.sqlite shard.parquet
+
+The converted image set ranges for each plate are recorded in a stream manifest in the folder for the plate.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+import argparse
+import json
+import pathlib
+import subprocess
+import sys
+import threading
+
+import cp_manifest
+
+# name of the conda environment with CytoTable
+PREPROCESSING_ENV = "nf1_preprocessing_env"
+
+# command to run python in the preprocessing environment from the CellProfiler environment
+PREPROCESSING_PYTHON = ["conda", "run", "--no-capture-output", "-n", PREPROCESSING_ENV, "python"]
+
+# name of the stream manifest that is saved in the folder of converted shards for each plate
+STREAM_MANIFEST_NAME = "stream_manifest.json"
+
+# preset configurations based on typical CellProfiler outputs
+CYTOTABLE_PRESET = "cellprofiler_sqlite_pycytominer"
+
+
+def cytotable_joins() -> str:
+    """Create the joins for the CytoTable preset that also include the site metadata and the path of each image.
+
+    Returns:
+        str: SQL for the joins that is given to CytoTable `convert`
+    """
+    from cytotable import presets
+
+    # update preset to include site metadata and cell counts
+    joins = presets.config[CYTOTABLE_PRESET]["CONFIG_JOINS"].replace(
+        "Image_Metadata_Well,",
+        "Image_Metadata_Well, Image_Metadata_Site,",
+    )
+    # Add the PathName columns separately
+    return joins.replace(
+        "COLUMNS('Image_FileName_.*'),",
+        "COLUMNS('Image_FileName_.*'),\n COLUMNS('Image_PathName_.*'),",
+    )
+
+
+def convert_sqlite(source_path: pathlib.Path, dest_path: pathlib.Path) -> None:
+    """Merge the objects in a CellProfiler SQLite file into single cells and save them as a Parquet file with CytoTable.
+
+    Args:
+        source_path (pathlib.Path): path to the SQLite file from `ExportToDatabase`
+        dest_path (pathlib.Path): path to save the Parquet file
+    """
+    from cytotable import convert
+
+    pathlib.Path(dest_path).parent.mkdir(parents=True, exist_ok=True)
+    convert(
+        source_path=str(source_path),
+        dest_path=str(dest_path),
+        dest_datatype="parquet",
+        preset=CYTOTABLE_PRESET,
+        joins=cytotable_joins(),
+    )
+
+
+def load_stream_manifest(plate_dir: pathlib.Path) -> List[dict]:
+    """Load the converted shards for a plate, which is empty if no shards have been converted.
+
+    Args:
+        plate_dir (pathlib.Path): folder with the converted shards for the plate
+
+    Returns:
+        List[dict]: first and last image set ("first", "last") and Parquet file name ("file") of each converted shard
+    """
+    manifest_path = pathlib.Path(plate_dir) / STREAM_MANIFEST_NAME
+    if not manifest_path.exists():
+        return []
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def record_converted_shard(plate_dir: pathlib.Path, first: int, last: int, file_name: str) -> None:
+    """Add a converted shard to the stream manifest for a plate, where shards from a previous run that overlap the
+    image sets of the shard (e.g., when a plate is run again with a different shard size) are removed.
+
+    Args:
+        plate_dir (pathlib.Path): folder with the converted shards for the plate
+        first (int): first image set in the shard
+        last (int): last image set in the shard
+        file_name (str): name of the Parquet file for the shard
+    """
+    shards = []
+    for shard in load_stream_manifest(plate_dir):
+        if shard["first"] <= last and first <= shard["last"]:
+            if shard["file"] != file_name:
+                (pathlib.Path(plate_dir) / shard["file"]).unlink(missing_ok=True)
+            continue
+        shards.append(shard)
+    shards.append({"first": first, "last": last, "file": file_name})
+
+    # write to a temporary file first so the manifest is never left half written if the run is stopped
+    manifest_path = pathlib.Path(plate_dir) / STREAM_MANIFEST_NAME
+    temporary_path = manifest_path.with_suffix(".json.tmp")
+    with open(temporary_path, "w") as manifest_file:
+        json.dump(sorted(shards, key=lambda shard: shard["first"]), manifest_file, indent=4)
+    temporary_path.replace(manifest_path)
+
+
+def completed_ranges(path_to_output: pathlib.Path) -> List[Tuple[int, int]]:
+    """Find the completed image sets of a plate from its run manifest.
+
+    Args:
+        path_to_output (pathlib.Path): path to the CellProfiler output directory for the plate
+
+    Returns:
+        List[Tuple[int, int]]: first and last image set of each completed range across the pipelines in the manifest
+    """
+    return cp_manifest.merge_ranges(
+        [
+            tuple(image_sets)
+            for record in cp_manifest.load_manifest(path_to_output).values()
+            for image_sets in record.get("completed_image_sets", [])
+        ]
+    )
+
+
+def is_stream_complete(plate_dir: pathlib.Path, path_to_output: pathlib.Path) -> bool:
+    """Check if the converted shards of a plate cover every image set that was completed for the plate.
+
+    Args:
+        plate_dir (pathlib.Path): folder with the converted shards for the plate
+        path_to_output (pathlib.Path): path to the CellProfiler output directory for the plate
+
+    Returns:
+        bool: True if the converted shards and the completed image sets are the same
+    """
+    converted = cp_manifest.merge_ranges([(shard["first"], shard["last"]) for shard in load_stream_manifest(plate_dir)])
+    completed = completed_ranges(path_to_output)
+    return bool(completed) and converted == completed
+
+
+def combine_converted_shards(plate_dir: pathlib.Path, dest_path: pathlib.Path) -> None:
+    """Combine the converted shards of a plate into one Parquet file in image set order, reading one batch of rows
+    at a time so the plate is never loaded into memory.
+
+    Args:
+        plate_dir (pathlib.Path): folder with the converted shards for the plate
+        dest_path (pathlib.Path): path to save the Parquet file for the plate
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    shard_files = [pq.ParquetFile(pathlib.Path(plate_dir) / shard["file"]) for shard in load_stream_manifest(plate_dir)]
+
+    # a column that is empty in a shard has a null type, so the type of each column is taken from the first shard
+    # where it is not null
+    fields = {}
+    for shard_file in shard_files:
+        for field in shard_file.schema_arrow:
+            if field.name not in fields or pa.types.is_null(fields[field.name].type):
+                fields[field.name] = field
+    schema = pa.schema(list(fields.values()))
+
+    # write to a temporary file first so a plate that fails to combine does not leave a partial Parquet file, which
+    # would be skipped as already merged
+    temporary_path = pathlib.Path(dest_path).with_suffix(".parquet.tmp")
+    with pq.ParquetWriter(temporary_path, schema) as writer:
+        for shard_file in shard_files:
+            for batch in shard_file.iter_batches():
+                # shards can have the columns in a different order or be missing columns (e.g., a shard without
+                # any objects of a compartment), so the columns are put in the schema order and the missing ones
+                # are filled with nulls before casting
+                columns = [
+                    batch.column(field.name)
+                    if field.name in batch.schema.names
+                    else pa.nulls(batch.num_rows, type=field.type)
+                    for field in schema
+                ]
+                writer.write_table(pa.Table.from_arrays(columns, names=schema.names).cast(schema))
+    temporary_path.replace(dest_path)
+
+
+class StreamingConverter:
+    """
+    Convert the SQLite file of each shard (or plate) to Parquet in the background as soon as it completes, running
+    up to `max_workers` conversions at a time so they do not take CPUs away from the CellProfiler processes.
+    """
+
+    def __init__(
+        self,
+        converted_dir: pathlib.Path,
+        max_workers: int = 1,
+        python_command: Optional[List[str]] = None,
+    ):
+        """
+        Args:
+            converted_dir (pathlib.Path): directory for the converted shards (in a folder per plate)
+            max_workers (int, optional): maximum number of conversions to run at once (default is 1)
+            python_command (List[str], optional): command to run python with CytoTable installed, which defaults to
+            python in the preprocessing environment (default is None)
+        """
+        self.converted_dir = pathlib.Path(converted_dir).resolve()
+        self.python_command = python_command or PREPROCESSING_PYTHON
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures: List[Future] = []
+        self.lock = threading.Lock()
+
+    def convert(self, plate: str, path_to_output: pathlib.Path, first: int, last: int) -> Optional[str]:
+        """Convert the SQLite file in the output directory of a shard and record it in the stream manifest.
+
+        Args:
+            plate (str): name of the plate
+            path_to_output (pathlib.Path): output directory of the shard (or plate)
+            first (int): first image set in the shard
+            last (int): last image set in the shard
+
+        Returns:
+            Optional[str]: error message if the conversion failed, otherwise None
+        """
+        sqlite_paths = sorted(pathlib.Path(path_to_output).glob("*.sqlite"))
+        if len(sqlite_paths) != 1:
+            return f"Expected one SQLite file in {path_to_output} but found {len(sqlite_paths)}"
+
+        plate_dir = self.converted_dir / plate
+        file_name = f"{plate}_image_sets_{first:05d}_{last:05d}.parquet"
+        plate_dir.mkdir(parents=True, exist_ok=True)
+        result = subprocess.run(
+            self.python_command + [str(pathlib.Path(__file__).resolve()), str(sqlite_paths[0]), str(plate_dir / file_name)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        if result.returncode != 0:
+            return f"Converting {sqlite_paths[0]} failed:\n{result.stdout.decode('utf-8')}"
+
+        with self.lock:
+            record_converted_shard(plate_dir=plate_dir, first=first, last=last, file_name=file_name)
+        print(f"Converted image sets {first} to {last} of {plate} to {file_name}")
+        return None
+
+    def submit(self, plate: str, path_to_output: pathlib.Path, first: int, last: int) -> None:
+        """Queue the conversion of a shard (see `convert`).
+
+        Args:
+            plate (str): name of the plate
+            path_to_output (pathlib.Path): output directory of the shard (or plate)
+            first (int): first image set in the shard
+            last (int): last image set in the shard
+        """
+        self.futures.append(self.executor.submit(self.convert, plate, path_to_output, first, last))
+
+    def wait(self) -> List[str]:
+        """Wait for all queued conversions to finish, which must be done before the shard outputs are merged.
+
+        Returns:
+            List[str]: error message of each conversion that failed
+        """
+        errors = [future.result() for future in self.futures]
+        self.executor.shutdown()
+        return [error for error in errors if error is not None]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a CellProfiler SQLite file to a single-cell Parquet file.")
+    parser.add_argument("source_path", type=pathlib.Path, help="path to the SQLite file")
+    parser.add_argument("dest_path", type=pathlib.Path, help="path to save the Parquet file")
+    args = parser.parse_args()
+    convert_sqlite(source_path=args.source_path, dest_path=args.dest_path)
+    sys.exit(0)
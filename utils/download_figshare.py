@@ -1,9 +1,1055 @@
+"""
+This collection of functions downloads items from Figshare and extracts the images and metadata for each plate.
+Large items are downloaded as byte ranges over several connections, where the completed ranges are recorded in a
+journal next to the partial file so a download that stops can resume from where it was. The zip files are extracted in
+one pass (including the zip files nested inside them) while the zip file is truncated, so the disk use stays close to
+one copy of the images. The files extracted from each item are saved with their checksums in a download manifest for
+the item and version, so an item that is already extracted is checked in seconds instead of being downloaded again.
+A zip file can also be kept and indexed instead of extracted, so the images are read from it (see `zip_images`).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 import os
-import glob
+import hashlib
+import http.client
+import io
+import json
 import pathlib
-import shutil
+import struct
+import threading
+import time
+import urllib.error
 import urllib.request
 import zipfile
+import zlib
+
+import zip_images
+
+# size of the byte ranges that each connection downloads (the unit that is recorded in the journal)
+RANGE_SIZE_BYTES = 64 * 1024**2
+
+# size of the blocks read from a connection and written to the partial file
+BLOCK_SIZE_BYTES = 1024**2
+
+# number of times a byte range is downloaded again after a dropped connection before the download fails
+RANGE_RETRIES = 5
+
+# seconds between throughput reports for each download
+REPORT_INTERVAL_SECONDS = 30.0
+
+# local file header that starts each member of a zip file (with the size of its fixed fields)
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+LOCAL_HEADER_SIZE = 30
+
+
+class TransferLimits:
+    """
+    Limits shared by downloads that run at the same time, which cap the total number of open connections and the
+    total bandwidth across the downloads.
+    """
+
+    def __init__(self, max_connections: int = 16, max_bytes_per_second: Optional[float] = None):
+        """
+        Attributes
+        ----------
+        max_connections : int, default 16
+            maximum number of connections open at once across all downloads
+        max_bytes_per_second : float, optional
+            maximum total download rate across all downloads, which is not limited if not set
+        """
+        self.connections = threading.BoundedSemaphore(max_connections)
+        self.max_bytes_per_second = max_bytes_per_second
+        self.lock = threading.Lock()
+        # time when the bytes downloaded so far are within the bandwidth limit
+        self.next_time = time.monotonic()
+
+    def throttle(self, num_bytes: int) -> None:
+        """Wait until downloading the bytes keeps the total download rate within the bandwidth limit."""
+        if self.max_bytes_per_second is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + num_bytes / self.max_bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+class ThroughputReporter:
+    """
+    Count the bytes downloaded for one file and print the throughput and ETA at a fixed interval.
+    """
+
+    def __init__(self, name: str, total_bytes: Optional[int], completed_bytes: int = 0):
+        """
+        Attributes
+        ----------
+        name : str
+            name of the download in the reports
+        total_bytes : int, optional
+            size of the file, where the ETA is not reported if the size is unknown
+        completed_bytes : int, default 0
+            bytes that were already downloaded (e.g., by a download that is resumed)
+        """
+        self.name = name
+        self.total_bytes = total_bytes
+        self.completed_bytes = completed_bytes
+        self.resumed_bytes = completed_bytes
+        self.started_at = time.monotonic()
+        self.reported_at = self.started_at
+        self.lock = threading.Lock()
+
+    def add(self, num_bytes: int) -> None:
+        """Count downloaded bytes and print a report when the interval has passed."""
+        with self.lock:
+            self.completed_bytes += num_bytes
+            now = time.monotonic()
+            if now - self.reported_at < REPORT_INTERVAL_SECONDS:
+                return
+            self.reported_at = now
+            print(self.report())
+
+    def report(self) -> str:
+        """Create a report of the bytes downloaded, the throughput, and the ETA."""
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        rate = (self.completed_bytes - self.resumed_bytes) / elapsed
+        report = f"{self.name}: {self.completed_bytes / 1024**3:.2f}"
+        if self.total_bytes:
+            report += f" of {self.total_bytes / 1024**3:.2f} GB"
+            if rate > 0:
+                report += f" ({rate / 1024**2:.1f} MB/s, ETA {(self.total_bytes - self.completed_bytes) / rate / 60:.1f} min)"
+        else:
+            report += f" GB ({rate / 1024**2:.1f} MB/s)"
+        return report
+
+
+def probe_download(url: str) -> Tuple[Optional[int], bool]:
+    """
+    Find the size of a download and if the server can send byte ranges.
+
+    Attributes
+    ----------
+    url : str
+        URL of the file to download
+
+    Returns
+    -------
+    Tuple[Optional[int], bool]
+        size in bytes (None if unknown) and if byte ranges are supported
+    """
+    request = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+    with urllib.request.urlopen(request) as response:
+        # a server that supports ranges answers with the partial content and the total size in Content-Range
+        content_range = response.headers.get("Content-Range")
+        if response.status == 206 and content_range and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            if total.isdigit():
+                return int(total), True
+        length = response.headers.get("Content-Length")
+        return int(length) if length and length.isdigit() else None, False
+
+
+def download_range(
+    url: str,
+    part_path: pathlib.Path,
+    start: int,
+    end: int,
+    reporter: ThroughputReporter,
+    transfer_limits: TransferLimits,
+) -> None:
+    """
+    Download a byte range of a file into the same position of the partial file, which is downloaded again from
+    the start of the range when the connection drops (up to `RANGE_RETRIES` times).
+
+    Attributes
+    ----------
+    url : str
+        URL of the file to download
+    part_path : pathlib.Path
+        path to the partial file, which is already the size of the whole file
+    start : int
+        first byte of the range
+    end : int
+        last byte of the range (inclusive)
+    reporter : ThroughputReporter
+        counts the downloaded bytes
+    transfer_limits : TransferLimits
+        connection and bandwidth limits shared across downloads
+    """
+    for attempt in range(RANGE_RETRIES + 1):
+        downloaded = 0
+        try:
+            with transfer_limits.connections:
+                request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}"})
+                with urllib.request.urlopen(request, timeout=60) as response, open(part_path, "r+b") as part_file:
+                    if response.status != 206:
+                        raise urllib.error.URLError(f"expected partial content but received {response.status}")
+                    part_file.seek(start)
+                    while True:
+                        block = response.read(BLOCK_SIZE_BYTES)
+                        if not block:
+                            break
+                        transfer_limits.throttle(len(block))
+                        part_file.write(block)
+                        downloaded += len(block)
+                        reporter.add(len(block))
+            if downloaded != end - start + 1:
+                raise urllib.error.URLError(f"received {downloaded} of {end - start + 1} bytes")
+            return
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as error:
+            # the bytes of the failed attempt are downloaded again
+            reporter.add(-downloaded)
+            if attempt == RANGE_RETRIES:
+                raise
+            print(f"Downloading bytes {start}-{end} of {part_path.name} failed ({error}), retrying")
+            time.sleep(2**attempt)
+
+
+def load_journal(journal_path: pathlib.Path, url: str, total_bytes: int) -> List[int]:
+    """
+    Load the byte ranges (by index) that were completed by a previous download of the same file, which is empty
+    if there is no journal or the journal is for a different file or range size.
+
+    Attributes
+    ----------
+    journal_path : pathlib.Path
+        path to the journal of the partial file
+    url : str
+        URL of the file to download
+    total_bytes : int
+        size of the file
+
+    Returns
+    -------
+    List[int]
+        indices of the completed byte ranges
+    """
+    if not journal_path.exists():
+        return []
+    with open(journal_path, "r") as journal_file:
+        journal = json.load(journal_file)
+    if (journal["url"], journal["total_bytes"], journal["range_size"]) != (url, total_bytes, RANGE_SIZE_BYTES):
+        return []
+    return journal["completed_ranges"]
+
+
+def write_journal(journal_path: pathlib.Path, url: str, total_bytes: int, completed: List[int]) -> None:
+    """
+    Record the completed byte ranges (by index) of a partial file in its journal.
+
+    Attributes
+    ----------
+    journal_path : pathlib.Path
+        path to the journal of the partial file
+    url : str
+        URL of the file to download
+    total_bytes : int
+        size of the file
+    completed : List[int]
+        indices of the completed byte ranges
+    """
+    # write to a temporary file first so the journal is never left half written if the download is stopped
+    temporary_path = journal_path.with_suffix(".tmp")
+    with open(temporary_path, "w") as journal_file:
+        json.dump(
+            {
+                "url": url,
+                "total_bytes": total_bytes,
+                "range_size": RANGE_SIZE_BYTES,
+                "completed_ranges": sorted(completed),
+            },
+            journal_file,
+        )
+    temporary_path.replace(journal_path)
+
+
+def download_file(
+    url: str,
+    output_file: pathlib.Path,
+    num_connections: int = 4,
+    transfer_limits: Optional[TransferLimits] = None,
+) -> None:
+    """
+    Download a file as byte ranges over several connections into a partial file (`{output_file}.part`), which is
+    renamed to the output file once every range is downloaded. The completed ranges are recorded in a journal
+    (`{output_file}.journal.json`), so running the download again resumes from the ranges that are missing.
+    If the server does not support byte ranges, the file is downloaded over one connection without resuming.
+
+    Attributes
+    ----------
+    url : str
+        URL of the file to download
+    output_file : pathlib.Path
+        path to save the file to
+    num_connections : int, default 4
+        number of connections to download byte ranges over at once
+    transfer_limits : TransferLimits, optional
+        connection and bandwidth limits shared with other downloads, where only `num_connections` limits the
+        download if not given
+    """
+    output_file = pathlib.Path(output_file)
+    part_path = pathlib.Path(f"{output_file}.part")
+    journal_path = pathlib.Path(f"{output_file}.journal.json")
+    transfer_limits = transfer_limits or TransferLimits(max_connections=num_connections)
+
+    # the ranges are requested from the Figshare URL (and not the storage URL it redirects to), since the storage
+    # URL expires before a large item finishes downloading
+    total_bytes, supports_ranges = probe_download(url)
+    if not supports_ranges or not total_bytes:
+        print(f"The server does not support byte ranges for {output_file.name}, downloading over one connection")
+        reporter = ThroughputReporter(name=output_file.name, total_bytes=total_bytes)
+        with transfer_limits.connections:
+            with urllib.request.urlopen(url) as response, open(part_path, "wb") as part_file:
+                while True:
+                    block = response.read(BLOCK_SIZE_BYTES)
+                    if not block:
+                        break
+                    transfer_limits.throttle(len(block))
+                    part_file.write(block)
+                    reporter.add(len(block))
+        part_path.replace(output_file)
+        print(reporter.report())
+        return
+
+    # the ranges are listed by index, where the last range can be smaller
+    ranges = [
+        (start, min(start + RANGE_SIZE_BYTES, total_bytes) - 1) for start in range(0, total_bytes, RANGE_SIZE_BYTES)
+    ]
+    completed = load_journal(journal_path, url, total_bytes) if part_path.exists() else []
+    if not completed:
+        # create the partial file at the full size so each range can be written to its position
+        with open(part_path, "wb") as part_file:
+            part_file.truncate(total_bytes)
+        write_journal(journal_path, url, total_bytes, completed)
+    else:
+        print(f"Resuming {output_file.name} with {len(completed)} of {len(ranges)} byte ranges already downloaded")
+
+    reporter = ThroughputReporter(
+        name=output_file.name,
+        total_bytes=total_bytes,
+        completed_bytes=sum(ranges[index][1] - ranges[index][0] + 1 for index in completed),
+    )
+    journal_lock = threading.Lock()
+
+    def download_index(index: int) -> None:
+        start, end = ranges[index]
+        download_range(
+            url=url,
+            part_path=part_path,
+            start=start,
+            end=end,
+            reporter=reporter,
+            transfer_limits=transfer_limits,
+        )
+        with journal_lock:
+            completed.append(index)
+            write_journal(journal_path, url, total_bytes, completed)
+
+    missing = sorted(set(range(len(ranges))) - set(completed))
+    with ThreadPoolExecutor(max_workers=num_connections) as executor:
+        # raise the first error once the ranges that are running have finished
+        for _ in executor.map(download_index, missing):
+            pass
+
+    part_path.replace(output_file)
+    journal_path.unlink()
+    print(reporter.report())
+
+
+class ZipWindow(io.RawIOBase):
+    """
+    Read-only view of a byte range of a file, which is used to open a zip file that is stored (not compressed) inside
+    another zip file without extracting it.
+    """
+
+    def __init__(self, path: pathlib.Path, start: int, size: int):
+        """
+        Attributes
+        ----------
+        path : pathlib.Path
+            path to the file
+        start : int
+            first byte of the range
+        size : int
+            number of bytes in the range
+        """
+        self.file = open(path, "rb")
+        self.start = start
+        self.size = size
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = min(max(offset, 0), self.size)
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        num_bytes = min(len(buffer), self.size - self.position)
+        if num_bytes <= 0:
+            return 0
+        self.file.seek(self.start + self.position)
+        data = self.file.read(num_bytes)
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self) -> None:
+        self.file.close()
+        super().close()
+
+
+def member_data_offset(zip_file, header_offset: int) -> int:
+    """
+    Find where the data of a zip member starts from its local file header.
+
+    Attributes
+    ----------
+    zip_file : file object
+        zip file opened in binary mode
+    header_offset : int
+        position of the local file header of the member
+
+    Returns
+    -------
+    int
+        position of the first byte of the member data
+    """
+    zip_file.seek(header_offset)
+    header = zip_file.read(LOCAL_HEADER_SIZE)
+    if header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f"No local file header at byte {header_offset}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def member_destination(name: str, extraction_path: pathlib.Path) -> pathlib.Path:
+    """
+    Find the path to extract a zip member to, making sure it is inside the extraction path.
+
+    Attributes
+    ----------
+    name : str
+        name of the member in the zip file
+    extraction_path : pathlib.Path
+        path to directory to extract the member to
+
+    Returns
+    -------
+    pathlib.Path
+        path to extract the member to
+    """
+    parts = pathlib.PurePosixPath(name).parts
+    if pathlib.PurePosixPath(name).is_absolute() or ".." in parts:
+        raise zipfile.BadZipFile(f"The zip member {name} would be extracted outside of {extraction_path}")
+    return pathlib.Path(extraction_path, *parts)
+
+
+def plan_zip_extraction(
+    path_to_zip_file: pathlib.Path,
+    extraction_path: pathlib.Path,
+    metadata_dir: Optional[pathlib.Path] = None,
+    nested_zips: Optional[Dict[str, pathlib.Path]] = None,
+) -> List[dict]:
+    """
+    List where each file in a zip file is extracted to. Metadata CSV files at the top of the zip file go to the
+    metadata directory, and the members of nested zip files go to their own extraction path. Nested zip files that are
+    stored (not compressed) are read in place, while compressed nested zip files are extracted to a temporary zip file
+    first.
+
+    Attributes
+    ----------
+    path_to_zip_file : pathlib.Path
+        path to the zip file
+    extraction_path : pathlib.Path
+        path to directory to extract the files to
+    metadata_dir : pathlib.Path, optional
+        path to directory for the metadata CSV files, which are extracted with the other files if not given
+    nested_zips : Dict[str, pathlib.Path], optional
+        path to directory to extract the files of each nested zip file to by the name of the nested zip file
+
+    Returns
+    -------
+    List[dict]
+        position of the local file header in the zip file ("header_offset"), compression ("compress_type"),
+        compressed size ("compress_size"), size ("file_size"), CRC ("crc"), path to extract to ("destination"), and
+        if the file is a nested zip file to extract after ("nested_extraction_path") for each file
+    """
+    nested_zips = nested_zips or {}
+
+    def entry(info: zipfile.ZipInfo, offset: int, destination: pathlib.Path) -> dict:
+        return {
+            "header_offset": offset + info.header_offset,
+            "compress_type": info.compress_type,
+            "compress_size": info.compress_size,
+            "file_size": info.file_size,
+            "crc": info.CRC,
+            "destination": str(destination),
+            "nested_extraction_path": None,
+        }
+
+    entries = []
+    with zipfile.ZipFile(path_to_zip_file, "r") as zip_file, open(path_to_zip_file, "rb") as raw_file:
+        for info in zip_file.infolist():
+            if info.is_dir():
+                continue
+            name = pathlib.PurePosixPath(info.filename).name
+            if name in nested_zips and info.compress_type == zipfile.ZIP_STORED:
+                data_offset = member_data_offset(raw_file, info.header_offset)
+                with zipfile.ZipFile(ZipWindow(path_to_zip_file, data_offset, info.file_size), "r") as nested_file:
+                    entries.extend(
+                        entry(nested_info, data_offset, member_destination(nested_info.filename, nested_zips[name]))
+                        for nested_info in nested_file.infolist()
+                        if not nested_info.is_dir()
+                    )
+            elif name in nested_zips:
+                nested_entry = entry(info, 0, pathlib.Path(f"{path_to_zip_file}.{name}"))
+                nested_entry["nested_extraction_path"] = str(nested_zips[name])
+                entries.append(nested_entry)
+            elif metadata_dir is not None and "/" not in info.filename and name.endswith(".csv"):
+                # the metadata from Figshare overwrites the GitHub versioned metadata
+                entries.append(entry(info, 0, pathlib.Path(metadata_dir) / name))
+            else:
+                entries.append(entry(info, 0, member_destination(info.filename, extraction_path)))
+
+    return entries
+
+
+def write_member(source, member: dict) -> str:
+    """
+    Write the data of one zip member (see `plan_zip_extraction`) from a file object that is at the first byte of the
+    data, checking the CRC of the extracted file.
+
+    Attributes
+    ----------
+    source : file object
+        zip file (or byte range of a download) opened in binary mode at the first byte of the member data
+    member : dict
+        compression, sizes, CRC, and path to extract to for the member
+
+    Returns
+    -------
+    str
+        SHA-256 checksum of the extracted file
+    """
+    if member["compress_type"] not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise zipfile.BadZipFile(f"The compression of {member['destination']} is not supported")
+
+    destination = pathlib.Path(member["destination"])
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if member["compress_type"] == zipfile.ZIP_DEFLATED else None
+    crc = 0
+    checksum = hashlib.sha256()
+    with open(destination, "wb") as output_file:
+        remaining = member["compress_size"]
+        while remaining > 0:
+            block = source.read(min(BLOCK_SIZE_BYTES, remaining))
+            if not block:
+                raise zipfile.BadZipFile(f"The zip file ends before the end of {destination.name}")
+            remaining -= len(block)
+            if decompressor is not None:
+                block = decompressor.decompress(block)
+            crc = zlib.crc32(block, crc)
+            checksum.update(block)
+            output_file.write(block)
+        if decompressor is not None:
+            block = decompressor.flush()
+            crc = zlib.crc32(block, crc)
+            checksum.update(block)
+            output_file.write(block)
+    if crc != member["crc"]:
+        raise zipfile.BadZipFile(f"The CRC of {destination.name} does not match the zip file")
+    return checksum.hexdigest()
+
+
+def extract_member(path_to_zip_file: pathlib.Path, member: dict) -> str:
+    """
+    Extract one member of a zip file (see `plan_zip_extraction`), checking the CRC of the extracted file.
+
+    Attributes
+    ----------
+    path_to_zip_file : pathlib.Path
+        path to the zip file
+    member : dict
+        position, compression, sizes, CRC, and path to extract to for the member
+
+    Returns
+    -------
+    str
+        SHA-256 checksum of the extracted file
+    """
+    with open(path_to_zip_file, "rb") as zip_file:
+        zip_file.seek(member_data_offset(zip_file, member["header_offset"]))
+        return write_member(zip_file, member)
+
+
+def load_extracted_files(records_path: pathlib.Path) -> List[dict]:
+    """
+    Load the files recorded by an extraction (see `extract_zip_in_place`), where a file that was extracted again after
+    the extraction was stopped is only listed once.
+
+    Attributes
+    ----------
+    records_path : pathlib.Path
+        path to the records of the extraction
+
+    Returns
+    -------
+    List[dict]
+        position in the download, compression, sizes, CRC, path, and checksum ("sha256") of each extracted file
+    """
+    if not records_path.exists():
+        return []
+    files = {}
+    with open(records_path, "r") as records_file:
+        for line in records_file:
+            # the last line is incomplete if the extraction was stopped while it was written
+            if line.endswith("\n"):
+                record = json.loads(line)
+                files[record["destination"]] = record
+    return list(files.values())
+
+
+def extract_zip_in_place(
+    path_to_zip_file: pathlib.Path,
+    extraction_path: pathlib.Path,
+    metadata_dir: Optional[pathlib.Path] = None,
+    nested_zips: Optional[Dict[str, pathlib.Path]] = None,
+    num_workers: int = 8,
+    records_path: Optional[pathlib.Path] = None,
+) -> List[dict]:
+    """
+    Extract the files in a zip file (and the nested zip files it contains) with one pass over the bytes, where the zip
+    file is removed as it is extracted so the disk use stays close to one copy of the files.
+
+    The members are extracted on several threads from the end of the zip file to the start, and after each batch of
+    members the zip file is truncated before them. The list of members is saved to a journal
+    (`{path_to_zip_file}.extract.json`) before anything is truncated, so an extraction that stops resumes with the
+    members that are still in the zip file. The checksum of each extracted file is added to the records of the
+    extraction (`{path_to_zip_file}.extract.records.jsonl`) before its batch is truncated.
+
+    Attributes
+    ----------
+    path_to_zip_file : pathlib.Path
+        path to the zip file, which is removed once all files are extracted
+    extraction_path : pathlib.Path
+        path to directory to extract the files to
+    metadata_dir : pathlib.Path, optional
+        path to directory for the metadata CSV files at the top of the zip file
+    nested_zips : Dict[str, pathlib.Path], optional
+        path to directory to extract the files of each nested zip file to by the name of the nested zip file
+    num_workers : int, default 8
+        number of members to extract at once
+    records_path : pathlib.Path, optional
+        path to the records of the extraction that a temporary nested zip file adds its files to, where the files of a
+        temporary zip file are recorded without a position since they are not at a position of the download
+
+    Returns
+    -------
+    List[dict]
+        position in the download ("header_offset", None for files of compressed nested zip files), compression, sizes,
+        CRC, path ("destination"), and SHA-256 checksum ("sha256") of each extracted file
+    """
+    path_to_zip_file = pathlib.Path(path_to_zip_file)
+    journal_path = pathlib.Path(f"{path_to_zip_file}.extract.json")
+    in_download = records_path is None
+    records_path = pathlib.Path(records_path or f"{path_to_zip_file}.extract.records.jsonl")
+    if journal_path.exists():
+        with open(journal_path, "r") as journal_file:
+            members = json.load(journal_file)
+    else:
+        members = plan_zip_extraction(
+            path_to_zip_file=path_to_zip_file,
+            extraction_path=extraction_path,
+            metadata_dir=metadata_dir,
+            nested_zips=nested_zips,
+        )
+        # write to a temporary file first so the journal is never left half written if the extraction is stopped
+        temporary_path = journal_path.with_suffix(".tmp")
+        with open(temporary_path, "w") as journal_file:
+            json.dump(members, journal_file)
+        temporary_path.replace(journal_path)
+
+    # members before the end of the zip file have not been extracted yet (members after it were truncated away)
+    zip_size = path_to_zip_file.stat().st_size
+    remaining = sorted(
+        (member for member in members if member["header_offset"] < zip_size),
+        key=lambda member: member["header_offset"],
+        reverse=True,
+    )
+    print(f"Extracting {len(remaining)} of {len(members)} files from {path_to_zip_file.name}")
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for batch_start in range(0, len(remaining), num_workers):
+            batch = remaining[batch_start : batch_start + num_workers]
+            checksums = list(executor.map(lambda member: extract_member(path_to_zip_file, member), batch))
+            with open(records_path, "a") as records_file:
+                for member, checksum in zip(batch, checksums):
+                    # the temporary zip files of compressed nested zip files are not kept, so they are not recorded
+                    if member["nested_extraction_path"] is None:
+                        record = {key: value for key, value in member.items() if key != "nested_extraction_path"}
+                        if not in_download:
+                            record["header_offset"] = None
+                        records_file.write(json.dumps({**record, "sha256": checksum}) + "\n")
+            # free the space of the extracted members (and anything after them, like the central directory)
+            with open(path_to_zip_file, "r+b") as zip_file:
+                zip_file.truncate(batch[-1]["header_offset"])
+
+    # compressed nested zip files were extracted to a temporary zip file, which is extracted the same way
+    for member in members:
+        if member["nested_extraction_path"] is not None and pathlib.Path(member["destination"]).exists():
+            extract_zip_in_place(
+                path_to_zip_file=member["destination"],
+                extraction_path=member["nested_extraction_path"],
+                num_workers=num_workers,
+                records_path=records_path,
+            )
+
+    extracted_files = load_extracted_files(records_path)
+    path_to_zip_file.unlink()
+    journal_path.unlink()
+    if in_download:
+        records_path.unlink()
+    print(f"All files within {path_to_zip_file.name} have been extracted!")
+    return extracted_files
+
+
+def index_zip(
+    path_to_zip_file: pathlib.Path,
+    extraction_path: pathlib.Path,
+    metadata_dir: Optional[pathlib.Path] = None,
+    nested_zips: Optional[Dict[str, pathlib.Path]] = None,
+) -> List[dict]:
+    """
+    Keep a zip file and save an index of its images (see `zip_images.write_index`) instead of extracting it, so the
+    images are read from the zip file. The metadata CSV files are still extracted to the metadata directory, and
+    compressed nested zip files are extracted to their own zip file (`{path_to_zip_file}.{name}`) since the images in
+    them cannot be read from the zip file.
+
+    Attributes
+    ----------
+    path_to_zip_file : pathlib.Path
+        path to the zip file, which is in the image directory
+    extraction_path : pathlib.Path
+        path to directory the files would be extracted to
+    metadata_dir : pathlib.Path, optional
+        path to directory for the metadata CSV files at the top of the zip file
+    nested_zips : Dict[str, pathlib.Path], optional
+        path to directory the files of each nested zip file would be extracted to by the name of the nested zip file
+
+    Returns
+    -------
+    List[dict]
+        index entry of each image in the zip file (and its nested zip files)
+    """
+    path_to_zip_file = pathlib.Path(path_to_zip_file)
+    images_dir = path_to_zip_file.parent
+
+    def index_members(zip_path: pathlib.Path, members: List[dict]) -> List[dict]:
+        entries = []
+        with open(zip_path, "rb") as zip_file:
+            for member in members:
+                entries.append(
+                    {
+                        "path": pathlib.Path(os.path.relpath(member["destination"], images_dir)).as_posix(),
+                        "archive": pathlib.Path(os.path.relpath(zip_path, images_dir)).as_posix(),
+                        "data_offset": member_data_offset(zip_file, member["header_offset"]),
+                        "compress_type": member["compress_type"],
+                        "compress_size": member["compress_size"],
+                        "file_size": member["file_size"],
+                        "crc": member["crc"],
+                    }
+                )
+        return entries
+
+    members = plan_zip_extraction(
+        path_to_zip_file=path_to_zip_file,
+        extraction_path=extraction_path,
+        metadata_dir=metadata_dir,
+        nested_zips=nested_zips,
+    )
+    images = []
+    entries = []
+    for member in members:
+        if member["nested_extraction_path"] is not None:
+            extract_member(path_to_zip_file, member)
+            nested_path = pathlib.Path(member["destination"])
+            entries.extend(
+                index_members(nested_path, plan_zip_extraction(nested_path, member["nested_extraction_path"]))
+            )
+        elif metadata_dir is not None and pathlib.Path(member["destination"]).parent == pathlib.Path(metadata_dir):
+            extract_member(path_to_zip_file, member)
+        else:
+            images.append(member)
+    entries.extend(index_members(path_to_zip_file, images))
+
+    zip_images.write_index(path_to_zip_file, entries)
+    print(f"Indexed {len(entries)} files within {path_to_zip_file.name} to read them from the zip file")
+    return entries
+
+
+def file_sha256(path: pathlib.Path) -> str:
+    """
+    Compute the SHA-256 checksum of a file, reading it one block at a time.
+
+    Attributes
+    ----------
+    path : pathlib.Path
+        path to the file
+
+    Returns
+    -------
+    str
+        SHA-256 checksum of the file
+    """
+    checksum = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE_BYTES), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def download_manifest_path(cache_dir: pathlib.Path, figshare_id: str) -> pathlib.Path:
+    """
+    Find the path to the download manifest of a Figshare item, which is named by the id and version of the item
+    (e.g., `22233292_v2.json` for `22233292/versions/2`).
+
+    Attributes
+    ----------
+    cache_dir : pathlib.Path
+        path to directory with the download manifests
+    figshare_id : str
+        Figshare identifier of the item with the version
+
+    Returns
+    -------
+    pathlib.Path
+        path to the download manifest
+    """
+    return pathlib.Path(cache_dir) / f"{figshare_id.replace('/versions/', '_v').replace('/', '_')}.json"
+
+
+def write_download_manifest(manifest_path: pathlib.Path, figshare_id: str, url: str, files: List[dict]) -> None:
+    """
+    Save the files extracted from a Figshare item with their size, modification time, and checksum, and remove the
+    manifests of the other versions of the item.
+
+    Attributes
+    ----------
+    manifest_path : pathlib.Path
+        path to the download manifest
+    figshare_id : str
+        Figshare identifier of the item with the version
+    url : str
+        URL the item was downloaded from
+    files : List[dict]
+        extracted files (see `extract_zip_in_place`)
+    """
+    for file in files:
+        stat = pathlib.Path(file["destination"]).stat()
+        file["mtime_ns"] = stat.st_mtime_ns
+
+    manifest_path = pathlib.Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so the manifest is never left half written if the notebook is stopped
+    temporary_path = manifest_path.with_suffix(".tmp")
+    with open(temporary_path, "w") as manifest_file:
+        json.dump({"figshare_id": figshare_id, "url": url, "files": files}, manifest_file)
+    temporary_path.replace(manifest_path)
+
+    item_id = figshare_id.split("/")[0]
+    for other_path in manifest_path.parent.glob(f"{item_id}_v*.json"):
+        if other_path != manifest_path:
+            other_path.unlink()
+
+
+def find_damaged_files(files: List[dict], verify_checksums: bool = False) -> List[dict]:
+    """
+    Find the extracted files that are missing or do not match the download manifest. A file with the recorded size
+    and modification time is assumed to be unchanged, so only files with a different modification time (or every file
+    when `verify_checksums` is set) are checksummed.
+
+    Attributes
+    ----------
+    files : List[dict]
+        files in the download manifest
+    verify_checksums : bool, default False
+        if set to True, every file is checksummed
+
+    Returns
+    -------
+    List[dict]
+        files that are missing or corrupted
+    """
+    damaged = []
+    for file in files:
+        path = pathlib.Path(file["destination"])
+        if not path.exists():
+            damaged.append(file)
+            continue
+        stat = path.stat()
+        # files that were compressed after they were extracted (see `record_compressed_files`) are checked against
+        # the compressed file
+        if stat.st_size != file.get("stored_size", file["file_size"]):
+            damaged.append(file)
+        elif verify_checksums or stat.st_mtime_ns != file["mtime_ns"]:
+            if file_sha256(path) != file.get("stored_sha256", file["sha256"]):
+                damaged.append(file)
+            else:
+                # the file was only touched, so the check is fast again the next time
+                file["mtime_ns"] = stat.st_mtime_ns
+    return damaged
+
+
+def record_compressed_files(cache_dir: pathlib.Path, compressed: List[dict]) -> None:
+    """
+    Record the size and checksum of extracted files that were compressed (see `image_compression`) in the download
+    manifests, so they are not downloaded again as corrupted files. The paths in the manifests are relative to the
+    directory with the download cache, which is where the files were downloaded from.
+
+    Attributes
+    ----------
+    cache_dir : pathlib.Path
+        path to directory with the download manifests
+    compressed : List[dict]
+        path ("path"), size after compression ("compressed_bytes"), and checksum ("sha256") of each compressed file
+    """
+    cache_dir = pathlib.Path(cache_dir)
+    by_path = {str(pathlib.Path(file["path"]).resolve()): file for file in compressed}
+    for manifest_path in sorted(cache_dir.glob("*.json")):
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        changed = False
+        for file in manifest["files"]:
+            compressed_file = by_path.get(str((cache_dir.parent / file["destination"]).resolve()))
+            if compressed_file is not None:
+                file["stored_size"] = compressed_file["compressed_bytes"]
+                file["stored_sha256"] = compressed_file["sha256"]
+                file["mtime_ns"] = pathlib.Path(compressed_file["path"]).stat().st_mtime_ns
+                changed = True
+        if changed:
+            temporary_path = manifest_path.with_suffix(".tmp")
+            with open(temporary_path, "w") as manifest_file:
+                json.dump(manifest, manifest_file)
+            temporary_path.replace(manifest_path)
+
+
+def fetch_member(url: str, member: dict, transfer_limits: TransferLimits) -> str:
+    """
+    Download one member of a zip file from its byte range in the download and extract it, which is downloaded again
+    when the connection drops (up to `RANGE_RETRIES` times).
+
+    Attributes
+    ----------
+    url : str
+        URL of the zip file
+    member : dict
+        position, compression, sizes, CRC, and path to extract to for the member (see `plan_zip_extraction`)
+    transfer_limits : TransferLimits
+        connection and bandwidth limits shared across downloads
+
+    Returns
+    -------
+    str
+        SHA-256 checksum of the extracted file
+    """
+
+    class ThrottledResponse:
+        # pace the reads from the response with the bandwidth limit
+        def __init__(self, response):
+            self.response = response
+
+        def read(self, num_bytes: int) -> bytes:
+            block = self.response.read(num_bytes)
+            transfer_limits.throttle(len(block))
+            return block
+
+    def open_range(start: int, end: int):
+        request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}"})
+        response = urllib.request.urlopen(request, timeout=60)
+        if response.status != 206:
+            response.close()
+            raise urllib.error.URLError(f"expected partial content but received {response.status}")
+        return response
+
+    for attempt in range(RANGE_RETRIES + 1):
+        try:
+            with transfer_limits.connections:
+                # the length of the name and extra field in the local file header gives where the data starts
+                with open_range(member["header_offset"], member["header_offset"] + LOCAL_HEADER_SIZE - 1) as response:
+                    header = response.read(LOCAL_HEADER_SIZE)
+                if header[:4] != LOCAL_HEADER_SIGNATURE:
+                    raise zipfile.BadZipFile(f"No local file header at byte {member['header_offset']} of {url}")
+                name_length, extra_length = struct.unpack("<HH", header[26:30])
+                data_offset = member["header_offset"] + LOCAL_HEADER_SIZE + name_length + extra_length
+                if member["compress_size"] == 0:
+                    return write_member(io.BytesIO(), member)
+                with open_range(data_offset, data_offset + member["compress_size"] - 1) as response:
+                    return write_member(ThrottledResponse(response), member)
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as error:
+            if attempt == RANGE_RETRIES:
+                raise
+            print(f"Downloading {member['destination']} failed ({error}), retrying")
+            time.sleep(2**attempt)
+
+
+def repair_download(
+    url: str,
+    damaged: List[dict],
+    num_connections: int = 4,
+    transfer_limits: Optional[TransferLimits] = None,
+) -> bool:
+    """
+    Download only the missing or corrupted files of an extracted item from their byte ranges in the download. The
+    files cannot be repaired this way if the server does not support byte ranges, if a file was in a compressed nested
+    zip file, or if the download no longer matches the manifest (e.g., the CRC of a file is different).
+
+    Attributes
+    ----------
+    url : str
+        URL of the zip file
+    damaged : List[dict]
+        files in the download manifest that are missing or corrupted
+    num_connections : int, default 4
+        number of files to download at once
+    transfer_limits : TransferLimits, optional
+        connection and bandwidth limits shared with other downloads
+
+    Returns
+    -------
+    bool
+        True if all of the files were downloaded again, otherwise the whole item must be downloaded again
+    """
+    if any(file["header_offset"] is None for file in damaged) or not probe_download(url)[1]:
+        return False
+    transfer_limits = transfer_limits or TransferLimits(max_connections=num_connections)
+
+    def repair_file(file: dict) -> None:
+        file["sha256"] = fetch_member(url=url, member=file, transfer_limits=transfer_limits)
+        # the file from the download is not compressed
+        file.pop("stored_size", None)
+        file.pop("stored_sha256", None)
+
+    try:
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            for _ in executor.map(repair_file, damaged):
+                pass
+    except zipfile.BadZipFile as error:
+        print(f"The download does not match the manifest ({error})")
+        return False
+    return True
 
 
 def download_figshare(
@@ -13,6 +1059,13 @@ def download_figshare(
     figshare_url: str = "https://ndownloader.figshare.com/files/",
     unzip_download: bool = False,
     output_dir: pathlib.Path = None,
+    num_connections: int = 4,
+    transfer_limits: Optional[TransferLimits] = None,
+    nested_zips: Optional[Dict[str, pathlib.Path]] = None,
+    num_extract_workers: int = 8,
+    cache_dir: Optional[pathlib.Path] = None,
+    verify_checksums: bool = False,
+    extract_images: bool = True,
 ):
     """
     Download the provided figshare resource and extract the files from Figshare. Extract the downloaded
@@ -33,33 +1086,84 @@ def download_figshare(
         if set to True, then the expected download from Figshare is a zip file which will be unzipped
     output_dir : pathlib.Path, optional
         path to directory to extract images and metadata from zip file to
+    num_connections : int, default 4
+        number of connections to download byte ranges of the file over at once
+    transfer_limits : TransferLimits, optional
+        connection and bandwidth limits shared with other downloads that run at the same time
+    nested_zips : Dict[str, pathlib.Path], optional
+        path to directory to extract the images of each zip file inside the downloaded zip file to by its name
+    num_extract_workers : int, default 8
+        number of files to extract from the zip file at once
+    cache_dir : pathlib.Path, optional
+        path to directory to save a download manifest for each item and version to (see `write_download_manifest`),
+        which is used to skip items that are already extracted and to download only the files that are missing or
+        corrupted (the item is always downloaded if not given)
+    verify_checksums : bool, default False
+        if set to True, every extracted file is checksummed when checking an item against its download manifest
+        instead of only the files with a different size or modification time
+    extract_images : bool, default True
+        if set to False, the zip file is kept and indexed so the images are read from it (see `utils/zip_images.py`)
+        instead of being extracted, which only extracts the metadata
     """
-    # access the url and download the zip file from figshare containing files for plate (images + metadata)
-    urllib.request.urlretrieve(f"{figshare_url}/{figshare_id}", output_file)
+    url = f"{figshare_url}/{figshare_id}"
+    manifest_path = download_manifest_path(cache_dir, figshare_id) if cache_dir is not None else None
+    if manifest_path is not None and manifest_path.exists() and not pathlib.Path(output_file).exists():
+        with open(manifest_path, "r") as manifest_file:
+            files = json.load(manifest_file)["files"]
+        damaged = find_damaged_files(files, verify_checksums=verify_checksums)
+        if not damaged:
+            write_download_manifest(manifest_path, figshare_id, url, files)
+            print(f"All {len(files)} files for the item with ID {figshare_id} are already extracted!")
+            return
+        print(f"{len(damaged)} of {len(files)} files for the item with ID {figshare_id} are missing or corrupted")
+        if repair_download(url, damaged, num_connections=num_connections, transfer_limits=transfer_limits):
+            write_download_manifest(manifest_path, figshare_id, url, files)
+            print(f"The missing or corrupted files for the item with ID {figshare_id} have been downloaded again!")
+            return
+        print(f"Downloading the whole item with ID {figshare_id} again")
 
-    if unzip_download:
-        # find the zip file downloaded from figshare and then extract it into the specific folder
-        with zipfile.ZipFile(output_file, "r") as zip_files:
-            zip_files.extractall(output_dir)
+    # access the url and download the zip file from figshare containing files for plate (images + metadata), which
+    # resumes from a partial download of the file (a finished download is only renamed to the output file once it is
+    # complete, so it is kept when the extraction stopped partway through)
+    if not pathlib.Path(output_file).exists():
+        download_file(
+            url=url,
+            output_file=output_file,
+            num_connections=num_connections,
+            transfer_limits=transfer_limits,
+        )
 
-        # remove the zip file from the directory
-        os.remove(output_file)
+    if unzip_download and not extract_images:
+        # keep the zip file and read the images from it through an index, which is only made once
+        if not zip_images.index_path(output_file).exists():
+            index_zip(
+                path_to_zip_file=output_file,
+                extraction_path=output_dir,
+                metadata_dir=metadata_dir,
+                nested_zips=nested_zips,
+            )
+        print(f"The images for plate with ID {str(figshare_id)} are read from {pathlib.Path(output_file).name}!")
+    elif unzip_download:
+        # extract the zip file into the specific folder with the metadata going into its own directory, which removes
+        # the zip file while it is extracted
+        extracted_files = extract_zip_in_place(
+            path_to_zip_file=output_file,
+            extraction_path=output_dir,
+            metadata_dir=metadata_dir,
+            nested_zips=nested_zips,
+            num_workers=num_extract_workers,
+        )
+        if manifest_path is not None:
+            write_download_manifest(manifest_path, figshare_id, url, extracted_files)
+        # the images are now read from the disk if the zip file was kept and indexed before
+        zip_images.index_path(output_file).unlink(missing_ok=True)
         print(
             f"The downloaded zip file contents have been extracted into {output_dir.name} folder for plate with ID {str(figshare_id)}!"
         )
+        print("The metadata has been moved into its own directory!")
     else:
         print("No files were extracted. Check to see if a zip file was downloaded.")
 
-    # glob the metadata files together to then copy and remove
-    metadata_files = glob.glob(f"{output_dir}/*.csv")
-    for files in metadata_files:
-        # copy the metadata downloaded from Figshare into the metadata dir (must use ../ to go back one to access this directory from the plate folder)
-        # which will overwrite the GitHub versioned metadata
-        shutil.copy(files, str(metadata_dir))
-        # remove the metadata from the plate directory to make it an images only directory
-        os.remove(files)
-    print("The metadata has been moved into its own directory!")
-
 
 def extract_zip_from_Figshare(
     path_to_zip_file: pathlib.Path, extraction_path: pathlib.Path
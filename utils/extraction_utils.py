@@ -7,51 +7,150 @@ sqlite file from CellProfiler (based on the functions from the cells.SingleCells
 # must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
 # by itself only works in Python 3.10
 from __future__ import annotations
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
 import pathlib
+import sqlite3
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# name of the metadata column with the number of single cells in the well of each single cell
+SC_COUNT_COLUMN = "Metadata_number_of_singlecells"
+
+# position of the single cell count column in the saved files
+SC_COUNT_COLUMN_INDEX = 2
+
+# number of rows of a CSV file to load at a time when adding the single cell counts
+CSV_CHUNK_SIZE = 100_000
+
+# number of rows to read from a SQLite table at a time
+SQLITE_CHUNK_SIZE = 100_000
+
+
+def count_group_sizes(keys: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function finds the size of the group of each row from one or more key columns by factorizing the keys
+    into group codes and counting the codes, so no groupby or merge is needed.
+
+    Args:
+        keys (pd.DataFrame):
+            dataframe with the key column(s) that make up a group (e.g. plate, well, and site)
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]:
+            number of rows in the group of each row and if each row has a value for every key (rows without a value
+            are not counted in any group)
+    """
+    codes = np.zeros(len(keys), dtype=np.int64)
+    valid = np.ones(len(keys), dtype=bool)
+    for column in keys.columns:
+        column_codes, uniques = pd.factorize(keys[column])
+        valid &= column_codes >= 0
+        # combine the codes of the keys so far with the codes of this key and factorize again to keep them small
+        codes, _ = pd.factorize(codes * (len(uniques) + 1) + column_codes + 1)
+    sizes = np.bincount(codes[valid], minlength=codes.max() + 1 if len(codes) else 0)
+    return sizes[codes], valid
 
 
 def add_single_cell_count_df(
-    data_df: pd.DataFrame, well_column_name: str = "Metadata_Well"
-) -> pd.DataFrame:
+    data_df: Union[pd.DataFrame, pa.Table],
+    well_column_name: str = "Metadata_Well",
+    strata: Optional[List[str]] = None,
+) -> Union[pd.DataFrame, pa.Table]:
     """
-    This function adds a column with the number of singles cells per well to a pandas dataframe.
+    This function adds a column with the number of singles cells per well (or per group of strata) to a pandas
+    dataframe or Arrow table. The group sizes are broadcast to the rows from the factorized keys (see
+    `count_group_sizes`), so only the key columns are read and the data is not copied.
 
     Args:
-        data_df (pd.DataFrame):
-            dataframe to add number of single cells to
+        data_df (Union[pd.DataFrame, pa.Table]):
+            dataframe or Arrow table to add number of single cells to
         well_column_name (str):
             name of column for wells to use for finding single cell count (defaults to "Metadata_Well")
+        strata (List[str], optional):
+            names of columns that make up a group to count single cells in instead of the well column, which is
+            needed when plates are concatenated (e.g. ["Metadata_Plate", "Metadata_Well", "Metadata_Site"])
 
     Returns:
-        pd.DataFrame:
-            pandas dataframe with new metadata column with single cell count
+        Union[pd.DataFrame, pa.Table]:
+            dataframe or Arrow table (the same type as the input) with new metadata column with single cell count,
+            where rows without a value for every key are dropped
     """
-    merged_data = (
-        data_df.groupby([well_column_name])[well_column_name]
-        .count()
-        .reset_index(name="Metadata_number_of_singlecells")
-    )
+    strata = strata or [well_column_name]
 
-    data_df = data_df.merge(merged_data, on=well_column_name)
-    # pop out the column from the dataframe
-    singlecell_column = data_df.pop("Metadata_number_of_singlecells")
+    if isinstance(data_df, pa.Table):
+        counts, valid = count_group_sizes(data_df.select(strata).to_pandas())
+        if SC_COUNT_COLUMN in data_df.column_names:
+            data_df = data_df.drop([SC_COUNT_COLUMN])
+        if not valid.all():
+            data_df = data_df.filter(pa.array(valid))
+        # insert the column as the second index column in the table
+        return data_df.add_column(SC_COUNT_COLUMN_INDEX, SC_COUNT_COLUMN, pa.array(counts[valid]))
+
+    counts, valid = count_group_sizes(data_df[strata])
+    # a shallow copy shares the data with the input dataframe, so the column is added without changing the input
+    data_df = data_df.copy(deep=False) if valid.all() else data_df[valid]
+    if SC_COUNT_COLUMN in data_df.columns:
+        del data_df[SC_COUNT_COLUMN]
     # insert the column as the second index column in the dataframe
-    data_df.insert(2, "Metadata_number_of_singlecells", singlecell_column)
+    data_df.insert(SC_COUNT_COLUMN_INDEX, SC_COUNT_COLUMN, counts[valid])
 
     return data_df
 
 
+def count_single_cells_per_well(
+    data_path: pathlib.Path,
+    well_column_name: str = "Metadata_Well",
+    file_type: str = "csv.gz",
+) -> Dict[str, int]:
+    """
+    This function counts the single cells (rows) in each well of a saved file, reading only the well column
+    so the features are never loaded.
+
+    Args:
+        data_path (pathlib.Path):
+            path to data file to count single cells in
+        well_column_name (str):
+            name of column for wells to use for finding single cell count (defaults to "Metadata_Well")
+        file_type (str, optional):
+            the file type of the data (options include parquet, csv, defaults to "csv.gz")
+
+    Returns:
+        Dict[str, int]:
+            number of single cells in each well (rows without a well are not counted)
+    """
+    if file_type == "parquet":
+        counts = pc.value_counts(pq.read_table(data_path, columns=[well_column_name])[well_column_name])
+        return {
+            well: count
+            for well, count in zip(counts.field("values").to_pylist(), counts.field("counts").to_pylist())
+            if well is not None
+        }
+
+    counts = pd.Series(dtype="int64")
+    for chunk in pd.read_csv(
+        data_path,
+        compression="gzip" if file_type == "csv.gz" else None,
+        usecols=[well_column_name],
+        chunksize=CSV_CHUNK_SIZE,
+    ):
+        counts = counts.add(chunk[well_column_name].value_counts(), fill_value=0)
+    return {well: int(count) for well, count in counts.items()}
+
+
 def add_sc_count_metadata_file(
     data_path: pathlib.Path,
     well_column_name: str = "Metadata_Well",
     file_type: str = "csv.gz",
 ):
     """
-    This function loads in the saved file from Pycytominer or CytoTable (e.g. normalized, etc.), adds the single cell counts for
-    each well as metadata, and saves the file to the same place (as the same file type)
+    This function adds the single cell counts for each well as metadata to a saved file from Pycytominer or
+    CytoTable (e.g. normalized, etc.) and saves the file to the same place (as the same file type). The counts are
+    found from the well column only, and the file is rewritten one batch of rows at a time, so the memory used does
+    not depend on the size of the file.
 
     Args:
         data_path (pathlib.Path):
@@ -61,50 +160,393 @@ def add_sc_count_metadata_file(
         file_type (str, optional):
             the file type of the data (options include parquet, csv, defaults to "csv.gz")
     """
-    # load in data
-    if file_type == "csv.gz":
-        data_df = pd.read_csv(data_path, compression="gzip")
-    if file_type == "parquet":
-        data_df = pd.read_parquet(data_path)
-    if file_type == "csv":
-        data_df = pd.read_csv(data_path)
-
-    # add single cell count as new metadata column
-    data_df = add_single_cell_count_df(
-        data_df=data_df, well_column_name=well_column_name
+    data_path = pathlib.Path(data_path)
+    counts = count_single_cells_per_well(
+        data_path=data_path, well_column_name=well_column_name, file_type=file_type
     )
 
-    # save updated df to same path as the same file type
+    # the file is written to a temporary file next to it first so the data is never left half written
+    temporary_path = data_path.with_name(f".{data_path.name}.tmp")
+
     if file_type == "parquet":
-        data_df.to_parquet(data_path)
-    if file_type == "csv.gz":
-        data_df.to_csv(data_path, compression="gzip")
-    if file_type == "csv":
-        data_df.to_csv(data_path)
+        wells = pa.array(list(counts.keys()), type=pa.string())
+        well_counts = pa.array(list(counts.values()), type=pa.int64())
+        parquet_file = pq.ParquetFile(data_path)
+
+        # insert the column as the second index column, replacing the column if the counts were added before, where
+        # the pandas metadata is removed since it lists the columns of the original file
+        schema = parquet_file.schema_arrow
+        if SC_COUNT_COLUMN in schema.names:
+            schema = schema.remove(schema.get_field_index(SC_COUNT_COLUMN))
+        schema = schema.insert(SC_COUNT_COLUMN_INDEX, pa.field(SC_COUNT_COLUMN, pa.int64()))
+        schema = schema.with_metadata(
+            {key: value for key, value in (schema.metadata or {}).items() if key != b"pandas"}
+        )
+
+        with pq.ParquetWriter(temporary_path, schema) as writer:
+            for batch in parquet_file.iter_batches():
+                table = pa.Table.from_batches([batch])
+                if SC_COUNT_COLUMN in table.column_names:
+                    table = table.drop([SC_COUNT_COLUMN])
+                # rows without a well do not have a single cell count, so they are dropped
+                table = table.filter(pc.is_valid(table[well_column_name]))
+                well_index = pc.index_in(table[well_column_name].cast(pa.string()), value_set=wells)
+                table = table.add_column(SC_COUNT_COLUMN_INDEX, SC_COUNT_COLUMN, pc.take(well_counts, well_index))
+                writer.write_table(table.cast(schema))
+
+    else:
+        num_rows = 0
+        for chunk in pd.read_csv(
+            data_path,
+            compression="gzip" if file_type == "csv.gz" else None,
+            chunksize=CSV_CHUNK_SIZE,
+        ):
+            chunk = chunk.drop(columns=[SC_COUNT_COLUMN], errors="ignore")
+            # rows without a well do not have a single cell count, so they are dropped
+            chunk = chunk[chunk[well_column_name].notna()]
+            chunk.insert(SC_COUNT_COLUMN_INDEX, SC_COUNT_COLUMN, chunk[well_column_name].map(counts).astype("int64"))
+            chunk.index = range(num_rows, num_rows + len(chunk))
+            chunk.to_csv(
+                temporary_path,
+                mode="w" if num_rows == 0 else "a",
+                header=num_rows == 0,
+                compression="gzip" if file_type == "csv.gz" else None,
+            )
+            num_rows += len(chunk)
+
+    temporary_path.replace(data_path)
+
+
+def sqlite_column_type(declared_type: str) -> pa.DataType:
+    """
+    find the Arrow type of a SQLite column from its declared type, following the SQLite type affinity rules
+
+    Parameters
+    ----------
+    declared_type : str
+        declared type of the column in the table (e.g. "FLOAT", "INTEGER", "TEXT")
+
+    Returns
+    -------
+    pa.DataType:
+        Arrow type to load the column as
+    """
+    declared_type = declared_type.upper()
+    if "INT" in declared_type:
+        return pa.int64()
+    if any(name in declared_type for name in ("CHAR", "CLOB", "TEXT")) or not declared_type:
+        return pa.string()
+    return pa.float64()
+
+
+def open_sqlite(sqlite_file_path: str) -> sqlite3.Connection:
+    """
+    open a sqlite file as read-only
+
+    Parameters
+    ----------
+    sqlite_file_path : str
+        string of path to the sqlite file (or a "sqlite:///" URL)
+
+    Returns
+    -------
+    sqlite3.Connection:
+        read-only connection to the sqlite file
+    """
+    sqlite_file_path = str(sqlite_file_path).replace("sqlite:///", "", 1)
+    return sqlite3.connect(f"file:{pathlib.Path(sqlite_file_path).resolve()}?mode=ro", uri=True)
+
+
+def sqlite_table_schema(sqlite_file_path: str, image_table_name: str = "Per_Image") -> Dict[str, str]:
+    """
+    find the columns of a table in a sqlite file with their declared types, without reading any rows
+
+    Parameters
+    ----------
+    sqlite_file_path : str
+        string of path to the sqlite file
+    image_table_name : str
+        string of the name with the image feature data (default = "Per_Image")
+
+    Returns
+    -------
+    Dict[str, str]:
+        declared type of each column in the order of the table
+    """
+    connection = open_sqlite(sqlite_file_path)
+    try:
+        table_columns = {
+            name: declared_type
+            for _, name, declared_type, *_ in connection.execute(f'PRAGMA table_info("{image_table_name}")')
+        }
+    finally:
+        connection.close()
+    if not table_columns:
+        raise KeyError(f"There is no {image_table_name} table in {sqlite_file_path}")
+    return table_columns
+
+
+def select_sqlite_columns(
+    table_columns: Dict[str, str],
+    image_feature_categories: Optional[List[str]] = None,
+    columns: Optional[List[str]] = None,
+) -> List[str]:
+    """
+    find the columns of a table that start with the image feature categories or are one of the given columns
+    (every column if neither is given)
+
+    Parameters
+    ----------
+    table_columns : Dict[str, str]
+        declared type of each column in the table (see `sqlite_table_schema`)
+    image_feature_categories : list of str, optional
+        image feature group(s) to select including the prefix (e.g. ["Image_ImageQuality"])
+    columns : list of str, optional
+        other columns to select
+
+    Returns
+    -------
+    list of str:
+        selected columns in the order of the table
+    """
+    if image_feature_categories is None and columns is None:
+        return list(table_columns)
+    missing = sorted(set(columns or []) - set(table_columns))
+    if missing:
+        raise KeyError(f"The columns {missing} are not in the table")
+    return [
+        name
+        for name in table_columns
+        if name in (columns or []) or name.startswith(tuple(image_feature_categories or []))
+    ]
+
+
+def read_sqlite_table(
+    sqlite_file_path: str,
+    image_table_name: str,
+    selected: List[str],
+    types: List[pa.DataType],
+    chunk_size: int = SQLITE_CHUNK_SIZE,
+) -> pa.Table:
+    """
+    read columns of a table in a sqlite file in chunks straight into typed Arrow arrays, so the table is never
+    held as Python objects
+
+    Parameters
+    ----------
+    sqlite_file_path : str
+        string of path to the sqlite file
+    image_table_name : str
+        string of the name with the image feature data
+    selected : list of str
+        columns to read
+    types : list of pa.DataType
+        Arrow type of each column (see `sqlite_column_type`)
+    chunk_size : int
+        number of rows to read from SQLite at a time (default = 100,000)
+
+    Returns
+    -------
+    pa.Table:
+        table with the columns
+    """
+    chunks = [[] for _ in selected]
+    connection = open_sqlite(sqlite_file_path)
+    try:
+        cursor = connection.execute(
+            "SELECT " + ", ".join(f'"{name}"' for name in selected) + f' FROM "{image_table_name}"'
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for index, values in enumerate(zip(*rows)):
+                chunks[index].append(pa.array(values, type=types[index]))
+    finally:
+        connection.close()
+
+    return pa.Table.from_arrays(
+        [pa.chunked_array(column_chunks, type=column_type) for column_chunks, column_type in zip(chunks, types)],
+        names=selected,
+    )
 
 
 def load_sqlite_as_df(
     sqlite_file_path: str,
     image_table_name: str = "Per_Image",
+    image_feature_categories: Optional[List[str]] = None,
+    columns: Optional[List[str]] = None,
+    chunk_size: int = SQLITE_CHUNK_SIZE,
 ) -> pd.DataFrame:
     """
-    load in table with image feature data from sqlite file
+    load in table with image feature data from sqlite file, where only the columns that start with the image
+    feature categories and the given columns are read (every column if neither is given). The rows are read
+    from SQLite in chunks straight into typed Arrow arrays (based on the declared type of each column), so the
+    table is never held as Python objects.
 
     Parameters
     ----------
     sqlite_file_path : str
-        string of path to the sqlite file
+        string of path to the sqlite file (or a "sqlite:///" URL)
     image_table_name : str
         string of the name with the image feature data (default = "Per_Image")
+    image_feature_categories : list of str, optional
+        image feature group(s) to read including the prefix (e.g. ["Image_ImageQuality"])
+    columns : list of str, optional
+        other columns to read (e.g. the image_cols and strata for `extract_image_features`)
+    chunk_size : int
+        number of rows to read from SQLite at a time (default = 100,000)
 
     Returns
     -------
     pd.DataFrame:
         dataframe containing image feature data
     """
-    image_df = pd.read_sql_table(image_table_name, sqlite_file_path)
+    table_columns = sqlite_table_schema(sqlite_file_path, image_table_name)
+    selected = select_sqlite_columns(table_columns, image_feature_categories, columns)
+    types = [sqlite_column_type(table_columns[name]) for name in selected]
+    return read_sqlite_table(sqlite_file_path, image_table_name, selected, types, chunk_size).to_pandas()
+
+
+def write_plate_image_features(
+    sqlite_file_path: str,
+    image_table_name: str,
+    selected: List[str],
+    names: List[str],
+    types: List[pa.DataType],
+    dest_file: pathlib.Path,
+    chunk_size: int = SQLITE_CHUNK_SIZE,
+) -> int:
+    """
+    read the selected image features of one plate and save them as a partition of the image feature dataset,
+    where the columns of the dataset that the plate does not have (e.g. channels only in other plates) are empty
+
+    Parameters
+    ----------
+    sqlite_file_path : str
+        string of path to the sqlite file of the plate
+    image_table_name : str
+        string of the name with the image feature data
+    selected : list of str
+        columns to read from the plate
+    names : list of str
+        columns of the dataset
+    types : list of pa.DataType
+        Arrow type of each column of the dataset
+    dest_file : pathlib.Path
+        path to the Parquet file for the partition of the plate
+    chunk_size : int
+        number of rows to read from SQLite at a time (default = 100,000)
+
+    Returns
+    -------
+    int:
+        number of rows saved for the plate
+    """
+    column_types = dict(zip(names, types))
+    plate_table = read_sqlite_table(
+        sqlite_file_path, image_table_name, selected, [column_types[name] for name in selected], chunk_size
+    )
+    plate_table = pa.Table.from_arrays(
+        [
+            plate_table[name] if name in selected else pa.nulls(plate_table.num_rows, type=column_type)
+            for name, column_type in column_types.items()
+        ],
+        names=names,
+    )
+
+    # write to a temporary file first so a partition is never left half written
+    dest_file = pathlib.Path(dest_file)
+    dest_file.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = dest_file.with_name(f".{dest_file.name}.tmp")
+    pq.write_table(plate_table, temporary_path)
+    temporary_path.replace(dest_file)
+    return plate_table.num_rows
+
+
+def extract_image_features_from_plates(
+    sqlite_dir: pathlib.Path,
+    dest_dir: pathlib.Path,
+    image_feature_categories: List[str],
+    image_cols: List[str],
+    strata: List[str],
+    plates: Optional[List[str]] = None,
+    image_table_name: str = "Per_Image",
+    sqlite_suffix: str = "_nf1_analysis.sqlite",
+    max_workers: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    extract image features from the sqlite file of every plate (`{sqlite_dir}/{plate}/{plate}{sqlite_suffix}`) into
+    one Parquet dataset partitioned by plate (`{dest_dir}/plate={plate}/`). The columns are selected once for each
+    distinct table schema (plates with the same channels share the selection), and the plates are read in parallel
+    processes that each save their own partition.
+
+    Parameters
+    ----------
+    sqlite_dir : pathlib.Path
+        directory with a folder per plate with the sqlite file from CellProfiler (e.g. analysis_output)
+    dest_dir : pathlib.Path
+        directory to save the partitioned Parquet dataset to
+    image_feature_categories : list of str
+        input image feature group(s) to extract from the image table including the prefix (e.g. ["Image_Correlation", "Image_ImageQuality"])
+    image_cols : list of str
+        column(s) to select from the image table to include
+    strata : list of str
+        the columns to groupby and add to the extracted dataset
+    plates : list of str, optional
+        names of the plates to extract, which defaults to every plate with a sqlite file
+    image_table_name : str
+        string of the name with the image feature data (default = "Per_Image")
+    sqlite_suffix : str
+        end of the name of the sqlite file after the plate name (default = "_nf1_analysis.sqlite")
+    max_workers : int, optional
+        number of plates to read at once, which defaults to the number of CPUs on the machine
+
+    Returns
+    -------
+    Dict[str, int]:
+        number of rows saved for each plate
+    """
+    sqlite_paths = {
+        path.name[: -len(sqlite_suffix)]: path
+        for path in sorted(pathlib.Path(sqlite_dir).glob(f"*/*{sqlite_suffix}"))
+        if plates is None or path.name[: -len(sqlite_suffix)] in plates
+    }
+    missing = sorted(set(plates or []) - set(sqlite_paths))
+    if missing:
+        raise FileNotFoundError(f"There are no sqlite files for the plates {missing} in {sqlite_dir}")
+
+    # select the columns once for each distinct schema, and combine the selections into the columns of the dataset
+    selections = {}
+    plate_selections = {}
+    column_types = {}
+    for plate, path in sqlite_paths.items():
+        table_columns = sqlite_table_schema(path, image_table_name)
+        schema_key = tuple(table_columns.items())
+        if schema_key not in selections:
+            selections[schema_key] = select_sqlite_columns(
+                table_columns,
+                image_feature_categories=image_feature_categories,
+                columns=list(np.union1d(image_cols, strata)),
+            )
+            for name in selections[schema_key]:
+                column_types.setdefault(name, sqlite_column_type(table_columns[name]))
+        plate_selections[plate] = selections[schema_key]
 
-    return image_df
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            plate: executor.submit(
+                write_plate_image_features,
+                str(path),
+                image_table_name,
+                plate_selections[plate],
+                list(column_types),
+                list(column_types.values()),
+                pathlib.Path(dest_dir) / f"plate={plate}" / f"{plate}.parquet",
+            )
+            for plate, path in sqlite_paths.items()
+        }
+        return {plate: future.result() for plate, future in futures.items()}
 
 
 def extract_image_features(
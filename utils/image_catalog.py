@@ -0,0 +1,314 @@
+"""
+This collection of functions keeps a catalog of every image in an image directory (e.g., 0.download_data or
+Corrected_Images) as a Parquet file, with the plate, well, site, channel, stain, size, modification time, and
+checksum of each image. The catalog is updated incrementally (only new or changed images are checksummed) and
+is used to find the plates and their image directories without walking the image directories. Images in zip files
+that were kept instead of extracted (see `zip_images`) are listed with the path they would have if extracted and
+the zip file they are read from.
+
+To update the catalog for a directory (e.g., after adding images), run this file as a script:
+
+    python utils/image_catalog.py 0.download_data
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import argparse
+import hashlib
+import os
+import pathlib
+import re
+
+import pandas as pd
+
+import zip_images
+
+# name of the catalog file that is saved in the image directory it catalogs
+CATALOG_NAME = "image_catalog.parquet"
+
+# image file extensions that are added to the catalog
+IMAGE_EXTENSIONS = (".tif", ".tiff", ".png", ".jpg", ".jpeg")
+
+# plate folders are the top level folders in the image directory, which start with "Corrected_" for corrected images
+PLATE_DIRECTORY_PATTERN = re.compile(r"^(?:Corrected_)?(?P<plate>Plate_.+)$")
+
+# image file names include the well, channel number, site, and stain (e.g., B10_01_1_10_DAPI_001.tif)
+IMAGE_NAME_PATTERN = re.compile(
+    r"(?P<well>[A-Z]{1}[0-9]{1,2})_01_(?P<channel>[0-9]{1})_(?P<site>[0-9]{1,2})_(?P<stain>DAPI|CY5|GFP|RFP)"
+)
+
+# columns of the catalog, where the path (and the zip file for images that are read from a zip file) is relative to
+# the image directory
+CATALOG_COLUMNS = [
+    "plate",
+    "plate_directory",
+    "well",
+    "site",
+    "channel",
+    "stain",
+    "path",
+    "archive",
+    "size_bytes",
+    "mtime_ns",
+    "sha256",
+]
+
+
+def file_checksum(file_path: pathlib.Path, chunk_size: int = 1024**2) -> str:
+    """Find the SHA256 checksum of a file, reading it in chunks so large images are not loaded into memory.
+
+    Args:
+        file_path (pathlib.Path): path to the file
+        chunk_size (int, optional): number of bytes to read at a time (default is 1 MiB)
+
+    Returns:
+        str: hex digest of the file contents
+    """
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def scan_images(images_dir: pathlib.Path) -> List[dict]:
+    """Find every image in the plate folders of an image directory with the size and modification time from the
+    directory entries (images are not opened), and every image in the indexes of the zip files in the directory that
+    is not extracted with the size from the index and the modification time of the zip file.
+
+    Args:
+        images_dir (pathlib.Path): path to the directory with a folder per plate
+
+    Returns:
+        List[dict]: plate, plate folder, path (relative to the image directory), zip file (None for extracted images),
+        size, and modification time of each image
+    """
+    images = []
+    for plate_entry in sorted(os.scandir(images_dir), key=lambda entry: entry.name):
+        match = PLATE_DIRECTORY_PATTERN.match(plate_entry.name)
+        if not plate_entry.is_dir() or match is None:
+            continue
+        directories = [plate_entry.path]
+        while directories:
+            for entry in os.scandir(directories.pop()):
+                # skip hidden folders and files like the `Images` module rule in the CellProfiler pipelines
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif pathlib.Path(entry.name).suffix.lower() in IMAGE_EXTENSIONS:
+                    stat = entry.stat()
+                    images.append(
+                        {
+                            "plate": match.group("plate"),
+                            "plate_directory": plate_entry.name,
+                            "path": pathlib.Path(entry.path).relative_to(images_dir).as_posix(),
+                            "archive": None,
+                            "size_bytes": stat.st_size,
+                            "mtime_ns": stat.st_mtime_ns,
+                        }
+                    )
+
+    extracted = {image["path"] for image in images}
+    archive_mtimes = {}
+    for path, member in sorted(zip_images.load_indexes(images_dir).items()):
+        plate_directory = pathlib.PurePosixPath(path).parts[0]
+        match = PLATE_DIRECTORY_PATTERN.match(plate_directory)
+        if path in extracted or match is None or pathlib.Path(path).suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+        if member["archive"] not in archive_mtimes:
+            archive_mtimes[member["archive"]] = (pathlib.Path(images_dir) / member["archive"]).stat().st_mtime_ns
+        images.append(
+            {
+                "plate": match.group("plate"),
+                "plate_directory": plate_directory,
+                "path": path,
+                "archive": member["archive"],
+                "size_bytes": member["file_size"],
+                "mtime_ns": archive_mtimes[member["archive"]],
+            }
+        )
+    return images
+
+
+def update_catalog(images_dir: pathlib.Path, num_workers: Optional[int] = None) -> pd.DataFrame:
+    """Update the catalog for an image directory, where only images that are new or have a different size or
+    modification time than in the catalog are checksummed, and images that no longer exist are removed.
+
+    Args:
+        images_dir (pathlib.Path): path to the directory with a folder per plate
+        num_workers (int, optional): number of threads to checksum images with, which defaults to the number of CPUs
+        on the machine (default is None)
+
+    Returns:
+        pd.DataFrame: updated catalog with one row per image
+    """
+    images_dir = pathlib.Path(images_dir)
+    catalog_path = images_dir / CATALOG_NAME
+    previous = (
+        pd.read_parquet(catalog_path) if catalog_path.exists() else pd.DataFrame(columns=CATALOG_COLUMNS)
+    )
+    previous_checksums = {
+        (path, size_bytes, mtime_ns): sha256
+        for path, size_bytes, mtime_ns, sha256 in previous[["path", "size_bytes", "mtime_ns", "sha256"]].itertuples(
+            index=False
+        )
+    }
+
+    images = scan_images(images_dir)
+    changed = [
+        image
+        for image in images
+        if (image["path"], image["size_bytes"], image["mtime_ns"]) not in previous_checksums
+    ]
+    # reading the images to checksum them is I/O bound, so threads are used
+    with zip_images.ZipImageStore(images_dir) as store, ThreadPoolExecutor(
+        max_workers=num_workers or os.cpu_count()
+    ) as executor:
+        checksums = executor.map(
+            lambda image: (
+                store.checksum(image["path"])
+                if image["archive"] is not None
+                else file_checksum(images_dir / image["path"])
+            ),
+            changed,
+        )
+        for image, checksum in zip(changed, checksums):
+            image["sha256"] = checksum
+    for image in images:
+        if "sha256" not in image:
+            image["sha256"] = previous_checksums[(image["path"], image["size_bytes"], image["mtime_ns"])]
+
+    # add the metadata from the image file names
+    for image in images:
+        match = IMAGE_NAME_PATTERN.search(pathlib.Path(image["path"]).name)
+        image.update(
+            {
+                "well": match.group("well") if match else None,
+                "site": int(match.group("site")) if match else None,
+                "channel": int(match.group("channel")) if match else None,
+                "stain": match.group("stain") if match else None,
+            }
+        )
+
+    removed = set(previous["path"]) - {image["path"] for image in images}
+    catalog = pd.DataFrame(sorted(images, key=lambda image: image["path"]), columns=CATALOG_COLUMNS)
+    catalog["site"] = catalog["site"].astype("Int64")
+    catalog["channel"] = catalog["channel"].astype("Int64")
+
+    # write to a temporary file first so the catalog is never left half written if the update is stopped, which is
+    # named by process so stages that update the same catalog at once (see `stage_scheduler`) do not share it
+    temporary_path = catalog_path.with_suffix(f".parquet.{os.getpid()}.tmp")
+    catalog.to_parquet(temporary_path, index=False)
+    temporary_path.replace(catalog_path)
+    print(
+        f"Updated the image catalog for {images_dir.name} with {len(catalog)} images "
+        f"({len(changed)} new or changed, {len(removed)} removed)"
+    )
+
+    return catalog
+
+
+def load_catalog(images_dir: pathlib.Path) -> pd.DataFrame:
+    """Load the catalog for an image directory, which is created if it does not exist yet.
+
+    Args:
+        images_dir (pathlib.Path): path to the directory with a folder per plate
+
+    Returns:
+        pd.DataFrame: catalog with one row per image
+    """
+    catalog_path = pathlib.Path(images_dir) / CATALOG_NAME
+    if not catalog_path.exists():
+        return update_catalog(images_dir)
+    return pd.read_parquet(catalog_path)
+
+
+def query_images(
+    images_dir: pathlib.Path,
+    plate: Optional[str] = None,
+    well: Optional[str] = None,
+    site: Optional[int] = None,
+    channel: Optional[int] = None,
+    stain: Optional[str] = None,
+) -> pd.DataFrame:
+    """Find the images in the catalog for an image directory that match all of the given metadata.
+
+    Args:
+        images_dir (pathlib.Path): path to the directory with a folder per plate
+        plate (str, optional): name of the plate (e.g., Plate_1) (default is None)
+        well (str, optional): name of the well (e.g., B10) (default is None)
+        site (int, optional): site number (default is None)
+        channel (int, optional): channel number (default is None)
+        stain (str, optional): name of the stain (e.g., DAPI) (default is None)
+
+    Returns:
+        pd.DataFrame: rows of the catalog for the matching images
+    """
+    catalog = load_catalog(images_dir)
+    filters = {"plate": plate, "well": well, "site": site, "channel": channel, "stain": stain}
+    for column, value in filters.items():
+        if value is not None:
+            catalog = catalog[catalog[column] == value]
+    return catalog.reset_index(drop=True)
+
+
+def list_plates(images_dir: pathlib.Path) -> List[str]:
+    """Find the names of the plates with images in the catalog for an image directory.
+
+    Args:
+        images_dir (pathlib.Path): path to the directory with a folder per plate
+
+    Returns:
+        List[str]: sorted names of the plates (e.g., Plate_1)
+    """
+    return sorted(load_catalog(images_dir)["plate"].unique().tolist())
+
+
+def plate_directories(images_dir: pathlib.Path, plates: Optional[List[str]] = None) -> Dict[str, pathlib.Path]:
+    """Find the folder with the images for each plate in the catalog for an image directory, where plates with images
+    that are only in a zip file (see `zip_images`) are skipped when no plates are given.
+
+    Args:
+        images_dir (pathlib.Path): path to the directory with a folder per plate
+        plates (List[str], optional): names of the plates to find, which defaults to all plates with extracted images
+        (default is None)
+
+    Raises:
+        KeyError: if a plate is not in the catalog
+        FileNotFoundError: if the images of a given plate are only in a zip file
+
+    Returns:
+        Dict[str, pathlib.Path]: absolute path to the folder of images for each plate
+    """
+    images_dir = pathlib.Path(images_dir)
+    directories = (
+        load_catalog(images_dir).drop_duplicates("plate").set_index("plate")["plate_directory"].to_dict()
+    )
+    missing = sorted(set(plates or []) - set(directories))
+    if missing:
+        raise KeyError(f"The plates {missing} are not in the image catalog for {images_dir.name}.")
+    zipped = sorted(plate for plate, directory in directories.items() if not (images_dir / directory).is_dir())
+
+    if plates is None:
+        if zipped:
+            print(f"Skipping the plates {zipped} in {images_dir.name}, which are only in a zip file")
+        plates = [plate for plate in sorted(directories) if plate not in zipped]
+    zipped_plates = [plate for plate in plates if plate in zipped]
+    if zipped_plates:
+        raise FileNotFoundError(
+            f"The images for {zipped_plates} are only in a zip file, so the plates must be extracted first "
+            "(see `extract_images` in 0.download_data)."
+        )
+    return {plate: (images_dir / directories[plate]).resolve(strict=True) for plate in plates}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the image catalog for an image directory.")
+    parser.add_argument("images_dir", type=pathlib.Path, help="path to the directory with a folder per plate")
+    args = parser.parse_args()
+    catalog = update_catalog(images_dir=args.images_dir)
+    print(catalog.groupby("plate").size().to_string())
@@ -0,0 +1,302 @@
+"""
+This collection of functions rewrites the uncompressed TIFF images of an image directory (e.g., 0.download_data or
+Corrected_Images) with lossless compression, which makes the images smaller to store (often 2-3 times) and faster to
+read from network storage. Each image is written to a temporary file and read back to check that every pixel is the
+same before it replaces the original image, so an image is never lost if the compression is stopped. Images that are
+already compressed are skipped, so running the compression again continues where it stopped.
+
+The default compression (zlib, with horizontal differencing) is read by CellProfiler. Zstandard (zstd) compresses
+faster, but needs the `imagecodecs` package and a Bio-Formats version that reads it, so confirm CellProfiler reads the
+images before using it. To compress the images of a directory and compare the read throughput before and after on a
+sample of images, run this file as a script:
+
+    python utils/image_compression.py 0.download_data --benchmark-sample 20
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import argparse
+import os
+import pathlib
+import random
+import time
+
+import numpy as np
+import tifffile
+
+import download_figshare
+import image_catalog
+
+# TIFF compression of images that are not compressed
+UNCOMPRESSED = 1
+
+# number of images to compress between updates of the download manifests
+MANIFEST_BATCH_SIZE = 1000
+
+# tags that tifffile writes from the pixels and the compression options, or that point to other places in the file
+# (e.g., the EXIF tags), so they are not copied from the original image
+WRITTEN_TAGS = (
+    "NewSubfileType",
+    "ImageWidth",
+    "ImageLength",
+    "BitsPerSample",
+    "Compression",
+    "PhotometricInterpretation",
+    "StripOffsets",
+    "SamplesPerPixel",
+    "RowsPerStrip",
+    "StripByteCounts",
+    "XResolution",
+    "YResolution",
+    "PlanarConfiguration",
+    "ResolutionUnit",
+    "Predictor",
+    "TileWidth",
+    "TileLength",
+    "TileOffsets",
+    "TileByteCounts",
+    "SubIFDs",
+    "ExtraSamples",
+    "SampleFormat",
+    "JPEGTables",
+    "YCbCrSubSampling",
+    "ExifTag",
+    "GPSTag",
+    "InteroperabilityTag",
+)
+
+# tags with the physical size of the pixels, which are written with the resolution options of tifffile
+RESOLUTION_TAGS = ("XResolution", "YResolution", "ResolutionUnit")
+
+
+def metadata_tags(page: tifffile.TiffPage) -> dict:
+    """Find the tags of a TIFF page that are kept when the image is compressed, which are the resolution and every
+    tag that is not written by tifffile (e.g., the image description with the ImageJ or microscope metadata, the
+    software, and the date and time).
+
+    Args:
+        page (tifffile.TiffPage): page of the TIFF image
+
+    Returns:
+        dict: value of each tag by its name
+    """
+    return {
+        tag.name: tag.value
+        for tag in page.tags.values()
+        if tag.name not in WRITTEN_TAGS or tag.name in RESOLUTION_TAGS
+    }
+
+
+def copied_tags(tiff: tifffile.TiffFile) -> List[tuple]:
+    """Find the tags of the first page of a TIFF image that are not written by tifffile, as tifffile extra tags with
+    the bytes of each value as they are in the file (so tags that tifffile decodes, like the ImageJ metadata, are
+    written back the same).
+
+    Args:
+        tiff (tifffile.TiffFile): open TIFF image
+
+    Returns:
+        List[tuple]: code, data type, count, value, and write once of each tag
+    """
+    tags = []
+    for tag in tiff.pages[0].tags.values():
+        if tag.name in WRITTEN_TAGS:
+            continue
+        tiff.filehandle.seek(tag.valueoffset)
+        tags.append((tag.code, int(tag.dtype), tag.count, tiff.filehandle.read(tag.valuebytecount), True))
+    return tags
+
+
+def compress_image(path: pathlib.Path, compression: str = "zlib", level: int = 6) -> Optional[dict]:
+    """Rewrite an uncompressed TIFF image with lossless compression, checking that the pixels and the metadata tags
+    (see `metadata_tags`) of the compressed image are the same as the original image before replacing it. Tags that
+    point to other places in the file (the EXIF and GPS tags) are not copied, and images without a resolution are
+    written with the default resolution of tifffile.
+
+    Args:
+        path (pathlib.Path): path to the image
+        compression (str, optional): name of the compression for tifffile, "zlib" or "zstd" (default is "zlib")
+        level (int, optional): compression level, where higher levels are smaller and slower to write (default is 6)
+
+    Raises:
+        ValueError: if the pixels or metadata tags of the compressed image are not the same as the original image
+
+    Returns:
+        Optional[dict]: path ("path"), size before ("original_bytes") and after ("compressed_bytes") compression, and
+        checksum of the compressed image ("sha256"), or None if the image was already compressed or has more than one
+        page
+    """
+    path = pathlib.Path(path)
+    with tifffile.TiffFile(path) as tiff:
+        if len(tiff.pages) != 1 or tiff.pages[0].compression != UNCOMPRESSED:
+            return None
+        page = tiff.pages[0]
+        pixels = page.asarray()
+        metadata = metadata_tags(page)
+        extratags = copied_tags(tiff)
+        byteorder = tiff.byteorder
+        photometric = page.photometric
+        subfiletype = page.subfiletype
+
+    temporary_path = path.with_name(f".{path.stem}.tmp{path.suffix}")
+    try:
+        tifffile.imwrite(
+            temporary_path,
+            pixels,
+            # write the values of the copied tags in the same byte order as they are in the original image
+            byteorder=byteorder,
+            photometric=photometric,
+            subfiletype=subfiletype,
+            resolution=(
+                (metadata["XResolution"], metadata["YResolution"])
+                if "XResolution" in metadata and "YResolution" in metadata
+                else None
+            ),
+            resolutionunit=metadata.get("ResolutionUnit"),
+            # the description and software of the original image are copied with the other tags
+            metadata=None,
+            software=False,
+            extratags=extratags,
+            # horizontal differencing makes neighboring pixels compress better and is reversed when read
+            predictor=True,
+            compression=compression,
+            compressionargs={"level": level},
+        )
+        with tifffile.TiffFile(temporary_path) as compressed_tiff:
+            compressed = compressed_tiff.pages[0].asarray()
+            compressed_metadata = metadata_tags(compressed_tiff.pages[0])
+        if compressed.dtype != pixels.dtype or not np.array_equal(compressed, pixels):
+            raise ValueError(f"The pixels of the compressed image for {path.name} are not the same as the original")
+        changed_tags = sorted(
+            name for name, value in metadata.items() if str(compressed_metadata.get(name)) != str(value)
+        )
+        if changed_tags:
+            raise ValueError(f"The tags {changed_tags} of the compressed image for {path.name} are not the same")
+        original_bytes = path.stat().st_size
+        os.replace(temporary_path, path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+
+    return {
+        "path": str(path),
+        "original_bytes": original_bytes,
+        "compressed_bytes": path.stat().st_size,
+        "sha256": image_catalog.file_checksum(path),
+    }
+
+
+def benchmark_reads(paths: List[pathlib.Path]) -> Dict[str, float]:
+    """Measure how fast images are read and decoded into pixels.
+
+    Args:
+        paths (List[pathlib.Path]): paths to the images to read
+
+    Returns:
+        Dict[str, float]: images read per second ("images_per_second"), MB of files read per second
+        ("file_mb_per_second"), and MB of pixels decoded per second ("pixel_mb_per_second")
+    """
+    start = time.perf_counter()
+    pixel_bytes = sum(tifffile.imread(path).nbytes for path in paths)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    return {
+        "images_per_second": len(paths) / elapsed,
+        "file_mb_per_second": sum(pathlib.Path(path).stat().st_size for path in paths) / 1024**2 / elapsed,
+        "pixel_mb_per_second": pixel_bytes / 1024**2 / elapsed,
+    }
+
+
+def compress_images(
+    images_dir: pathlib.Path,
+    compression: str = "zlib",
+    level: int = 6,
+    plates: Optional[List[str]] = None,
+    num_workers: Optional[int] = None,
+    download_cache_dir: Optional[pathlib.Path] = None,
+    benchmark_sample: int = 0,
+) -> List[dict]:
+    """Compress the uncompressed TIFF images in the plate folders of an image directory (see `compress_image`) and
+    update the image catalog for the directory.
+
+    Args:
+        images_dir (pathlib.Path): path to the directory with a folder per plate
+        compression (str, optional): name of the compression for tifffile, "zlib" or "zstd" (default is "zlib")
+        level (int, optional): compression level (default is 6)
+        plates (List[str], optional): names of the plates to compress, which defaults to all plates (default is None)
+        num_workers (int, optional): number of threads to compress images with, which defaults to the number of CPUs
+        on the machine (default is None)
+        download_cache_dir (pathlib.Path, optional): directory with the download manifests of the images (see
+        `download_figshare.download_figshare`), which are updated so the compressed images are not downloaded again
+        (default is None)
+        benchmark_sample (int, optional): number of random images to read before and after compression to compare the
+        read throughput, where no benchmark is run if 0 (default is 0)
+
+    Returns:
+        List[dict]: path, size before and after compression, and checksum of each compressed image
+    """
+    images_dir = pathlib.Path(images_dir)
+    paths = [
+        images_dir / image["path"]
+        for image in image_catalog.scan_images(images_dir)
+        if image["archive"] is None
+        and pathlib.Path(image["path"]).suffix.lower() in (".tif", ".tiff")
+        and (plates is None or image["plate"] in plates)
+    ]
+
+    sample = random.Random(0).sample(paths, min(benchmark_sample, len(paths)))
+    before = benchmark_reads(sample) if sample else None
+
+    # zlib and zstd release the GIL while they compress, so threads are used
+    compressed = []
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        for batch_start in range(0, len(paths), MANIFEST_BATCH_SIZE):
+            batch = [
+                result
+                for result in executor.map(
+                    lambda path: compress_image(path, compression=compression, level=level),
+                    paths[batch_start : batch_start + MANIFEST_BATCH_SIZE],
+                )
+                if result is not None
+            ]
+            # the download manifests are updated after each batch, so images compressed before the compression was
+            # stopped are not downloaded again
+            if download_cache_dir is not None and batch:
+                download_figshare.record_compressed_files(download_cache_dir, batch)
+            compressed.extend(batch)
+
+    image_catalog.update_catalog(images_dir)
+
+    original_bytes = sum(result["original_bytes"] for result in compressed)
+    compressed_bytes = sum(result["compressed_bytes"] for result in compressed)
+    print(
+        f"Compressed {len(compressed)} of {len(paths)} images in {images_dir.name} with {compression} from "
+        f"{original_bytes / 1024**3:.2f} GB to {compressed_bytes / 1024**3:.2f} GB"
+        + (f" ({original_bytes / compressed_bytes:.2f}x smaller)" if compressed_bytes else "")
+    )
+    if before is not None:
+        after = benchmark_reads(sample)
+        for name, value in before.items():
+            print(f"{name}: {value:.1f} before and {after[name]:.1f} after compression")
+
+    return compressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compress the TIFF images of an image directory without loss.")
+    parser.add_argument("images_dir", type=pathlib.Path, help="path to the directory with a folder per plate")
+    parser.add_argument("--compression", default="zlib", choices=["zlib", "zstd"], help="compression to use")
+    parser.add_argument("--level", type=int, default=6, help="compression level")
+    parser.add_argument("--plates", nargs="+", default=None, help="names of the plates to compress")
+    parser.add_argument("--download-cache-dir", type=pathlib.Path, default=None, help="directory with the download manifests")
+    parser.add_argument("--benchmark-sample", type=int, default=0, help="number of images to benchmark reads with")
+    args = parser.parse_args()
+    compress_images(
+        images_dir=args.images_dir,
+        compression=args.compression,
+        level=args.level,
+        plates=args.plates,
+        download_cache_dir=args.download_cache_dir,
+        benchmark_sample=args.benchmark_sample,
+    )
@@ -0,0 +1,302 @@
+"""
+This collection of functions merges the objects in a CellProfiler SQLite file into single cells and saves them as a
+Parquet file with one query in DuckDB, as an alternative to CytoTable `convert`. The cytoplasm of each single cell is
+joined to its parent cell and nucleus (on ImageNumber and the object numbers) and to its image set, with the same
+column names, types, and column order as CytoTable with the `cellprofiler_sqlite_pycytominer` preset and the joins
+from `cp_stream_convert.cytotable_joins` (including the site and the PathName columns). The tables are read straight
+from the SQLite file by the DuckDB SQLite scanner (the same reader CytoTable uses), and the number of threads and the
+memory limit of DuckDB can be set, where DuckDB spills to the disk when the merge does not fit in the memory limit.
+
+To merge a plate, and to compare the time and output with CytoTable, run this file as a script:
+
+    python utils/sc_merge.py Plate_1_nf1_analysis.sqlite Plate_1.parquet --threads 8 --compare-cytotable
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Dict, List, Optional
+import argparse
+import os
+import pathlib
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import cp_sqlite
+
+# columns that CytoTable treats as identifiers with the preset (`CONFIG_IDENTIFYING_COLUMNS`), which are renamed with
+# the Metadata prefix
+IDENTIFYING_COLUMNS = (
+    "ImageNumber",
+    "Metadata_Well",
+    "Parent_Cells",
+    "Parent_Nuclei",
+    "Cytoplasm_Parent_Cells",
+    "Cytoplasm_Parent_Nuclei",
+    "Cells_Number_Object_Number",
+    "Nuclei_Number_Object_Number",
+)
+
+# columns from the image table that are added to each single cell
+IMAGE_COLUMNS = ["Image_Metadata_Well", "Image_Metadata_Site", "Image_Metadata_Plate"]
+IMAGE_COLUMN_PATTERN = re.compile(r"^Image_(?:FileName|PathName)_")
+
+# order of the columns in the CytoTable output, where columns that are first are sorted by their position in this
+# list, then columns with "metadata" in the name, then columns of each compartment in the order of this list
+FIRST_COLUMNS = [
+    "tablenumber",
+    "metadata_tablenumber",
+    "imagenumber",
+    "metadata_imagenumber",
+    "objectnumber",
+    "object_number",
+]
+COMPARTMENT_COLUMN_ORDER = ["image", "cytoplasm", "cells", "nuclei"]
+
+
+def cytotable_column_name(table: str, column: str) -> str:
+    """Find the name that CytoTable gives a column of a table from `ExportToDatabase` with the preset, where
+    identifying columns get the Metadata prefix and other columns get the compartment prefix if they do not have it.
+
+    Args:
+        table (str): name of the table (e.g., Per_Cells)
+        column (str): name of the column in the table (e.g., Cells_Number_Object_Number)
+
+    Returns:
+        str: name of the column in the merged single cells (e.g., Metadata_Cells_Number_Object_Number)
+    """
+    compartment = table[len("Per_") :].capitalize()
+    if column not in IDENTIFYING_COLUMNS:
+        return column if column.startswith(compartment) else f"{compartment}_{column}"
+    if column.startswith(compartment):
+        return f"Metadata_{column}"
+    if column.startswith("Metadata_"):
+        return column
+    if not any(name in column for name in ["Image", "ObjectNumber", "TableNumber"]):
+        return f"Metadata_{compartment}_{column}"
+    return f"Metadata_{column}"
+
+
+def column_sort_key(column: str) -> int:
+    """Find the position of a column in the CytoTable column order (see `FIRST_COLUMNS`), where columns with the same
+    position are sorted by name.
+
+    Args:
+        column (str): name of the column in the merged single cells
+
+    Returns:
+        int: position of the column in the order
+    """
+    column_lower = column.lower()
+    if column_lower in FIRST_COLUMNS:
+        return FIRST_COLUMNS.index(column_lower)
+    if "metadata" in column_lower:
+        return len(FIRST_COLUMNS)
+    for position, compartment in enumerate(COMPARTMENT_COLUMN_ORDER, start=len(FIRST_COLUMNS) + 1):
+        if column_lower.startswith(compartment):
+            return position
+    return len(FIRST_COLUMNS) + len(COMPARTMENT_COLUMN_ORDER) + 1
+
+
+def merge_columns(tables: Dict[str, List[str]]) -> Dict[str, str]:
+    """Find the columns of the merged single cells and the table column each one is selected from.
+
+    Args:
+        tables (Dict[str, List[str]]): names of the columns of each table (see `cp_sqlite.table_columns`)
+
+    Raises:
+        KeyError: if the SQLite file does not have one of the tables or image columns that are merged
+
+    Returns:
+        Dict[str, str]: SQL for the table column (e.g., per_cells."Cells_AreaShape_Area") by the name of each column
+        of the merged single cells in the CytoTable column order
+    """
+    missing_tables = [
+        table
+        for table in [cp_sqlite.IMAGE_TABLE, cp_sqlite.MERGE_BASE_TABLE, *cp_sqlite.MERGE_TABLES]
+        if table not in tables
+    ]
+    if missing_tables:
+        raise KeyError(f"The SQLite file does not have the tables {missing_tables} to merge single cells from")
+    missing_columns = [column for column in IMAGE_COLUMNS if column not in tables[cp_sqlite.IMAGE_TABLE]]
+    if missing_columns:
+        raise KeyError(f"The image table does not have the columns {missing_columns}")
+
+    columns = {
+        cytotable_column_name(cp_sqlite.IMAGE_TABLE, column): f'{cp_sqlite.IMAGE_TABLE.lower()}."{column}"'
+        for column in tables[cp_sqlite.IMAGE_TABLE]
+        if column in IMAGE_COLUMNS or IMAGE_COLUMN_PATTERN.match(column)
+    }
+    # the image number of each single cell is taken from the cytoplasm, which every single cell has
+    for table in [cp_sqlite.MERGE_BASE_TABLE, *cp_sqlite.MERGE_TABLES]:
+        for column in tables[table]:
+            if table != cp_sqlite.MERGE_BASE_TABLE and column == "ImageNumber":
+                continue
+            columns.setdefault(cytotable_column_name(table, column), f'{table.lower()}."{column}"')
+
+    return {name: columns[name] for name in sorted(sorted(columns), key=column_sort_key)}
+
+
+def merge_query(sqlite_file_path: pathlib.Path, columns: Dict[str, str]) -> str:
+    """Create the DuckDB SQL that merges the objects in a SQLite file into single cells, where cytoplasms without a
+    parent cell or nucleus are left out like in CytoTable.
+
+    Args:
+        sqlite_file_path (pathlib.Path): path to the SQLite file
+        columns (Dict[str, str]): SQL for the table column by the name of each merged column (see `merge_columns`)
+
+    Returns:
+        str: SQL query for the merged single cells in image set and cytoplasm order
+    """
+    source = str(sqlite_file_path).replace("'", "''")
+    base = cp_sqlite.MERGE_BASE_TABLE.lower()
+    image = cp_sqlite.IMAGE_TABLE.lower()
+    joins = "\n".join(
+        f"JOIN sqlite_scan('{source}', '{table}') AS {table.lower()} "
+        f"ON {table.lower()}.ImageNumber = {base}.ImageNumber "
+        f'AND {table.lower()}."{object_number}" = {base}."{parent_column}"'
+        for table, (object_number, parent_column) in cp_sqlite.MERGE_TABLES.items()
+    )
+    select = ",\n".join(f'{column} AS "{name}"' for name, column in columns.items())
+    return (
+        f"SELECT\n{select}\n"
+        f"FROM sqlite_scan('{source}', '{cp_sqlite.MERGE_BASE_TABLE}') AS {base}\n"
+        f"{joins}\n"
+        f"LEFT JOIN sqlite_scan('{source}', '{cp_sqlite.IMAGE_TABLE}') AS {image} "
+        f"ON {image}.ImageNumber = {base}.ImageNumber\n"
+        f'ORDER BY {base}.ImageNumber, {base}."{cp_sqlite.MERGE_BASE_OBJECT_NUMBER}"'
+    )
+
+
+def merge_single_cells(
+    source_path: pathlib.Path,
+    dest_path: pathlib.Path,
+    threads: Optional[int] = None,
+    memory_limit_gb: Optional[float] = None,
+) -> int:
+    """Merge the objects in a CellProfiler SQLite file into single cells and save them as a Parquet file with the same
+    schema as CytoTable `convert` (see `merge_columns`).
+
+    Args:
+        source_path (pathlib.Path): path to the SQLite file from `ExportToDatabase`
+        dest_path (pathlib.Path): path to save the Parquet file
+        threads (int, optional): number of threads for DuckDB to use, which defaults to the number of CPUs on the
+        machine (default is None)
+        memory_limit_gb (float, optional): memory for DuckDB to use before spilling to the disk (next to the Parquet
+        file), which defaults to the DuckDB default of 80% of the machine memory (default is None)
+
+    Returns:
+        int: number of single cells saved
+    """
+    import duckdb
+
+    source_path = pathlib.Path(source_path).resolve(strict=True)
+    dest_path = pathlib.Path(dest_path)
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+
+    connection = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True)
+    try:
+        columns = merge_columns(cp_sqlite.table_columns(connection))
+    finally:
+        connection.close()
+
+    # write to a temporary file first so the Parquet file is never left half written if the merge is stopped
+    temporary_path = dest_path.with_name(f".{dest_path.name}.tmp")
+    spill_dir = dest_path.with_name(f".{dest_path.stem}_duckdb_tmp")
+    connection = duckdb.connect()
+    try:
+        connection.execute("INSTALL sqlite_scanner; LOAD sqlite_scanner;")
+        connection.execute(f"SET threads = {int(threads or os.cpu_count())}")
+        if memory_limit_gb is not None:
+            connection.execute(f"SET memory_limit = '{float(memory_limit_gb)}GB'")
+        connection.execute(f"SET temp_directory = '{spill_dir}'")
+        connection.execute(f"COPY ({merge_query(source_path, columns)}) TO '{temporary_path}' (FORMAT PARQUET)")
+        num_single_cells = connection.execute(f"SELECT COUNT(*) FROM read_parquet('{temporary_path}')").fetchone()[0]
+    finally:
+        connection.close()
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    temporary_path.replace(dest_path)
+
+    return num_single_cells
+
+
+def compare_with_cytotable(
+    source_path: pathlib.Path,
+    threads: Optional[int] = None,
+    memory_limit_gb: Optional[float] = None,
+) -> dict:
+    """Merge the single cells of a SQLite file with both `merge_single_cells` and CytoTable `convert` (see
+    `cp_stream_convert.convert_sqlite`), and compare the time and the outputs.
+
+    Args:
+        source_path (pathlib.Path): path to the SQLite file from `ExportToDatabase`
+        threads (int, optional): number of threads for DuckDB to use (default is None)
+        memory_limit_gb (float, optional): memory for DuckDB to use before spilling to the disk (default is None)
+
+    Returns:
+        dict: seconds to merge with DuckDB ("duckdb_seconds") and CytoTable ("cytotable_seconds"), number of single
+        cells from each ("duckdb_single_cells", "cytotable_single_cells"), if the column names and types are the same
+        ("same_schema"), and if the single cells are the same once sorted by image set and cytoplasm ("same_values")
+    """
+    import pyarrow.parquet as pq
+
+    import cp_stream_convert
+
+    with tempfile.TemporaryDirectory() as compare_dir:
+        duckdb_path = pathlib.Path(compare_dir) / "duckdb.parquet"
+        cytotable_path = pathlib.Path(compare_dir) / "cytotable.parquet"
+
+        start = time.perf_counter()
+        merge_single_cells(source_path, duckdb_path, threads=threads, memory_limit_gb=memory_limit_gb)
+        duckdb_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cp_stream_convert.convert_sqlite(source_path, cytotable_path)
+        cytotable_seconds = time.perf_counter() - start
+
+        # CytoTable sorts the single cells of each chunk by the cytoplasm object number, so both are sorted the same
+        # way before comparing
+        sort_keys = [("Metadata_ImageNumber", "ascending"), ("Cytoplasm_Number_Object_Number", "ascending")]
+        duckdb_table = pq.read_table(duckdb_path).sort_by(sort_keys)
+        cytotable_table = pq.read_table(cytotable_path).sort_by(sort_keys)
+        same_schema = duckdb_table.schema.remove_metadata().equals(cytotable_table.schema.remove_metadata())
+
+        return {
+            "duckdb_seconds": duckdb_seconds,
+            "cytotable_seconds": cytotable_seconds,
+            "duckdb_single_cells": duckdb_table.num_rows,
+            "cytotable_single_cells": cytotable_table.num_rows,
+            "same_schema": same_schema,
+            "same_values": same_schema and duckdb_table.replace_schema_metadata().equals(
+                cytotable_table.replace_schema_metadata()
+            ),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the objects in a CellProfiler SQLite file into single cells.")
+    parser.add_argument("source_path", type=pathlib.Path, help="path to the SQLite file")
+    parser.add_argument("dest_path", type=pathlib.Path, help="path to save the Parquet file")
+    parser.add_argument("--threads", type=int, default=None, help="number of threads for DuckDB to use")
+    parser.add_argument("--memory-limit-gb", type=float, default=None, help="memory for DuckDB to use")
+    parser.add_argument("--compare-cytotable", action="store_true", help="compare the time and output with CytoTable")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    num_single_cells = merge_single_cells(
+        source_path=args.source_path,
+        dest_path=args.dest_path,
+        threads=args.threads,
+        memory_limit_gb=args.memory_limit_gb,
+    )
+    print(
+        f"Merged {num_single_cells} single cells into {args.dest_path.name} in {time.perf_counter() - start:.1f} seconds"
+    )
+    if args.compare_cytotable:
+        for name, value in compare_with_cytotable(
+            source_path=args.source_path, threads=args.threads, memory_limit_gb=args.memory_limit_gb
+        ).items():
+            print(f"{name}: {value}")
@@ -0,0 +1,325 @@
+"""
+This collection of functions runs the per-plate chain of the workflow (download, illumination correction, analysis,
+and merging single cells) as a dependency graph, so each plate moves to its next stage as soon as it is ready instead
+of waiting for every plate to finish the stage. For example, the next plate can download while a plate is being
+corrected and the plate before is being analyzed.
+
+Each stage of a plate is run as the script for the module (e.g., `2.cellprofiler_analysis/scripts/nf1_analysis.py`)
+with the plates to process and the number of CPUs for CellProfiler given as environment variables, which the scripts
+read to only process those plates. Tasks only start when they fit within shared CPU and disk limits, and only one
+plate runs through each stage at a time.
+
+To run the whole workflow, run this file as a script from the root of the repository:
+
+    python utils/stage_scheduler.py --plates Plate_3 Plate_3_prime Plate_4 Plate_5
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+import argparse
+import json
+import multiprocessing
+import os
+import pathlib
+import subprocess
+import sys
+import time
+
+# root of the repository with a folder for each module
+REPO_DIR = pathlib.Path(__file__).resolve().parents[1]
+
+# environment variables that the scripts read when they are run by the scheduler
+STAGE_PLATES_ENV = "NF1_STAGE_PLATES"
+STAGE_MAX_WORKERS_ENV = "NF1_STAGE_MAX_WORKERS"
+
+# command to run python in the preprocessing environment (with CytoTable) from the main environment
+PREPROCESSING_PYTHON = ["conda", "run", "--no-capture-output", "-n", "nf1_preprocessing_env", "python"]
+
+# stages of each plate in the order they run, with the module directory the script is run from, the python command
+# (None for the python running the scheduler), and if the stage reads or writes the images (so it uses a disk slot),
+# where analysis reads every image of the plate and writes the SQLite file
+STAGES = {
+    "download": {
+        "module_dir": "0.download_data",
+        "script": "scripts/download_plates.py",
+        "python": None,
+        "uses_disk": True,
+    },
+    "illum_correction": {
+        "module_dir": "1.cellprofiler_ic",
+        "script": "scripts/nf1_ic.py",
+        "python": None,
+        "uses_disk": True,
+    },
+    "analysis": {
+        "module_dir": "2.cellprofiler_analysis",
+        "script": "scripts/nf1_analysis.py",
+        "python": None,
+        "uses_disk": True,
+    },
+    "merge": {
+        "module_dir": "3.processing_features",
+        "script": "scripts/0.merge_sc_cytotable.py",
+        "python": PREPROCESSING_PYTHON,
+        "uses_disk": True,
+    },
+}
+
+# plates that are downloaded together since they are in the same figshare item (see `download_plates.ipynb`)
+DOWNLOAD_GROUPS = [("Plate_3", "Plate_3_prime")]
+
+
+def run_task_graph(
+    tasks: List[dict],
+    capacities: Dict[str, int],
+    events_path: Optional[pathlib.Path] = None,
+) -> Dict[str, str]:
+    """Run tasks once the tasks they depend on have completed and there are enough resources for them, where
+    tasks that are ready are started in the order they are listed. When a task fails, the tasks that depend on it
+    are not run.
+
+    Args:
+        tasks (List[dict]): tasks with a unique name ("name"), the names of the tasks it depends on ("depends_on"),
+        the amount of each resource it uses while it runs ("resources"), and a function that runs the task and
+        returns a return code ("run")
+        capacities (Dict[str, int]): total amount of each resource that the running tasks can use, where a task that
+        asks for more than the total is given the total
+        events_path (pathlib.Path, optional): path to a JSONL file to append the start and finish events of each task
+        to (default is None)
+
+    Returns:
+        Dict[str, str]: status of each task, which is "completed", "failed", or "skipped" (a task it depends on failed)
+    """
+
+    def write_event(event: str, task: dict, **fields) -> None:
+        if events_path is None:
+            return
+        record = {"event": event, "task": task["name"], "time": time.time()}
+        record.update(fields)
+        with open(events_path, "a") as events_file:
+            events_file.write(json.dumps(record) + "\n")
+
+    # a task can not ask for more than the total of a resource or it would never start
+    requests = {
+        task["name"]: {
+            resource: min(amount, capacities[resource]) for resource, amount in task["resources"].items()
+        }
+        for task in tasks
+    }
+    available = dict(capacities)
+    statuses: Dict[str, str] = {}
+    pending = list(tasks)
+    # running tasks by future
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(len(tasks), 1)) as executor:
+        while pending or running:
+            for task in list(pending):
+                dependency_statuses = [statuses.get(name) for name in task["depends_on"]]
+                if any(status in ("failed", "skipped") for status in dependency_statuses):
+                    statuses[task["name"]] = "skipped"
+                    pending.remove(task)
+                    write_event("skipped", task)
+                    print(f"Skipping {task['name']} since a task it depends on did not complete")
+                    continue
+                if not all(status == "completed" for status in dependency_statuses):
+                    continue
+                request = requests[task["name"]]
+                if any(available[resource] < amount for resource, amount in request.items()):
+                    continue
+
+                for resource, amount in request.items():
+                    available[resource] -= amount
+                pending.remove(task)
+                running[executor.submit(task["run"])] = task
+                write_event("start", task, resources=request)
+                print(f"Started {task['name']}")
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                for resource, amount in requests[task["name"]].items():
+                    available[resource] += amount
+                try:
+                    returncode = future.result()
+                except Exception as error:
+                    print(f"{task['name']} raised {error!r}")
+                    returncode = -1
+                statuses[task["name"]] = "completed" if returncode == 0 else "failed"
+                write_event("finish", task, returncode=returncode)
+                print(f"Finished {task['name']} with a return code of {returncode}")
+
+    return statuses
+
+
+def stage_runner(
+    stage: str, plates: List[str], log_path: pathlib.Path, max_workers: Optional[int] = None
+) -> Callable[[], int]:
+    """Create the function that runs the script of a stage for some plates with the output written to a log file.
+
+    Args:
+        stage (str): name of the stage (see `STAGES`)
+        plates (List[str]): names of the plates to process
+        log_path (pathlib.Path): path to the log file for the output of the script
+        max_workers (int, optional): number of CellProfiler processes the script can run at once (default is None)
+
+    Returns:
+        Callable[[], int]: function that runs the script and returns its return code
+    """
+    info = STAGES[stage]
+    command = (info["python"] or [sys.executable]) + [info["script"]]
+    env = dict(os.environ)
+    env[STAGE_PLATES_ENV] = ",".join(plates)
+    if max_workers is not None:
+        env[STAGE_MAX_WORKERS_ENV] = str(max_workers)
+
+    def run() -> int:
+        with open(log_path, "wb") as log_file:
+            return subprocess.run(
+                command, cwd=REPO_DIR / info["module_dir"], env=env, stdout=log_file, stderr=subprocess.STDOUT
+            ).returncode
+
+    return run
+
+
+def create_stage_tasks(
+    plates: List[str],
+    stages: List[str],
+    stage_cpus: Dict[str, int],
+    log_dir: pathlib.Path,
+) -> List[dict]:
+    """Create the tasks for each stage of each plate, where each task depends on the previous stage of the plate.
+    Tasks are listed by plate, so the earliest plate that is ready for a stage is run first.
+
+    Args:
+        plates (List[str]): names of the plates in the order to process them
+        stages (List[str]): names of the stages to run in order (see `STAGES`)
+        stage_cpus (Dict[str, int]): number of CPUs used by each stage
+        log_dir (pathlib.Path): directory for the log file of each task
+
+    Returns:
+        List[dict]: tasks for `run_task_graph`
+    """
+    tasks = []
+    # the task that each plate is waiting on
+    previous_tasks = {plate: None for plate in plates}
+    for stage in stages:
+        # plates in the same download group are downloaded (and extracted) together by one task
+        if stage == "download":
+            units = []
+            for plate in plates:
+                group = next((group for group in DOWNLOAD_GROUPS if plate in group), (plate,))
+                if group not in units:
+                    units.append(group)
+        else:
+            units = [(plate,) for plate in plates]
+
+        for unit in units:
+            name = f"{stage}:{'+'.join(unit)}"
+            resources = {"cpus": stage_cpus[stage], stage: 1}
+            if STAGES[stage]["uses_disk"]:
+                resources["disk"] = 1
+            tasks.append(
+                {
+                    "name": name,
+                    "plates": list(unit),
+                    "depends_on": sorted(
+                        {previous_tasks[plate] for plate in unit if previous_tasks.get(plate) is not None}
+                    ),
+                    "resources": resources,
+                    "run": stage_runner(
+                        stage=stage,
+                        plates=list(unit),
+                        log_path=pathlib.Path(f"{log_dir}/{'+'.join(unit)}_{stage}.log"),
+                        max_workers=stage_cpus[stage],
+                    ),
+                }
+            )
+            for plate in unit:
+                if plate in previous_tasks:
+                    previous_tasks[plate] = name
+
+    # order the tasks by the first plate they process so the earlier plates are ahead for every stage
+    return sorted(tasks, key=lambda task: min(plates.index(plate) for plate in task["plates"] if plate in plates))
+
+
+def run_stages(
+    plates: List[str],
+    stages: Optional[List[str]] = None,
+    max_cpus: Optional[int] = None,
+    max_disk_tasks: int = 2,
+    ic_workers: Optional[int] = None,
+    analysis_workers: Optional[int] = None,
+    log_dir: pathlib.Path = REPO_DIR / "stage_logs",
+) -> Dict[str, str]:
+    """Run the stages for each plate as a dependency graph within shared CPU and disk limits. By default, a quarter
+    of the CPUs are given to illumination correction and the rest (minus one CPU each for downloading and merging)
+    to analysis, so every stage can run at the same time.
+
+    Args:
+        plates (List[str]): names of the plates in the order to process them
+        stages (List[str], optional): names of the stages to run, where stages that are left out (e.g., when the
+        plates are already downloaded) are not waited on (default is None, which runs every stage)
+        max_cpus (int, optional): total CPUs for all running stages, which defaults to the number of CPUs on the
+        machine (default is None)
+        max_disk_tasks (int, optional): number of stages that read or write the images at once (default is 2)
+        ic_workers (int, optional): number of CellProfiler processes for illumination correction (default is None)
+        analysis_workers (int, optional): number of CellProfiler processes for analysis (default is None)
+        log_dir (pathlib.Path, optional): directory for the log file of each task and the JSONL file of events
+        (default is "stage_logs" in the root of the repository)
+
+    Raises:
+        ValueError: if a stage is not in `STAGES`
+
+    Returns:
+        Dict[str, str]: status of each task (see `run_task_graph`)
+    """
+    unknown = set(stages or []) - set(STAGES)
+    if unknown:
+        raise ValueError(f"The stages {sorted(unknown)} are not in {list(STAGES)}")
+    # stages always run in the order of the workflow
+    stages = [stage for stage in STAGES if stages is None or stage in stages]
+
+    max_cpus = max_cpus or multiprocessing.cpu_count()
+    ic_workers = ic_workers or max(1, max_cpus // 4)
+    analysis_workers = analysis_workers or max(1, max_cpus - ic_workers - 2)
+    stage_cpus = {"download": 1, "illum_correction": ic_workers, "analysis": analysis_workers, "merge": 1}
+
+    pathlib.Path(log_dir).mkdir(parents=True, exist_ok=True)
+    tasks = create_stage_tasks(plates=plates, stages=stages, stage_cpus=stage_cpus, log_dir=log_dir)
+    capacities = {"cpus": max_cpus, "disk": max_disk_tasks, **{stage: 1 for stage in stages}}
+    events_path = pathlib.Path(f"{log_dir}/stage_events.jsonl")
+    print(f"Running {len(tasks)} tasks with {max_cpus} CPUs, follow the progress in {events_path}")
+
+    statuses = run_task_graph(tasks=tasks, capacities=capacities, events_path=events_path)
+    for name, status in statuses.items():
+        if status != "completed":
+            print(f"{name} was {status}")
+    return statuses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run download, illumination correction, analysis, and merging for each plate as a pipeline."
+    )
+    parser.add_argument("--plates", nargs="+", required=True, help="names of the plates in the order to process them")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), help="stages to run (default is all)")
+    parser.add_argument("--max-cpus", type=int, help="total CPUs for all running stages")
+    parser.add_argument("--max-disk-tasks", type=int, default=2, help="stages that read or write images at once")
+    parser.add_argument("--ic-workers", type=int, help="CellProfiler processes for illumination correction")
+    parser.add_argument("--analysis-workers", type=int, help="CellProfiler processes for analysis")
+    args = parser.parse_args()
+    statuses = run_stages(
+        plates=args.plates,
+        stages=args.stages,
+        max_cpus=args.max_cpus,
+        max_disk_tasks=args.max_disk_tasks,
+        ic_workers=args.ic_workers,
+        analysis_workers=args.analysis_workers,
+    )
+    sys.exit(0 if all(status == "completed" for status in statuses.values()) else 1)
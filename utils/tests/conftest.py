@@ -0,0 +1,9 @@
+"""
+The utils are imported by name in the notebooks (after adding `utils` to sys.path), so the tests import them the
+same way.
+"""
+
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
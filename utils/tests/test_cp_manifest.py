@@ -0,0 +1,68 @@
+import pathlib
+
+import pytest
+
+import cp_manifest
+
+
+@pytest.fixture
+def path_to_pipeline(tmp_path: pathlib.Path) -> pathlib.Path:
+    path_to_pipeline = tmp_path / "NF1_analysis_4channel.cppipe"
+    path_to_pipeline.write_text("CellProfiler Pipeline\n")
+    return path_to_pipeline
+
+
+@pytest.mark.parametrize(
+    "ranges, expected",
+    [
+        ([], []),
+        ([(5, 8), (1, 3)], [(1, 3), (5, 8)]),
+        # adjacent ranges are combined
+        ([(1, 3), (4, 6)], [(1, 6)]),
+        # overlapping and contained ranges are combined
+        ([(1, 5), (3, 8), (4, 4)], [(1, 8)]),
+        ([(10, 12), (1, 2), (2, 9)], [(1, 12)]),
+    ],
+)
+def test_merge_ranges(ranges, expected):
+    assert cp_manifest.merge_ranges(ranges) == expected
+
+
+def test_missing_image_sets_without_manifest(tmp_path, path_to_pipeline):
+    assert cp_manifest.missing_image_sets(tmp_path, path_to_pipeline, num_image_sets=10) == [(1, 10)]
+
+
+def test_missing_image_sets_gaps(tmp_path, path_to_pipeline):
+    for first, last in [(3, 4), (8, 8), (5, 6)]:
+        cp_manifest.record_completed_image_sets(tmp_path, path_to_pipeline, first, last)
+
+    assert cp_manifest.missing_image_sets(tmp_path, path_to_pipeline, num_image_sets=10) == [
+        (1, 2),
+        (7, 7),
+        (9, 10),
+    ]
+
+
+def test_missing_image_sets_complete(tmp_path, path_to_pipeline):
+    cp_manifest.record_completed_image_sets(tmp_path, path_to_pipeline, 1, 5)
+    cp_manifest.record_completed_image_sets(tmp_path, path_to_pipeline, 6, 10)
+
+    assert cp_manifest.missing_image_sets(tmp_path, path_to_pipeline, num_image_sets=10) == []
+
+
+def test_missing_image_sets_changed_pipeline(tmp_path, path_to_pipeline):
+    cp_manifest.record_completed_image_sets(tmp_path, path_to_pipeline, 1, 5)
+    path_to_pipeline.write_text("CellProfiler Pipeline\nchanged\n")
+
+    with pytest.raises(ValueError):
+        cp_manifest.missing_image_sets(tmp_path, path_to_pipeline, num_image_sets=10)
+
+
+def test_missing_image_sets_changed_load_data_csv(tmp_path, path_to_pipeline):
+    path_to_csv = tmp_path / "load_data.csv"
+    path_to_csv.write_text("FileName_OrigDAPI\nA01_01_1_1_DAPI_001.tif\n")
+    cp_manifest.record_completed_image_sets(tmp_path, path_to_pipeline, 1, 1, path_to_csv=path_to_csv, num_image_sets=1)
+    path_to_csv.write_text("FileName_OrigDAPI\nA01_01_1_2_DAPI_001.tif\n")
+
+    with pytest.raises(ValueError):
+        cp_manifest.missing_image_sets(tmp_path, path_to_pipeline, num_image_sets=1, path_to_csv=path_to_csv)
@@ -0,0 +1,56 @@
+import pathlib
+
+import pytest
+
+import cp_retry
+
+
+@pytest.mark.parametrize(
+    "returncode, log_text, expected",
+    [
+        (1, 'Exception in thread "main" java.lang.OutOfMemoryError: Java heap space\n', "java_heap"),
+        (1, "numpy.core._exceptions.MemoryError: Unable to allocate 1.21 GiB for an array\n", "out_of_memory"),
+        (1, "FileNotFoundError: [Errno 2] No such file or directory: 'A01_01_1_1_DAPI_001.tif'\n", "missing_file"),
+        (1, "sqlite3.OperationalError: database is locked\n", "database_locked"),
+        # the error messages are checked before the return code
+        (-9, "Java heap space\n", "java_heap"),
+        (-9, "Times reported are CPU and Wall-clock times for each module\n", "killed"),
+        (137, "", "killed"),
+        (-11, "", "segfault"),
+        (143, "", "terminated"),
+        (1, "ValueError: Failed to run module IdentifyPrimaryObjects\n", "error"),
+        (
+            -1,
+            f"Job 1234 {cp_retry.LOST_JOB_MESSAGE} (scheduler state: OUT_OF_MEMORY)\n",
+            "out_of_memory",
+        ),
+        (-1, f"Job 1234 {cp_retry.LOST_JOB_MESSAGE} (scheduler state: TIMEOUT)\n", "timeout"),
+        (-1, f"Job 1234 {cp_retry.LOST_JOB_MESSAGE} (scheduler state: NODE_FAIL)\n", "lost"),
+    ],
+)
+def test_classify_failure(tmp_path, returncode, log_text, expected):
+    log_path = tmp_path / "Plate_1_analysis_run.log"
+    log_path.write_text(log_text)
+
+    assert cp_retry.classify_failure(returncode, log_path) == expected
+
+
+def test_classify_failure_without_log(tmp_path):
+    assert cp_retry.classify_failure(-9, tmp_path / "missing.log") == "killed"
+    assert cp_retry.classify_failure(1, tmp_path / "missing.log") == "error"
+
+
+@pytest.mark.parametrize(
+    "failure, retryable",
+    [
+        ("java_heap", True),
+        ("out_of_memory", True),
+        ("lost", True),
+        ("timeout", False),
+        ("missing_file", False),
+        ("segfault", False),
+        ("error", False),
+    ],
+)
+def test_is_retryable(failure, retryable):
+    assert cp_retry.is_retryable(failure) == retryable
@@ -0,0 +1,32 @@
+import pytest
+
+import cp_shards
+
+
+@pytest.mark.parametrize(
+    "num_image_sets, shard_size, expected",
+    [
+        (10, 5, [(1, 5), (6, 10)]),
+        # the last shard has the image sets that are left over
+        (11, 5, [(1, 5), (6, 10), (11, 11)]),
+        (3, 5, [(1, 3)]),
+        (3, 1, [(1, 1), (2, 2), (3, 3)]),
+        (0, 5, []),
+    ],
+)
+def test_create_image_set_shards(num_image_sets, shard_size, expected):
+    assert cp_shards.create_image_set_shards(num_image_sets, shard_size) == expected
+
+
+@pytest.mark.parametrize("num_image_sets, shard_size", [(1, 1), (97, 10), (100, 7), (250, 250)])
+def test_create_image_set_shards_cover_every_image_set(num_image_sets, shard_size):
+    shards = cp_shards.create_image_set_shards(num_image_sets, shard_size)
+
+    image_sets = [image_set for first, last in shards for image_set in range(first, last + 1)]
+    assert image_sets == list(range(1, num_image_sets + 1))
+    assert all(last - first + 1 <= shard_size for first, last in shards)
+
+
+def test_create_image_set_shards_invalid_size():
+    with pytest.raises(ValueError):
+        cp_shards.create_image_set_shards(10, 0)
@@ -0,0 +1,229 @@
+"""
+This collection of functions reads images straight from the zip files downloaded from Figshare, so the plates do not
+have to be extracted for analyses that only read images (e.g., reviewing a few images for QC). When a download is kept
+as a zip file, an index with the position of each image in the zip file is saved next to it (`{zip file}.index.json`),
+and the images are read from the zip file with a memory map through the index. Each image has the same path (relative
+to the image directory) as it would have if the zip file was extracted, so the image catalog lists the images in the
+zip files with the extracted images.
+
+CellProfiler can only read images from the disk, so the plates must be extracted (or the images needed copied out with
+`ZipImageStore.materialize`) before running the CellProfiler pipelines.
+"""
+
+# must use the annotations import as CellProfiler is restricted to Python 3.8 at this time so Optional
+# by itself only works in Python 3.10
+from __future__ import annotations
+from typing import Dict, Iterable, List
+import hashlib
+import io
+import json
+import mmap
+import pathlib
+import threading
+import zipfile
+import zlib
+
+# suffix of the index that is saved next to each zip file that images are read from
+INDEX_SUFFIX = ".index.json"
+
+# number of bytes to hash at a time when checksumming an image in a zip file
+CHUNK_SIZE_BYTES = 1024**2
+
+
+def index_path(path_to_zip_file: pathlib.Path) -> pathlib.Path:
+    """Find the path to the index of a zip file.
+
+    Args:
+        path_to_zip_file (pathlib.Path): path to the zip file
+
+    Returns:
+        pathlib.Path: path to the index, which is next to the zip file
+    """
+    return pathlib.Path(f"{path_to_zip_file}{INDEX_SUFFIX}")
+
+
+def write_index(path_to_zip_file: pathlib.Path, members: List[dict]) -> None:
+    """Save the index of the images in a zip file.
+
+    Args:
+        path_to_zip_file (pathlib.Path): path to the zip file the index is for (next to the zip file)
+        members (List[dict]): path of the image relative to the image directory ("path"), path of the zip file with
+        the image relative to the image directory ("archive"), position of the image data in the zip file
+        ("data_offset"), compression ("compress_type"), compressed size ("compress_size"), size ("file_size"), and CRC
+        ("crc") of each image
+    """
+    path = index_path(path_to_zip_file)
+    # write to a temporary file first so the index is never left half written if the download is stopped
+    temporary_path = path.with_suffix(".tmp")
+    with open(temporary_path, "w") as index_file:
+        json.dump(members, index_file)
+    temporary_path.replace(path)
+
+
+def load_indexes(images_dir: pathlib.Path) -> Dict[str, dict]:
+    """Load the indexes of the zip files in an image directory.
+
+    Args:
+        images_dir (pathlib.Path): path to the directory with the zip files (and a folder per extracted plate)
+
+    Returns:
+        Dict[str, dict]: index entry (see `write_index`) of each image by its path relative to the image directory
+    """
+    members = {}
+    for path in sorted(pathlib.Path(images_dir).glob(f"*{INDEX_SUFFIX}")):
+        with open(path, "r") as index_file:
+            for member in json.load(index_file):
+                members[member["path"]] = member
+    return members
+
+
+class ZipImageStore:
+    """
+    Read the images in the zip files of an image directory through their indexes, where the images that are extracted
+    are read from the disk instead. The zip files are memory mapped, so reading an image only reads its bytes from the
+    zip file and the store can be shared by threads.
+    """
+
+    def __init__(self, images_dir: pathlib.Path):
+        """
+        Args:
+            images_dir (pathlib.Path): path to the directory with the zip files (and a folder per extracted plate)
+        """
+        self.images_dir = pathlib.Path(images_dir)
+        self.members = load_indexes(self.images_dir)
+        self.maps: Dict[str, mmap.mmap] = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.members or (self.images_dir / path).is_file()
+
+    def paths(self) -> List[str]:
+        """List the images in the zip files.
+
+        Returns:
+            List[str]: sorted paths of the images relative to the image directory
+        """
+        return sorted(self.members)
+
+    def archive_map(self, archive: str) -> mmap.mmap:
+        """Memory map a zip file, which is mapped once and reused for every image in it.
+
+        Args:
+            archive (str): path of the zip file relative to the image directory
+
+        Returns:
+            mmap.mmap: read-only memory map of the zip file
+        """
+        with self.lock:
+            if archive not in self.maps:
+                with open(self.images_dir / archive, "rb") as zip_file:
+                    self.maps[archive] = mmap.mmap(zip_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.maps[archive]
+
+    def member_data(self, path: str) -> memoryview:
+        """Find the (compressed) data of an image in its zip file without copying it.
+
+        Args:
+            path (str): path of the image relative to the image directory
+
+        Returns:
+            memoryview: view of the image data in the memory map of the zip file
+        """
+        member = self.members[path]
+        start = member["data_offset"]
+        return memoryview(self.archive_map(member["archive"]))[start : start + member["compress_size"]]
+
+    def read_bytes(self, path: str) -> bytes:
+        """Read an image from the disk if it is extracted, otherwise from its zip file (checking the CRC).
+
+        Args:
+            path (str): path of the image relative to the image directory
+
+        Raises:
+            KeyError: if the image is not extracted or in a zip file
+            zipfile.BadZipFile: if the image in the zip file does not match its CRC
+
+        Returns:
+            bytes: contents of the image file
+        """
+        if (self.images_dir / path).is_file():
+            return (self.images_dir / path).read_bytes()
+        member = self.members[path]
+        data = self.member_data(path)
+        if member["compress_type"] == zipfile.ZIP_DEFLATED:
+            contents = zlib.decompress(data, -zlib.MAX_WBITS)
+        elif member["compress_type"] == zipfile.ZIP_STORED:
+            contents = bytes(data)
+        else:
+            raise zipfile.BadZipFile(f"The compression of {path} is not supported")
+        if zlib.crc32(contents) != member["crc"]:
+            raise zipfile.BadZipFile(f"The CRC of {path} does not match the zip file")
+        return contents
+
+    def open(self, path: str) -> io.BytesIO:
+        """Open an image as a file object, which can be given to image readers (e.g., `PIL.Image.open` or
+        `tifffile.imread`).
+
+        Args:
+            path (str): path of the image relative to the image directory
+
+        Returns:
+            io.BytesIO: file object with the contents of the image file
+        """
+        return io.BytesIO(self.read_bytes(path))
+
+    def checksum(self, path: str) -> str:
+        """Find the SHA256 checksum of an image in a zip file, hashing it in chunks so large images are not copied.
+
+        Args:
+            path (str): path of the image relative to the image directory
+
+        Returns:
+            str: hex digest of the contents of the image file
+        """
+        member = self.members[path]
+        data = self.member_data(path)
+        checksum = hashlib.sha256()
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if member["compress_type"] == zipfile.ZIP_DEFLATED else None
+        for start in range(0, len(data), CHUNK_SIZE_BYTES):
+            chunk = data[start : start + CHUNK_SIZE_BYTES]
+            checksum.update(decompressor.decompress(chunk) if decompressor is not None else chunk)
+        if decompressor is not None:
+            checksum.update(decompressor.flush())
+        return checksum.hexdigest()
+
+    def materialize(self, paths: Iterable[str], cache_dir: pathlib.Path) -> Dict[str, pathlib.Path]:
+        """Find a path on the disk for each image, copying the images that are only in a zip file to a cache directory
+        (with the same relative path) for tools that can only read images from the disk.
+
+        Args:
+            paths (Iterable[str]): paths of the images relative to the image directory
+            cache_dir (pathlib.Path): directory to copy the images that are only in a zip file to
+
+        Returns:
+            Dict[str, pathlib.Path]: absolute path on the disk of each image
+        """
+        local_paths = {}
+        for path in paths:
+            if (self.images_dir / path).is_file():
+                local_paths[path] = (self.images_dir / path).resolve()
+                continue
+            cached_path = pathlib.Path(cache_dir) / path
+            if not cached_path.is_file() or cached_path.stat().st_size != self.members[path]["file_size"]:
+                cached_path.parent.mkdir(parents=True, exist_ok=True)
+                cached_path.write_bytes(self.read_bytes(path))
+            local_paths[path] = cached_path.resolve()
+        return local_paths
+
+    def close(self) -> None:
+        """Close the memory maps of the zip files."""
+        with self.lock:
+            for archive_map in self.maps.values():
+                archive_map.close()
+            self.maps = {}
+
+    def __enter__(self) -> ZipImageStore:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()